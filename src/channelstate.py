@@ -0,0 +1,381 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Compact tracking of who is in which channel
+
+SingleServerIRCBot keeps an irc.bot.Channel per channel, with a dict
+per user mode and a case folded copy of every nick in each of them.
+In channels with thousands of users that's most of the bot's memory,
+and a NAMES burst on join builds all of it one nick at a time.
+
+ChannelStore holds CompactChannels instead:
+- a channel is one dict of lowercased nick to a bitset of its user
+  modes (op, voice...), the small ints all shared by Python
+- how each nick is written is kept once, in a NickPool shared by all
+  channels, and only if it isn't all lowercase
+- ASCII nicks are stored as byte strings
+- NAMES replies are parsed as they stream in, without splitting them
+  into lists first
+
+Channels named in untracked don't keep their members at all, for big
+channels where the bot doesn't care who's there. They still know
+their own modes.
+
+Both kinds have the interface of irc.bot.Channel.
+"""
+
+import re
+from irc.dict import IRCDict
+from irc.strings import IRCFoldedCase
+
+# bits of the user modes we know about, others get the next free ones
+mode_bits = {'o': 1, 'v': 2, 'q': 4, 'h': 8, 'a': 16}
+nick_token = re.compile(r"\S+")
+# nicks that str.lower() wouldn't fold like IRC does
+needs_folding = re.compile(u"[\\[\\]\\\\^\x80-\uffff]")
+
+
+def fold(nick):
+    """Lowercase a nick the IRC way, fast for plain ones"""
+    if needs_folding.search(nick):
+        if isinstance(nick, str):
+            # the translation table only works on unicode
+            nick = nick.decode('utf-8', 'replace')
+        return nick.translate(IRCFoldedCase.translation)
+    return nick.lower()
+
+
+def mode_bit(mode):
+    bit = mode_bits.get(mode)
+    if bit is None:
+        bit = mode_bits[mode] = 1 << len(mode_bits)
+    return bit
+
+
+class NickPool(object):
+    """
+    How every nick the channels know is written, stored once.
+
+    Nicks are kept as byte strings when they're ASCII, which compare
+    and hash equal to their unicode forms in half the memory or less.
+    A nick is forgotten when no channel has it anymore.
+    """
+
+    def __init__(self):
+        # lowercased nick -> nick, the same string if it's all lowercase
+        self.nicks = {}
+        self.channels = []
+
+    def acquire(self, nick, key=None):
+        """Remember a nick, returning its lowercased form"""
+        key = key or fold(nick)
+        try:
+            key, nick = str(key), str(nick)
+        except UnicodeError:
+            pass
+        self.nicks[key] = key if nick == key else nick
+        return key
+
+    def release(self, key):
+        """Forget a nick if no channel has it"""
+        if not any(key in channel.members for channel in self.channels):
+            self.nicks.pop(key, None)
+
+    def display(self, key):
+        return self.nicks[key]
+
+    def __contains__(self, key):
+        return key in self.nicks
+
+    def __len__(self):
+        return len(self.nicks)
+
+
+class CompactChannel(object):
+    """Members of a channel as a dict of lowercased nick to mode bits"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.members = {}
+        self.modes = {}
+
+    def _nicks(self, bit=None):
+        display = self.pool.display
+        return [display(key) for key, bits in self.members.iteritems()
+                if bit is None or bits & bit]
+
+    def users(self):
+        return self._nicks()
+
+    def opers(self):
+        return self._nicks(mode_bits['o'])
+
+    def voiced(self):
+        return self._nicks(mode_bits['v'])
+
+    def owners(self):
+        return self._nicks(mode_bits['q'])
+
+    def halfops(self):
+        return self._nicks(mode_bits['h'])
+
+    def __len__(self):
+        return len(self.members)
+
+    def _has(self, nick, bit):
+        return bool(self.members.get(fold(nick), 0) & bit)
+
+    def has_user(self, nick):
+        return fold(nick) in self.members
+
+    def is_oper(self, nick):
+        return self._has(nick, mode_bits['o'])
+
+    def is_voiced(self, nick):
+        return self._has(nick, mode_bits['v'])
+
+    def is_owner(self, nick):
+        return self._has(nick, mode_bits['q'])
+
+    def is_halfop(self, nick):
+        return self._has(nick, mode_bits['h'])
+
+    def add_user(self, nick, bits=0):
+        key = fold(nick)
+        if key in self.members:
+            self.members[key] |= bits
+        else:
+            self.members[self.pool.acquire(nick, key)] = bits
+
+    def remove_user(self, nick):
+        key = fold(nick)
+        if self.members.pop(key, None) is not None:
+            self.pool.release(key)
+
+    def change_nick(self, before, after):
+        bits = self.members.pop(fold(before), None)
+        if bits is None:
+            return
+        self.pool.release(fold(before))
+        self.add_user(after, bits)
+
+    def set_userdetails(self, nick, details):
+        pass
+
+    def set_mode(self, mode, value=None):
+        if mode in mode_bits and value is not None:
+            key = fold(value)
+            if key in self.members:
+                self.members[key] |= mode_bits[mode]
+        else:
+            self.modes[mode] = value
+
+    def clear_mode(self, mode, value=None):
+        if mode in mode_bits and value is not None:
+            key = fold(value)
+            if key in self.members:
+                self.members[key] &= ~mode_bits[mode]
+        else:
+            self.modes.pop(mode, None)
+
+    def clear(self):
+        """Forget all members"""
+        members, self.members = self.members, {}
+        for key in members:
+            self.pool.release(key)
+
+    def has_mode(self, mode):
+        return mode in self.modes
+
+    def is_moderated(self):
+        return self.has_mode("m")
+
+    def is_secret(self):
+        return self.has_mode("s")
+
+    def is_protected(self):
+        return self.has_mode("p")
+
+    def has_topic_lock(self):
+        return self.has_mode("t")
+
+    def is_invite_only(self):
+        return self.has_mode("i")
+
+    def has_allow_external_messages(self):
+        return self.has_mode("n")
+
+    def has_limit(self):
+        return self.has_mode("l")
+
+    def limit(self):
+        return self.modes.get("l")
+
+    def has_key(self):
+        return self.has_mode("k")
+
+
+class UntrackedChannel(CompactChannel):
+    """A channel that doesn't keep its members, only its modes"""
+
+    def add_user(self, nick, bits=0):
+        pass
+
+
+class ChannelStore(IRCDict):
+    """
+    The channels the bot is in, by name.
+
+    untracked: names of the channels not to keep the members of
+    """
+
+    def __init__(self, untracked=()):
+        super(ChannelStore, self).__init__()
+        self.pool = NickPool()
+        self.untracked = set(fold(name) for name in untracked)
+
+    def new(self, name):
+        """Start tracking a channel we joined, returning it"""
+        if name in self:
+            del self[name]
+        cls = UntrackedChannel if fold(name) in self.untracked else CompactChannel
+        channel = self[name] = cls(self.pool)
+        self.pool.channels.append(channel)
+        return channel
+
+    def __delitem__(self, name):
+        channel = self[name]
+        self.pool.channels.remove(channel)
+        channel.clear()
+        super(ChannelStore, self).__delitem__(name)
+
+    def clear(self):
+        super(ChannelStore, self).clear()
+        self.pool = NickPool()
+
+    def names(self, name, nick_list, prefixes):
+        """
+        Add the nicks of a NAMES reply to a channel.
+
+        prefixes maps nick prefixes to their modes, ie. {'@': 'o'}
+        """
+        channel = self.get(name)
+        if channel is None or isinstance(channel, UntrackedChannel):
+            return
+        prefix_bits = dict((prefix, mode_bit(mode)) for prefix, mode in prefixes.iteritems())
+        add_user = channel.add_user
+        for match in nick_token.finditer(nick_list):
+            nick = match.group()
+            bits = 0
+            # multi-prefix servers send all of them, ie. @+nick
+            while nick and nick[0] in prefix_bits:
+                bits |= prefix_bits[nick[0]]
+                nick = nick[1:]
+            if nick:
+                add_user(nick, bits)
+
+    def rename(self, before, after):
+        """A nick changed, in every channel"""
+        key = fold(before)
+        for channel in self.values():
+            if key in channel.members:
+                channel.change_nick(before, after)
+
+    def quit(self, nick):
+        """A nick left every channel"""
+        key = fold(nick)
+        for channel in self.values():
+            if key in channel.members:
+                channel.remove_user(nick)
+
+    def stats(self):
+        return {'channels': len(self), 'nicks': len(self.pool),
+                'members': sum(len(channel) for channel in self.values())}
+
+
+def deep_size(obj, seen=None):
+    """Bytes taken by obj and everything it refers to, each counted once"""
+    import sys
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+if __name__ == '__main__':
+    # Test the store against the events of a channel
+    channels = ChannelStore(untracked=["#Huge"])
+    chan = channels.new("#fidibot")
+    channels.names("#FidiBot", u"fidibot @Op +Voiced @+Both Some[One]", {'@': 'o', '+': 'v'})
+    assert sorted(chan.users()) == ["Both", "Op", "Some[One]", "Voiced", "fidibot"]
+    assert chan.is_oper("op") and chan.is_voiced("VOICED") and chan.is_oper("both") and chan.is_voiced("both")
+    assert chan.has_user("some{one}") and not chan.is_oper("fidibot")
+    chan.set_mode("o", "Voiced")
+    chan.clear_mode("v", "Voiced")
+    chan.set_mode("t")
+    chan.set_mode("l", "50")
+    assert chan.is_oper("voiced") and not chan.is_voiced("voiced") and chan.has_topic_lock()
+    assert chan.limit() == "50"
+    other = channels.new("#other")
+    other.add_user("Op")
+    channels.rename("Op", "NewOp")
+    assert chan.is_oper("newop") and not chan.has_user("op") and other.has_user("NEWOP")
+    assert "newop" in channels.pool and "op" not in channels.pool
+    assert "NewOp" in chan.opers()
+    channels.quit("newop")
+    assert not chan.has_user("newop") and not other.has_user("newop")
+    assert "newop" not in channels.pool
+    del channels["#other"]
+    assert channels.stats() == {'channels': 1, 'nicks': 4, 'members': 4}
+    huge = channels.new("#huge")
+    channels.names("#huge", u"a b c", {'@': 'o'})
+    huge.add_user("d")
+    huge.set_mode("m")
+    assert not huge.users() and huge.is_moderated()
+    channels.clear()
+    assert not channels and not channels.pool
+    # byte strings, like channel names from the command line
+    assert fold("Some[One]^") == u"some{one}~" and fold("#Big[1]") == u"#big{1}"
+    assert ChannelStore(untracked=["#big[1]"]).untracked == set([u"#big{1}"])
+
+    # Benchmark memory and NAMES parsing against irc.bot.Channel
+    import time
+    from irc.bot import Channel
+    prefixes = {'@': 'o', '+': 'v'}
+    for members in (10000, 100000):
+        nicks = [u"%sUser%d" % ("@" if i % 50 == 0 else "+" if i % 20 == 0 else "", i)
+                 for i in xrange(members)]
+        lines = [u" ".join(nicks[i:i + 30]) for i in xrange(0, members, 30)]
+
+        start = time.time()
+        old = Channel()
+        for line in lines:
+            # what SingleServerIRCBot._on_namreply does
+            for nick in line.split():
+                if nick[0] in prefixes:
+                    old.set_mode(prefixes[nick[0]], nick[1:])
+                    nick = nick[1:]
+                old.add_user(nick)
+        old_time = time.time() - start
+
+        start = time.time()
+        store = ChannelStore()
+        store.new("#big")
+        for line in lines:
+            store.names("#big", line, prefixes)
+        new_time = time.time() - start
+        assert len(store["#big"]) == len(old.users()) == members
+        assert len(store["#big"].opers()) == len(old.opers())
+
+        old_size = deep_size(old)
+        new_size = deep_size(store)
+        print "%6d members: irc.bot.Channel %5.1fMB %4.0fms, ChannelStore %5.1fMB %4.0fms" % (
+            members, old_size / 1e6, old_time * 1000, new_size / 1e6, new_time * 1000)
+    print "Everything in order"
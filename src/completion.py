@@ -0,0 +1,175 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Command name completion and suggestions
+
+The command names of the help index built by introspect.build_index
+are compiled to a prefix trie, for completing unique prefixes,
+and a deletion index, for suggesting commands within a small edit distance.
+"""
+
+
+def edit_distance(a, b):
+    """Levenshtein distance between two strings"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+class PrefixTrie(object):
+    """A trie of words, each node knowing all the words below it"""
+
+    def __init__(self, words=()):
+        self.root = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        node = self.root
+        node.setdefault('', set()).add(word)
+        for char in word:
+            node = node.setdefault(char, {})
+            node.setdefault('', set()).add(word)
+
+    def complete(self, prefix):
+        """Return the sorted list of words starting with prefix"""
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        return sorted(node.get('', ()))
+
+
+def deletes(word, distance):
+    """Return the strings made by deleting up to distance characters from word"""
+    found = set([word])
+    frontier = found
+    for _ in xrange(distance):
+        frontier = set(w[:i] + w[i + 1:] for w in frontier for i in xrange(len(w)))
+        found |= frontier
+    return found
+
+
+class DeleteIndex(object):
+    """
+    SymSpell style index for finding words within an edit distance.
+
+    Every word is stored under all the strings made by deleting up to
+    max_distance characters from it. Two words within that distance
+    always share one of those, so a search only has to look up the
+    deletes of the query and check the few candidates it finds.
+    """
+
+    def __init__(self, words=(), max_distance=2):
+        self.max_distance = max_distance
+        self.index = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        for key in deletes(word, self.max_distance):
+            self.index.setdefault(key, set()).add(word)
+
+    def search(self, word, max_distance):
+        """Return (distance, word) tuples within max_distance, closest first"""
+        max_distance = min(max_distance, self.max_distance)
+        candidates = set()
+        for key in deletes(word, max_distance):
+            candidates.update(self.index.get(key, ()))
+        found = []
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) > max_distance:
+                continue
+            d = edit_distance(word, candidate)
+            if d <= max_distance:
+                found.append((d, candidate))
+        found.sort()
+        return found
+
+
+class CommandIndex(object):
+    """
+    Completion and suggestions for the public and private commands
+    of a help index.
+    """
+
+    def __init__(self, help_index):
+        self.tries = {}
+        self.fuzzy = {}
+        for kind in ('public', 'private'):
+            names = help_index[kind].keys()
+            self.tries[kind] = PrefixTrie(names)
+            self.fuzzy[kind] = DeleteIndex(names)
+
+    def complete(self, kind, prefix):
+        """Return all commands of kind starting with prefix"""
+        return self.tries[kind].complete(prefix)
+
+    def complete_unique(self, kind, prefix):
+        """Return the command prefix uniquely completes to, or None"""
+        matches = self.complete(kind, prefix)
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def suggest(self, kind, word, limit=3):
+        """
+        Suggest commands for an unknown word.
+
+        Commands starting with the word come first, then those within
+        an edit distance of two, or one for words up to three letters.
+        """
+        suggestions = self.complete(kind, word)[:limit]
+        if len(suggestions) < limit:
+            max_distance = 1 if len(word) <= 3 else 2
+            for d, name in self.fuzzy[kind].search(word, max_distance):
+                if name not in suggestions:
+                    suggestions.append(name)
+                if len(suggestions) >= limit:
+                    break
+        return suggestions
+
+
+if __name__ == '__main__':
+    # Test completion and suggestions
+    assert edit_distance("help", "hepl") == 2
+    assert edit_distance("", "abc") == 3
+    assert edit_distance("kitten", "sitting") == 3
+    index = {'public': dict.fromkeys(['help', 'hello', 'list', 'roll', 'title']),
+             'private': dict.fromkeys(['help', 'say'])}
+    commands = CommandIndex(index)
+    assert commands.complete_unique('public', 'he') is None
+    assert commands.complete_unique('public', 'hel') is None
+    assert commands.complete_unique('public', 'helm') is None
+    assert commands.complete_unique('public', 'ro') == 'roll'
+    assert commands.complete_unique('private', 'he') == 'help'
+    assert commands.suggest('public', 'he') == ['hello', 'help']
+    assert commands.suggest('public', 'lsit') == ['list'], commands.suggest('public', 'lsit')
+    assert commands.suggest('public', 'titel') == ['title']
+    assert commands.suggest('public', 'xyzzy') == []
+
+    # Time lookups on a few hundred commands
+    import random, string, timeit
+    random.seed(42)
+    names = set()
+    while len(names) < 500:
+        names.add("".join(random.choice(string.ascii_lowercase)
+                          for _ in xrange(random.randint(3, 10))))
+    commands = CommandIndex({'public': dict.fromkeys(names), 'private': {}})
+    words = random.sample(sorted(names), 100)
+    typos = [w[:-1] + random.choice(string.ascii_lowercase) for w in words]
+    t = min(timeit.repeat(lambda: [commands.suggest('public', w) for w in typos],
+                          number=1, repeat=3))
+    print "suggest: %.3fms per lookup on %d commands" % (t * 10, len(names))
+    t = min(timeit.repeat(lambda: [commands.complete_unique('public', w[:3]) for w in words],
+                          number=1, repeat=3))
+    print "complete: %.3fms per lookup on %d commands" % (t * 10, len(names))
+    print "Everything in order"
@@ -0,0 +1,220 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Keeping the bot connected
+
+ConnectionManager notices a dead link and gets the bot back on a
+server quickly:
+- any line from the server counts as a sign of life. When the server
+  goes quiet for ping_interval seconds it is pinged, and if nothing
+  comes back in ping_timeout seconds the link is dropped
+- reconnecting is retried with exponential backoff and full jitter,
+  going through the list of servers in turn, so a server that's down
+  is failed over from and a netsplit doesn't have every bot on the
+  network knocking at the same second
+- with TimeoutFactory, a connection attempt gives up after a few
+  seconds instead of waiting on the system's TCP timeout
+
+The bot rejoins its channels on welcome, see FidiBot.on_welcome.
+"""
+
+import time
+import random
+import socket
+
+import irc.connection
+import irc.client
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def parse_server(spec, default_port=6667):
+    """Split a `host[:port]` into host and port"""
+    host, _, port = spec.rpartition(':')
+    if not host or not port.isdigit():
+        # no port, or an IPv6 address without brackets
+        return spec.strip('[]'), default_port
+    return host.strip('[]'), int(port)
+
+
+class Backoff(object):
+    """
+    Delays between retries, doubling up to cap each time, picked at
+    random below that, ie. exponential backoff with full jitter.
+    """
+
+    def __init__(self, base=1, cap=5*60, random=random.random):
+        self.base = base
+        self.cap = cap
+        self.random = random
+        self.attempts = 0
+
+    def next(self):
+        ceiling = min(self.cap, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return ceiling * self.random()
+
+    def reset(self):
+        self.attempts = 0
+
+
+class TimeoutFactory(irc.connection.Factory):
+    """Connection factory giving up on connecting after timeout seconds"""
+
+    def __init__(self, timeout, **kwargs):
+        super(TimeoutFactory, self).__init__(**kwargs)
+        self.timeout = timeout
+
+    def connect(self, server_address):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.bind(self.bind_address)
+        sock.connect(server_address)
+        sock.settimeout(None)
+        return self.wrapper(sock)
+    __call__ = connect
+
+
+class ConnectionManager(object):
+    """
+    Watches the connection of a SingleServerIRCBot and reconnects it.
+
+    The bot should call disconnected() instead of the default reconnect
+    handling, and connect() to make its first connection.
+    """
+
+    def __init__(self, bot, ping_interval=30, ping_timeout=15,
+                 backoff=None, clock=time.time):
+        self.bot = bot
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.backoff = backoff or Backoff()
+        self.clock = clock
+        self.last_heard = clock()
+        self.ping_sent = None
+        self.down_since = None
+        self.reconnects = self.dead_links = 0
+        self.last_recovery = None
+        self.scheduled = False
+        c = bot.connection
+        c.add_global_handler("all_raw_messages", self.heard, -30)
+        c.add_global_handler("welcome", self.welcomed, -30)
+        c.execute_every(min(5, ping_interval), self.check)
+
+    def heard(self, c, e):
+        self.last_heard = self.clock()
+        self.ping_sent = None
+
+    def check(self):
+        """Ping a quiet server, drop the link if it doesn't answer"""
+        c = self.bot.connection
+        if not c.is_connected():
+            return
+        now = self.clock()
+        if self.ping_sent is not None:
+            if now - self.ping_sent > self.ping_timeout:
+                log.warning("No answer from %s for %d seconds, reconnecting",
+                            c.get_server_name(), now - self.last_heard)
+                self.dead_links += 1
+                c.disconnect("Ping timeout")
+        elif now - self.last_heard > self.ping_interval:
+            try:
+                c.ping("%.3f" % now)
+                self.ping_sent = now
+            except irc.client.ServerNotConnectedError:
+                pass
+
+    def connect(self):
+        """Connect to the current server, retrying later if we can't"""
+        self.bot._connect()
+        if self.bot.connection.is_connected():
+            self.last_heard = self.clock()
+            self.ping_sent = None
+        else:
+            self.retry()
+
+    def disconnected(self):
+        """The link is down, go get a new one"""
+        if self.down_since is None:
+            self.down_since = self.clock()
+        self.retry()
+
+    def retry(self):
+        if self.scheduled:
+            return
+        delay = self.backoff.next()
+        log.info("Reconnecting in %.1f seconds", delay)
+        self.scheduled = True
+        self.bot.connection.execute_delayed(delay, self._reconnect)
+
+    def _reconnect(self):
+        self.scheduled = False
+        if self.bot.connection.is_connected():
+            return
+        if self.backoff.attempts > 1:
+            # the last server didn't work out, try the next one
+            self.bot.server_list.append(self.bot.server_list.pop(0))
+        server = self.bot.server_list[0]
+        log.info("Connecting to %s:%d", server.host, server.port)
+        self.reconnects += 1
+        self.connect()
+
+    def welcomed(self, c, e):
+        self.backoff.reset()
+        if self.down_since is not None:
+            self.last_recovery = self.clock() - self.down_since
+            log.info("Back on %s after %.1f seconds", c.get_server_name(), self.last_recovery)
+            self.down_since = None
+
+    def stats(self):
+        c = self.bot.connection
+        return {'connected': c.is_connected(), 'server': c.get_server_name(),
+                'reconnects': self.reconnects, 'dead_links': self.dead_links,
+                'last_recovery': self.last_recovery,
+                'quiet': self.clock() - self.last_heard}
+
+
+if __name__ == '__main__':
+    # Test the backoff and the dead link detection
+    logging.basicConfig()
+    assert parse_server("irc.example.net") == ("irc.example.net", 6667)
+    assert parse_server("irc.example.net:6697") == ("irc.example.net", 6697)
+    assert parse_server("[::1]:7000") == ("::1", 7000)
+    backoff = Backoff(1, 60, random=lambda: 1.0)
+    assert [backoff.next() for i in xrange(8)] == [1, 2, 4, 8, 16, 32, 60, 60]
+    backoff.reset()
+    assert backoff.next() == 1
+    jittered = Backoff(1, 60)
+    delays = [jittered.next() for i in xrange(10)]
+    assert all(0 <= d <= 60 for d in delays) and len(set(delays)) == 10
+
+    from irc.bot import SingleServerIRCBot
+
+    class Bot(SingleServerIRCBot):
+        def _on_disconnect(self, c, e):
+            self.manager.disconnected()
+
+    now = [1000.0]
+    bot = Bot([("127.0.0.1", 1)], "fidibot", "fidibot")
+    bot.manager = ConnectionManager(bot, 30, 10, Backoff(1, 60, random=lambda: 0.5),
+                                    clock=lambda: now[0])
+    server, client = socket.socketpair()
+    c = bot.connection
+    c.socket, c.connected, c.buffer, c.handlers = client, True, c.buffer_class(), {}
+    c.server = c.real_server_name = "hub.example"
+    bot.manager.check()
+    assert bot.manager.ping_sent is None
+    now[0] += 31
+    bot.manager.check()
+    assert server.recv(100) == "PING 1031.000\r\n"
+    now[0] += 5
+    server.sendall(":hub.example PONG hub.example :1031.000\r\n")
+    c.process_data()
+    assert bot.manager.ping_sent is None and bot.manager.last_heard == 1036
+    now[0] += 31
+    bot.manager.check()
+    now[0] += 11
+    bot.manager.check()
+    assert not c.is_connected() and bot.manager.dead_links == 1
+    assert bot.manager.scheduled and bot.manager.down_since == 1078
+    print "Everything in order"
@@ -0,0 +1,566 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Dice expressions
+
+Expressions are made of dice, numbers, + - * / and parentheses.
+Division rounds down.
+
+    d20, 3d6, d%        dice, d% is a d100
+    4d6kh3, 4d6k3       keep the highest 3
+    2d20kl1             keep the lowest
+    d6!                 exploding, dice rolling their max roll again
+    d20adv, d20dis      advantage and disadvantage, ie. 2d20kh1
+    adv, dis            the same as d20adv and d20dis
+
+parse() turns an expression into a tree of nodes, caching the recent
+ones. A node can:
+
+    roll()      roll once, showing every die
+    sample(n)   roll n times at once, for statistics
+    dist()      work out the exact distribution of the outcomes, by
+                convolving the distributions of its dice
+
+With NumPy installed, sampling is vectorized and convolutions of long
+distributions go through an FFT. Without it everything still works
+in pure Python, with tighter limits.
+Inputs are bounded so nothing can keep the bot busy for long.
+"""
+
+import re
+import math
+import random
+import threading
+from datetime import datetime
+from tools import LRUCache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# limits
+max_length = 100
+max_groups = 10
+max_dice = 10000
+max_sides = 10000
+max_explode = 20
+# most dice rolled in total by a sample(), and most outcomes of a dist()
+max_sampled = 2000000 if numpy else 200000
+max_outcomes = 200000 if numpy else 20000
+# most work when working out which dice are kept, counted as the
+# kept dice sorted for every state and face of every die
+max_keep_work = 2000000
+# most dice shown by roll()
+max_shown = 20
+
+tokens = re.compile(r"""\s*(?:
+    (?P<dice>(?P<count>\d*)d(?P<sides>\d+|%)(?P<mods>(?:k[hl]?\d+|!|adv|dis)*))|
+    (?P<number>\d+)|
+    (?P<word>adv|dis)|
+    (?P<op>[-+*/()]))""", re.VERBOSE | re.IGNORECASE)
+modifiers = re.compile(r"k([hl]?)(\d+)|!|adv|dis", re.IGNORECASE)
+
+rng = random.Random()
+numpy_rng = numpy.random.RandomState() if numpy else None
+
+
+class DiceError(ValueError):
+    """The expression is invalid, or too big to work with"""
+
+
+class Dist(object):
+    """
+    Distribution of integer outcomes.
+
+    probs[i] is the probability of the outcome offset + i.
+    It's a list, or an array with NumPy.
+    """
+
+    def __init__(self, offset, probs):
+        if len(probs) > max_outcomes:
+            raise DiceError("Too many possible outcomes to work out")
+        self.offset = offset
+        self.probs = probs
+
+    @classmethod
+    def from_dict(cls, outcomes):
+        low, high = min(outcomes), max(outcomes)
+        if high - low >= max_outcomes:
+            raise DiceError("Too many possible outcomes to work out")
+        probs = [0.0] * (high - low + 1)
+        for value, p in outcomes.iteritems():
+            probs[value - low] += p
+        return cls(low, array(probs))
+
+    def items(self):
+        """(outcome, probability) of every possible outcome"""
+        return [(self.offset + i, float(p)) for i, p in enumerate(self.probs) if p > 0]
+
+    def __add__(self, other):
+        return Dist(self.offset + other.offset, convolve(self.probs, other.probs))
+
+    def __neg__(self):
+        return Dist(-(self.offset + len(self.probs) - 1), self.probs[::-1])
+
+    def __sub__(self, other):
+        return self + -other
+
+    def combine(self, other, function):
+        """Distribution of function(a, b), for a and b from the two"""
+        a, b = self.items(), other.items()
+        if len(a) * len(b) > max_keep_work:
+            raise DiceError("Too many possible outcomes to work out")
+        outcomes = {}
+        for x, p in a:
+            for y, q in b:
+                value = function(x, y)
+                outcomes[value] = outcomes.get(value, 0.0) + p * q
+        return Dist.from_dict(outcomes)
+
+    def mean(self):
+        return sum(value * p for value, p in self.items())
+
+    def sd(self):
+        mean = self.mean()
+        return math.sqrt(sum((value - mean) ** 2 * p for value, p in self.items()))
+
+    def mode(self):
+        return max(self.items(), key=lambda item: item[1])
+
+    def range(self):
+        items = self.items()
+        return items[0][0], items[-1][0]
+
+    def chance(self, compare, target):
+        """Probability that an outcome compares to target, ie. '>='"""
+        test = comparisons[compare]
+        return min(1.0, sum(p for value, p in self.items() if test(value, target)))
+
+
+comparisons = {
+    '>=': lambda a, b: a >= b, '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b, '<': lambda a, b: a < b,
+    '=': lambda a, b: a == b, '==': lambda a, b: a == b,
+}
+
+
+def array(values):
+    return numpy.array(values, dtype=float) if numpy else list(values)
+
+
+def convolve(a, b):
+    """Convolve two lists of probabilities"""
+    if numpy:
+        if min(len(a), len(b)) > 64:
+            # FFT is faster for long ones, rounding errors aside
+            size = len(a) + len(b) - 1
+            fft_size = 1 << (size - 1).bit_length()
+            result = numpy.fft.irfft(numpy.fft.rfft(a, fft_size) *
+                                     numpy.fft.rfft(b, fft_size), fft_size)[:size]
+            return numpy.clip(result, 0, None)
+        return numpy.convolve(a, b)
+    if len(a) * len(b) > max_keep_work * 5:
+        raise DiceError("Too many possible outcomes to work out")
+    result = [0.0] * (len(a) + len(b) - 1)
+    for i, p in enumerate(a):
+        if p:
+            for j, q in enumerate(b):
+                result[i + j] += p * q
+    return result
+
+
+def power(dist, n):
+    """Distribution of the sum of n independent outcomes of dist"""
+    result = Dist(0, array([1.0]))
+    while n:
+        if n & 1:
+            result = result + dist
+        n >>= 1
+        if n:
+            dist = dist + dist
+    return result
+
+
+class Number(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def roll(self):
+        return self.value, str(self.value)
+
+    def sample(self, n):
+        return numpy.full(n, self.value, dtype=numpy.int64)
+
+    def dist(self):
+        return Dist(self.value, array([1.0]))
+
+    def dice(self):
+        return 0
+
+
+class Negative(object):
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def roll(self):
+        value, text = self.operand.roll()
+        return -value, "-" + text
+
+    def sample(self, n):
+        return -self.operand.sample(n)
+
+    def dist(self):
+        return -self.operand.dist()
+
+    def dice(self):
+        return self.operand.dice()
+
+
+class Parentheses(object):
+
+    def __init__(self, node):
+        self.node = node
+        self.sample, self.dist, self.dice = node.sample, node.dist, node.dice
+
+    def roll(self):
+        value, text = self.node.roll()
+        return value, "(%s)" % text
+
+
+class Operation(object):
+
+    def __init__(self, op, left, right):
+        self.op, self.left, self.right = op, left, right
+
+    def apply(self, a, b):
+        if self.op == '+':
+            return a + b
+        if self.op == '-':
+            return a - b
+        if self.op == '*':
+            return a * b
+        if numpy and isinstance(b, numpy.ndarray):
+            if not b.all():
+                raise DiceError("Division by zero")
+        elif not b:
+            raise DiceError("Division by zero")
+        return a // b
+
+    def roll(self):
+        a, a_text = self.left.roll()
+        b, b_text = self.right.roll()
+        return self.apply(a, b), "%s %s %s" % (a_text, self.op, b_text)
+
+    def sample(self, n):
+        return self.apply(self.left.sample(n), self.right.sample(n))
+
+    def dist(self):
+        a, b = self.left.dist(), self.right.dist()
+        if self.op == '+':
+            return a + b
+        if self.op == '-':
+            return a - b
+        if self.op == '/' and b.chance('=', 0):
+            raise DiceError("That could be a division by zero")
+        return a.combine(b, self.apply)
+
+    def dice(self):
+        return self.left.dice() + self.right.dice()
+
+
+class Dice(object):
+    """
+    count dice with sides each, keeping the highest or lowest
+    of them if keep is ('h', k) or ('l', k)
+    """
+
+    def __init__(self, count, sides, keep=None, explode=False):
+        self.count, self.sides = count, sides
+        if keep and keep[1] >= count:
+            keep = None
+        self.keep, self.explode = keep, explode
+
+    def roll_die(self):
+        value = roll = rng.randint(1, self.sides)
+        rerolls = 0
+        while self.explode and roll == self.sides and rerolls < max_explode:
+            roll = rng.randint(1, self.sides)
+            value += roll
+            rerolls += 1
+        return value
+
+    def roll(self):
+        values = [self.roll_die() for _ in xrange(self.count)]
+        kept = range(self.count)
+        if self.keep:
+            order = sorted(kept, key=values.__getitem__, reverse=self.keep[0] == 'h')
+            kept = set(order[:self.keep[1]])
+        total = sum(values[i] for i in kept)
+        if self.count > max_shown:
+            return total, "%dd%d" % (self.count, self.sides)
+        shown = [str(v) if i in kept else "(%d)" % v for i, v in enumerate(values)]
+        return total, "[%s]" % ", ".join(shown)
+
+    def sample(self, n):
+        shape = (n, self.count)
+        values = last = numpy_rng.randint(1, self.sides + 1, shape)
+        if self.explode:
+            for _ in xrange(max_explode):
+                exploding = last == self.sides
+                if not exploding.any():
+                    break
+                last = numpy.where(exploding, numpy_rng.randint(1, self.sides + 1, shape), 0)
+                values = values + last
+        if self.keep:
+            values = numpy.sort(values, axis=1)
+            k = self.keep[1]
+            values = values[:, -k:] if self.keep[0] == 'h' else values[:, :k]
+        return values.sum(axis=1)
+
+    def die_dist(self):
+        """Distribution of a single die"""
+        if not self.explode:
+            return Dist(1, array([1.0 / self.sides] * self.sides))
+        # explode only as deep as it makes a difference
+        depth = min(max_explode, int(12 / math.log10(self.sides)) + 1)
+        p = 1.0 / self.sides
+        probs = []
+        for rerolls in xrange(depth + 1):
+            last = [p ** (rerolls + 1)] * self.sides
+            if rerolls < depth:
+                last[-1] = 0.0
+            probs.extend(last)
+        return Dist(1, array(probs))
+
+    def dist(self):
+        die = self.die_dist()
+        if not self.keep:
+            return power(die, self.count)
+        # follow the kept dice, sorted, one die at a time
+        faces = die.items()
+        highest, k = self.keep[0] == 'h', self.keep[1]
+        states = {(): 1.0}
+        work = 0
+        for rolled in xrange(self.count):
+            work += len(states) * len(faces) * min(rolled + 1, k)
+            if work > max_keep_work:
+                raise DiceError("Too many dice to keep track of, try stats instead")
+            new_states = {}
+            for kept, p in states.iteritems():
+                for value, q in faces:
+                    new = sorted(kept + (value,), reverse=highest)[:k]
+                    new = tuple(new)
+                    new_states[new] = new_states.get(new, 0.0) + p * q
+            states = new_states
+        outcomes = {}
+        for kept, p in states.iteritems():
+            outcomes[sum(kept)] = outcomes.get(sum(kept), 0.0) + p
+        return Dist.from_dict(outcomes)
+
+    def dice(self):
+        return self.count
+
+
+class Parser(object):
+    """Recursive descent parser of expressions"""
+
+    def __init__(self, text):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = tokens.match(text, pos)
+            if not m or m.end() == pos:
+                raise DiceError("I don't understand %s" % text[pos:].strip())
+            self.tokens.append(m)
+            pos = m.end()
+        self.pos = 0
+        self.groups = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise DiceError("The expression ends too soon")
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.expression()
+        if self.peek() is not None:
+            raise DiceError("I don't understand %s" % self.peek().group().strip())
+        return node
+
+    def expression(self):
+        node = self.term()
+        while self.peek() is not None and self.peek().group('op') in ('+', '-'):
+            node = Operation(self.next().group('op'), node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.peek() is not None and self.peek().group('op') in ('*', '/'):
+            node = Operation(self.next().group('op'), node, self.factor())
+        return node
+
+    def factor(self):
+        token = self.next()
+        if token.group('op') == '-':
+            return Negative(self.factor())
+        if token.group('op') == '+':
+            return self.factor()
+        if token.group('op') == '(':
+            node = self.expression()
+            if self.next().group('op') != ')':
+                raise DiceError("Missing a )")
+            return Parentheses(node)
+        if token.group('number'):
+            return Number(int(token.group('number')))
+        if token.group('word'):
+            return self.dice(1, 20, token.group('word'))
+        if token.group('dice'):
+            sides = token.group('sides')
+            sides = 100 if sides == '%' else int(sides)
+            count = int(token.group('count') or 1)
+            return self.dice(count, sides, token.group('mods'))
+        raise DiceError("I didn't expect %s" % token.group().strip())
+
+    def dice(self, count, sides, mods):
+        self.groups += 1
+        if self.groups > max_groups:
+            raise DiceError("Too many dice groups, %d at most" % max_groups)
+        if not 1 <= count <= max_dice:
+            raise DiceError("You can roll 1 to %d dice" % max_dice)
+        if not 1 <= sides <= max_sides:
+            raise DiceError("Dice can have 1 to %d sides" % max_sides)
+        keep, explode = None, False
+        for m in modifiers.finditer(mods or ''):
+            mod = m.group().lower()
+            if mod in ('adv', 'dis'):
+                if count != 1:
+                    raise DiceError("Advantage is for a single die")
+                count, keep = 2, ('h' if mod == 'adv' else 'l', 1)
+            elif mod == '!':
+                if sides < 2:
+                    raise DiceError("A d1 would explode forever")
+                explode = True
+            else:
+                keep = (m.group(1).lower() or 'h', int(m.group(2)))
+                if not keep[1]:
+                    raise DiceError("You have to keep at least one die")
+        return Dice(count, sides, keep, explode)
+
+
+cache = LRUCache(1000, 1000 * 400)
+dist_cache = LRUCache(100, 8 * 1024 * 1024)
+cache_ttl = 24 * 60 * 60
+# rolls run on the reactor, stats and odds in the workers
+cache_lock = threading.Lock()
+
+
+def parse(text):
+    """Return the tree of an expression, raising DiceError if it's invalid"""
+    if len(text) > max_length:
+        raise DiceError("Keep it under %d characters" % max_length)
+    key = "".join(text.lower().split())
+    with cache_lock:
+        node = cache.get(key)
+    if node is None:
+        node = Parser(key).parse()
+        with cache_lock:
+            cache.set(key, node, cache_ttl, len(key) + 400)
+    return node
+
+
+def roll(text):
+    """Roll an expression once, returning the total and the dice rolled"""
+    return parse(text).roll()
+
+
+def sample(text, n):
+    """Roll an expression n times, returning a list or array of totals"""
+    node = parse(text)
+    if node.dice() * n > max_sampled:
+        raise DiceError("That's too many dice to roll, %d at most" % max_sampled)
+    if numpy:
+        return node.sample(n)
+    return [node.roll()[0] for _ in xrange(n)]
+
+
+def stats(text, n):
+    """Return mean, standard deviation, min and max of n rolls"""
+    totals = sample(text, n)
+    if numpy:
+        return totals.mean(), totals.std(), totals.min(), totals.max()
+    mean = float(sum(totals)) / n
+    sd = math.sqrt(sum((t - mean) ** 2 for t in totals) / n)
+    return mean, sd, min(totals), max(totals)
+
+
+def dist(text):
+    """Return the exact Dist of the outcomes of an expression"""
+    key = "".join(text.lower().split())
+    with cache_lock:
+        result = dist_cache.get(key)
+    if result is None:
+        result = parse(text).dist()
+        with cache_lock:
+            dist_cache.set(key, result, cache_ttl, len(result.probs) * 8 + 100)
+    return result
+
+
+if __name__ == '__main__':
+    # Test parsing, rolling and distributions
+    def close(a, b):
+        return abs(a - b) < 1e-9
+    for expression in ("d20", "3d6+2", "4d6kh3", "2d20kl1", "adv", "d20dis + 5",
+                       "(2d4+1)*3", "d%", "d6!", "10000d6", "-d4+10/3"):
+        total, text = roll(expression)
+        print "%-12s %s = %d" % (expression, text if len(text) < 60 else text[:57] + "...", total)
+    for bad in ("d0", "2d6kh0", "3d20adv", "d6+", "(d6", "d6 x", "d1!",
+                "10001d6", "1d6" + "+d6" * 10):
+        try:
+            parse(bad)
+            assert False, bad
+        except DiceError:
+            pass
+    assert parse("3D6 + 2") is parse("3d6+2") # cached
+
+    d = dist("2d6")
+    assert close(d.mean(), 7) and d.range() == (2, 12)
+    assert d.mode()[0] == 7 and close(d.mode()[1], 1.0 / 6)
+    assert close(d.chance('>=', 7), 21.0 / 36)
+    assert close(dist("adv").chance('=', 20), 39.0 / 400)
+    assert close(dist("4d6kh3").mean(), 12.244598765432098)
+    assert close(dist("d6-d6").mean(), 0) and dist("d6-d6").range() == (-5, 5)
+    assert close(dist("d6!").mean(), 4.2), dist("d6!").mean()
+    assert close(dist("(d4+1)*2").mean(), 7) and close(dist("d6/2").mean(), 1.5)
+    assert close(sum(p for v, p in dist("100d100" if numpy else "20d20").items()), 1)
+    for bad in ("d6/0", "1000d2kh999", "10000d2kh9999"):
+        start = datetime.now()
+        try:
+            dist(bad)
+            assert False, bad
+        except DiceError:
+            pass
+        # refused before doing much work
+        assert (datetime.now() - start).total_seconds() < 2, bad
+    assert close(dist("20d6kh3").mean(), dist("20d6kh3").mean())
+
+    mean, sd, low, high = stats("4d6kh3", 10000)
+    assert abs(mean - 12.24) < 0.2 and low >= 3 and high <= 18
+    start = datetime.now()
+    mean, sd, low, high = stats("10000d6", 20 if not numpy else 200)
+    assert abs(mean - 35000) < 400
+    print "10000d6 x %d in %s" % (20 if not numpy else 200, datetime.now() - start)
+    start = datetime.now()
+    expression = "1000d6" if numpy else "100d6"
+    dist(expression)
+    print "%s distribution in %s" % (expression, datetime.now() - start)
+    print "Everything in order"
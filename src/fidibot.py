@@ -3,17 +3,34 @@
 # Author: Nick Raptis <airscorp@gmail.com>
 
 import argparse
+import copy
+import time
+from collections import deque
 import irc.bot
 from irc.strings import lower
 from logsetup import setup_logging, setup_client_logging
 from introspect import build_index
+from completion import CommandIndex
 from modules import activate_modules
 from alternatives import alternatives, read_files, _
-import tools, auth
+from workers import WorkerPool
+from httpclient import HttpClient
+from resolver import Resolver
+from connmanager import ConnectionManager, TimeoutFactory, parse_server
+from lag import LagMeter
+from channelstate import ChannelStore
+from history import History
+from storage import Store
+from timers import TimerWheel
+import metrics
+import tools, auth, handoff
 
 import logging
 log = logging.getLogger(__name__)
 
+# where the modules keep what they want to remember
+storage_db = "data/modules.db"
+
 # set unicode decoding to replace errors
 from irc.buffer import DecodingLineBuffer as DLB
 DLB.errors = 'replace'
@@ -23,7 +40,11 @@ class FidiBot(irc.bot.SingleServerIRCBot):
 
     def __init__(self, channel, nickname, server, port=6667,
                  realname=None, password='', callsign='fidi',
-                 admin_pass=None, google_api_key=None):
+                 admin_pass=None, short_url=None, short_port=None,
+                 autocomplete=False, failover=(), ping_interval=30,
+                 ping_timeout=15, connect_timeout=10, lag_threshold=5,
+                 lag_defer=False, untracked=(), history_lines=500,
+                 history_bytes=64*1024):
         if channel[0] != "#":
             # make sure channel starts with a #
             channel = "#" + channel
@@ -34,10 +55,26 @@ class FidiBot(irc.bot.SingleServerIRCBot):
         self.callsign = callsign
         self.identified = False
         self.alternatives = alternatives
-        self.google_api_key = google_api_key
+        self.short_url = short_url
+        self.short_port = short_port
         # setup admins
         #self.admin_pass = admin_pass
         self.admins = auth.AdminAuth(admin_pass)
+        # start worker threads for blocking work
+        self.workers = WorkerPool(call_soon=self._call_soon)
+        # shared HTTP client for the modules, with cached and checked DNS
+        self.resolver = Resolver()
+        self.http = HttpClient(resolver=self.resolver)
+        metrics.register("dns", self.resolver.stats)
+        # recent lines of every channel, for the modules
+        self.history = History(history_lines, history_bytes)
+        metrics.register("history", self.history.stats)
+        # shared by the modules, each in its own namespace
+        self.storage = Store(storage_db, "modules")
+        metrics.register("storage", self.storage.stats)
+        # timers for the modules, run on the reactor thread
+        self.timers = TimerWheel()
+        metrics.register("timers", self.timers.stats)
         # load modules
         active_modules, active_alternatives = activate_modules()
         self.modules = [m(self) for m in active_modules]
@@ -47,32 +84,102 @@ class FidiBot(irc.bot.SingleServerIRCBot):
         self.alternatives.clean_duplicates()
         # build help index
         self.help_index = build_index(self.modules)
-        super(FidiBot, self).__init__([(server, port)], nickname, realname)
+        self.command_index = CommandIndex(self.help_index)
+        self.autocomplete = autocomplete
+        # servers to fail over to, after the first one
+        servers = [(server, port)] + list(failover)
+        super(FidiBot, self).__init__(servers, nickname, realname,
+                                      connect_factory=TimeoutFactory(connect_timeout))
+        # compact membership, without it at all for the untracked channels
+        self.channels = ChannelStore(untracked)
+        metrics.register("channels", self.channels.stats)
         # set up rate limiting after 5 seconds to one message per second
         self.connection.execute_delayed(5,
             self.connection.set_rate_limit, (1,))
         # set up throttles
         self.join_throttle = tools.Throttle(10 * 60)
+        # services accounts of nicks, from WHOIS replies
+        self.accounts = tools.LRUCache(5000, 5000 * 100)
         self.duh_throttle = tools.Throttle(60)
-        # set up keepalive
-        self._pings_pending = 0
+        # channels to join again after reconnecting
+        self._rejoin = set()
         self._last_kicker = ''
-        self.connection.execute_every(300, self._keepalive)
+        # ping when quiet and reconnect quickly
+        self.manager = ConnectionManager(self, ping_interval, ping_timeout)
+        metrics.register("connection", self.manager.stats)
+        # measure lag, and hold back optional output while lagged
+        self.lag = LagMeter(lag_threshold)
+        self.lag_defer = lag_defer
+        self.deferred = deque(maxlen=50)
+        self.shed = 0
+        self.connection.execute_every(60, self._measure_lag)
+        self.connection.execute_every(self.timers.tick, self.timers.run_due)
+        metrics.register("lag", self._lag_stats)
 
-    def _keepalive(self):
-        if self._pings_pending >= 2:
-            log.warning("Connection timed out. Will try to reconnect!")
-            self.disconnect()
-            self._pings_pending = 0
-            return
+    def _call_soon(self, function, *args):
+        """Run function on the reactor thread. Safe to call from any thread"""
+        self.connection.execute_delayed(0, function, args)
+
+    def start(self):
+        self.manager.connect()
+        self.reactor.process_forever()
+
+    def _on_disconnect(self, c, e):
+        # replaces the reconnect after a minute of SingleServerIRCBot
+        self._rejoin.update(self.channels.keys())
+        self.channels.clear()
+        self.lag.reset()
+        self.deferred.clear()
+        self.manager.disconnected()
+
+    # channel state handlers of SingleServerIRCBot, for the ChannelStore
+
+    def _on_join(self, c, e):
+        if e.source.nick == c.get_nickname():
+            self.channels.new(e.target)
+        if e.target in self.channels:
+            self.channels[e.target].add_user(e.source.nick)
+
+    def _on_namreply(self, c, e):
+        ch_type, channel, nick_list = e.arguments
+        self.channels.names(channel, nick_list, c.features.prefix)
+
+    def _on_nick(self, c, e):
+        self.channels.rename(e.source.nick, e.target)
+
+    def _on_quit(self, c, e):
+        self.channels.quit(e.source.nick)
+
+    def _measure_lag(self):
         try:
-            self.connection.ping('keep-alive')
-            self._pings_pending += 1
+            self.lag.ping(self.connection)
         except irc.client.ServerNotConnectedError:
             pass
 
     def on_pong(self, c, e):
-        self._pings_pending = 0
+        self.lag.pong(e.arguments[0] if e.arguments else e.target)
+        while self.deferred and not self.lag.lagged():
+            function, args = self.deferred.popleft()
+            function(*args)
+
+    def when_not_lagged(self, function, *args):
+        """
+        Call function(*args) for output we can do without, ie. welcomes.
+
+        While lagged, it is dropped, or deferred until the lag is gone
+        with lag_defer.
+        """
+        if not self.lag.lagged():
+            function(*args)
+        elif self.lag_defer:
+            self.deferred.append((function, args))
+        else:
+            self.shed += 1
+
+    def _lag_stats(self):
+        stats = self.lag.stats()
+        stats.update(shed=self.shed, deferred=len(self.deferred))
+        return stats
 
     def on_kick(self, c, e):
         nick = e.arguments[0]
@@ -93,8 +200,14 @@ class FidiBot(irc.bot.SingleServerIRCBot):
             self.connection.nick(new_nick)
             self.nickname = new_nick
 
+    def on_whoisaccount(self, c, e):
+        nick, account = e.arguments[:2]
+        self.accounts.set(lower(nick), account, 60 * 60, len(nick) + len(account) + 50)
+
     def on_welcome(self, c, e):
-        c.join(self.channel)
+        channels = set([lower(self.channel)]) | set(lower(ch) for ch in self._rejoin)
+        self._rejoin = set()
+        c.join(",".join(sorted(channels)))
         
     def on_privnotice(self, c, e):
         if e.source.nick == "NickServ":
@@ -111,50 +224,120 @@ class FidiBot(irc.bot.SingleServerIRCBot):
             elif "Invalid password" in e.arguments[0]:
                 log.error("Invalid password! Check your settings!")
 
+    def _dispatch(self, c, e):
+        """Defer a message to the active modules until one processes it"""
+        for m in self.modules:
+            if e.type == "pubmsg":
+                handled = m.on_pubmsg(c, e)
+            else:
+                handled = m.on_privmsg(c, e)
+            if handled:
+                return True
+        return False
+
+    def _observe(self, hook, c, e):
+        """Let every module know about an event, unless its user is ignored"""
+        if e.source.nick != c.get_nickname() and any(m.is_ignored(c, e) for m in self.modules):
+            return
+        for m in self.modules:
+            getattr(m, hook)(c, e)
+
+    def _complete(self, c, e, kind, before, command, after):
+        """
+        Dispatch again with a unique command prefix completed,
+        if autocomplete is on.
+        """
+        if not self.autocomplete:
+            return False
+        full = self.command_index.complete_unique(kind, command)
+        if not full or full == command:
+            return False
+        log.debug("Completed command %s to %s", command, full)
+        # a copy, the event itself goes on to the history as it was said
+        completed = copy.copy(e)
+        completed.arguments = [" ".join(before + [full] + after)] + e.arguments[1:]
+        return self._dispatch(c, completed)
+
     def on_privmsg(self, c, e):
         # first try to defer the message to the active modules
-        for m in self.modules:
-            if m.on_privmsg(c, e):
-                return
+        if self._dispatch(c, e):
+            return
         
         # default behaviour if no module processes the message.
-        command = lower(e.arguments[0].split(" ", 1)[0])
+        tokens = e.arguments[0].split(" ", 1)
+        command = lower(tokens[0])
         if self.callsign in command:
             # maybe someone is calling us by name?
             c.privmsg(e.source.nick, _("You don't have to call me by name in private"))
             return
+        if self._complete(c, e, 'private', [], command, tokens[1:]):
+            return
         log.debug("Failed to understand private message '%s' from user %s",
                   e.arguments[0], e.source.nick)
-        c.privmsg(e.source.nick, _("I don't understand %s") % command)
+        suggestions = self.command_index.suggest('private', command)
+        if suggestions:
+            c.privmsg(e.source.nick, _("I don't understand %s. Did you mean %s?")
+                      % (command, " or ".join(suggestions)))
+        else:
+            c.privmsg(e.source.nick, _("I don't understand %s") % command)
 
     def on_pubmsg(self, c, e):
+        self._observe("on_message", c, e)
+        try:
+            self._answer_public(c, e)
+        finally:
+            # modules see the history up to the line before this one
+            self.history.record(e.target, time.time(), e.source.nick, e.arguments[0])
+
+    def _answer_public(self, c, e):
         # first try to defer the message to the active modules
-        for m in self.modules:
-            if m.on_pubmsg(c, e):
-                return
+        if self._dispatch(c, e):
+            return
         
         # don't do default behaviour for the GitHub bots
         if 'github' in e.source.nick.lower():
             return
         # default behaviour if no module processes the message.
         if self.callsign in lower(e.arguments[0]):
+            tokens = e.arguments[0].split(" ", 2)
+            command = lower(tokens[1]) if len(tokens) > 1 else ''
+            called = self.callsign in lower(tokens[0]) and command
+            if called and self._complete(c, e, 'public', tokens[:1], command, tokens[2:]):
+                return
             log.debug("Failed to understand public message '%s' from user %s",
                       e.arguments[0], e.source.nick)
-            if not self.duh_throttle.is_throttled(e.source.nick):
+            if self.duh_throttle.is_throttled(e.source.nick):
+                return
+            suggestions = self.command_index.suggest('public', command) if called else []
+            if suggestions:
+                c.privmsg(e.target, _("Did you mean %s?") % " or ".join(suggestions))
+            else:
                 c.privmsg(e.target, _("Someone talking about me? Duh!"))
 
     def on_join(self, c, e):
+        self._observe("on_join", c, e)
         nick = e.source.nick
         # ignore the commings and goings of the GitHub bots
         if 'github' in nick.lower():
             return
         if not nick == c.get_nickname():
             if not self.join_throttle.is_throttled(nick):
-                c.privmsg(e.target, _("Welcome %s") % nick)
+                self.when_not_lagged(c.privmsg, e.target, _("Welcome %s") % nick)
         elif self._last_kicker:
             c.privmsg(e.target, _("Why did you kick me, %s?") % self._last_kicker)
             self._last_kicker = ''
 
+    def on_part(self, c, e):
+        self._observe("on_part", c, e)
+        if e.source.nick == c.get_nickname():
+            self.history.discard(e.target)
+
+    def on_quit(self, c, e):
+        self._observe("on_quit", c, e)
+
+    def on_nick(self, c, e):
+        self._observe("on_nick", c, e)
+
     def on_bannedfromchan(self, c, e):
         c.execute_delayed(10, c.join, (e.arguments[0],))
 
@@ -162,6 +345,14 @@ class FidiBot(irc.bot.SingleServerIRCBot):
         return "fidibot https://github.com/nickraptis/fidibot"
 
 
+def positive_int(value):
+    """An argparse type for whole numbers of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not at least 1" % value)
+    return number
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('server', help="Server to connect to")
@@ -172,19 +363,34 @@ def get_args():
     parser.add_argument('-p', '--port', default=6667, type=int, help="Connect to port")
     parser.add_argument('-c', '--callsign', default="fidi", help="Callsign for commands")
     parser.add_argument('-s', '--admin-pass', help="Password for admin commands")
-    parser.add_argument('-g', '--google-api-key', help="Google API key for url shortener")
+    parser.add_argument('-u', '--short-url', help="Base URL for short links, ie. http://example.com/")
+    parser.add_argument('--short-port', type=int, help="Serve short links on this local port, for the base URL to point to")
+    parser.add_argument('-a', '--autocomplete', action='store_true',
+                        help="Run commands given by a unique prefix")
+    parser.add_argument('-f', '--failover', action='append', default=[], metavar='HOST[:PORT]',
+                        help="Server to fail over to, can be given many times")
+    parser.add_argument('--ping-interval', default=30, type=int,
+                        help="Ping the server after this many quiet seconds")
+    parser.add_argument('--ping-timeout', default=15, type=int,
+                        help="Reconnect if a ping isn't answered in this many seconds")
+    parser.add_argument('--lag-threshold', default=5, type=float,
+                        help="Hold back welcomes and URL titles while lagged over this many seconds, 0 never")
+    parser.add_argument('--lag-defer', action='store_true',
+                        help="Send held back output when the lag is gone, instead of dropping it")
+    parser.add_argument('--untracked', action='append', default=[], metavar='CHANNEL',
+                        help="Don't keep track of who is in this channel, can be given many times")
+    parser.add_argument('--history-lines', default=500, type=positive_int,
+                        help="Lines of every channel to keep for the modules to look back at")
+    parser.add_argument('--history-bytes', default=64*1024, type=positive_int,
+                        help="Most bytes of text to keep of every channel")
+    parser.add_argument('--resume', metavar='PATH',
+                        help="Take over the connection of the bot listening on this Unix socket")
     return parser.parse_args()
 
 
-def main():
-    args = get_args()
-    setup_logging()
-    bot = FidiBot(args.channel, args.nickname, args.server, args.port,
-                  realname= args.realname, password=args.password, callsign=args.callsign,
-                  admin_pass = args.admin_pass, google_api_key = args.google_api_key)
-    setup_client_logging(bot)
+def run(bot, start):
     try:
-        bot.start()
+        start()
     except KeyboardInterrupt:
         bot.disconnect(_("Someone closed me!"))
     except Exception as e:
@@ -192,5 +398,38 @@ def main():
         bot.disconnect(_("I crashed damn it!"))
         raise SystemExit(4)
 
+
+def main():
+    args = get_args()
+    setup_logging()
+    bot = FidiBot(args.channel, args.nickname, args.server, args.port,
+                  realname= args.realname, password=args.password, callsign=args.callsign,
+                  admin_pass = args.admin_pass, short_url = args.short_url,
+                  short_port = args.short_port,
+                  autocomplete = args.autocomplete,
+                  failover = [parse_server(f, args.port) for f in args.failover],
+                  ping_interval = args.ping_interval, ping_timeout = args.ping_timeout,
+                  lag_threshold = args.lag_threshold, lag_defer = args.lag_defer,
+                  untracked = args.untracked, history_lines = args.history_lines,
+                  history_bytes = args.history_bytes)
+    setup_client_logging(bot)
+    if not args.resume:
+        run(bot, bot.start)
+        return
+    state, conn = handoff.receive(args.resume)
+    handoff.restore_state(bot, state)
+    handoff.confirm(conn)
+    log.info("Took over the connection as %s", bot.nickname)
+    # we aren't run.sh's child anymore, tell it how we exit
+    status = 0
+    try:
+        run(bot, bot.reactor.process_forever)
+    except SystemExit as e:
+        status = e.code or 0
+        raise
+    finally:
+        handoff.write_status(status)
+
+
 if __name__ == "__main__":
     main()
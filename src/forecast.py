@@ -0,0 +1,314 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Current weather conditions from pluggable providers
+
+A Provider looks up the conditions of a location, blocking while it
+does. WeatherCache keeps the conditions of every location asked for,
+answering from memory and refreshing them in a worker thread before
+they expire, so asking for the weather never waits on the network
+after the first time. Concurrent requests for a location that is being
+looked up wait for that lookup instead of starting another one.
+
+Providers:
+    WeatherComProvider: weather.com's XML feed, through the bot's HttpClient
+    FixtureProvider:    canned conditions, for testing
+"""
+
+import re
+import requests
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+from xml.etree import cElementTree as ElementTree
+
+import logging
+log = logging.getLogger(__name__)
+
+Conditions = namedtuple('Conditions', 'location temperature text updated')
+
+
+class WeatherError(Exception):
+    """The provider couldn't give the conditions of a location"""
+
+
+class Provider(object):
+    """
+    Base class of weather providers
+
+    http: the HttpClient to make requests with
+    """
+
+    name = None
+
+    def __init__(self, http=None):
+        self.http = http
+
+    def current(self, location):
+        """
+        Return the current Conditions of location, or raise WeatherError.
+
+        This blocks, so it runs in a worker thread.
+        """
+        raise NotImplementedError
+
+
+class WeatherComProvider(Provider):
+    """
+    Conditions from weather.com
+
+    Locations are weather.com ids, ie. GRXX1283:1, or names to search for.
+    """
+
+    name = "weather.com"
+    location_id = re.compile(r"^[a-z]{4}\d{4}(:\d+)?$", re.IGNORECASE)
+    search_url = "http://wxdata.weather.com/wxdata/search/search"
+    weather_url = "http://wxdata.weather.com/wxdata/weather/local/%s"
+    # the feeds are a few KB
+    max_bytes = 256 * 1024
+
+    def _fetch(self, url, params):
+        try:
+            resp = self.http.get(url, params=params, max_bytes=self.max_bytes)
+            resp.raise_for_status()
+            return ElementTree.fromstring(resp.content)
+        except (requests.RequestException, SyntaxError) as e:
+            # SyntaxError is what a bad XML document raises
+            log.warning("Fetching %s failed: %s", url, e)
+            raise WeatherError("Couldn't reach weather.com")
+
+    def current(self, location):
+        if self.location_id.match(location):
+            location_id, name = location.upper(), location
+        else:
+            found = self._fetch(self.search_url, {'where': location}).findall('loc')
+            if not found:
+                raise WeatherError("Couldn't find %s" % location)
+            loc = min(found, key=lambda loc: loc.get('id'))
+            location_id, name = loc.get('id'), loc.text
+        weather = self._fetch(self.weather_url % location_id,
+                              {'unit': 'm', 'dayf': '0', 'cc': '*'})
+        error = weather.findtext('err')
+        if error:
+            raise WeatherError(error)
+        current = weather.find('cc')
+        if current is None:
+            raise WeatherError("No conditions for %s" % location)
+        name = weather.findtext('loc/dnam') or name
+        return Conditions(name, current.findtext('tmp'), current.findtext('t'),
+                          current.findtext('lsup'))
+
+
+class FixtureProvider(Provider):
+    """Conditions from a dict of lowercase location names to Conditions"""
+
+    name = "fixture"
+    fixtures = {
+        'nafpaktos': Conditions("Nafpaktos", "24", "Sunny", "10/19/26 9:50 AM EEST"),
+        'grxx1283:1': Conditions("Nafpaktos", "24", "Sunny", "10/19/26 9:50 AM EEST"),
+        'athens': Conditions("Athens", "27", "Partly Cloudy", "10/19/26 9:50 AM EEST"),
+    }
+
+    def __init__(self, fixtures=None, http=None):
+        super(FixtureProvider, self).__init__(http)
+        if fixtures is not None:
+            self.fixtures = fixtures
+        self.calls = 0
+
+    def current(self, location):
+        self.calls += 1
+        try:
+            return self.fixtures[location.lower()]
+        except KeyError:
+            raise WeatherError("Couldn't find %s" % location)
+
+
+class WeatherCache(object):
+    """
+    Conditions of many locations, kept fresh in the background.
+
+    submit:        how lookups get to a worker thread,
+                   ie. BaseModule.defer
+    ttl:           seconds the conditions of a location are good for
+    refresh_ahead: refresh that many seconds before they expire
+    failure_ttl:   seconds to remember a failed lookup
+    idle:          stop refreshing locations not asked for in that long
+    max_locations: most locations to remember
+
+    Everything but the lookups runs on the reactor thread, so there
+    is no locking.
+    """
+
+    def __init__(self, provider, submit, ttl=30*60, refresh_ahead=5*60, failure_ttl=60,
+                 idle=6*60*60, max_locations=100, datetime_class=datetime):
+        self.provider = provider
+        self.submit = submit
+        self.ttl = timedelta(seconds=ttl)
+        self.refresh_ahead = timedelta(seconds=refresh_ahead)
+        self.failure_ttl = timedelta(seconds=failure_ttl)
+        self.idle = timedelta(seconds=idle)
+        self.max_locations = max_locations
+        self.dtclass = datetime_class
+        # location -> [conditions, error, expires, last asked for]
+        self.entries = OrderedDict()
+        # location -> callbacks waiting for its lookup
+        self.pending = {}
+        self.hits = self.misses = self.refreshes = 0
+
+    def lookup(self, location, callback):
+        """
+        Call callback(conditions, error) with the conditions of location.
+
+        It is called right away if we have them, or else once they're
+        looked up.
+        """
+        key = location.strip().lower()
+        now = self.dtclass.now()
+        entry = self.entries.pop(key, None)
+        if entry and now < entry[2]:
+            entry[3] = now
+            self.entries[key] = entry
+            self.hits += 1
+            if entry[0] and now >= entry[2] - self.refresh_ahead:
+                self.refresh(key)
+            callback(entry[0], entry[1])
+            return
+        self.misses += 1
+        self.refresh(key)
+        self.pending[key].append(callback)
+
+    def refresh(self, key):
+        """Look up a location in the background, unless it's being looked up"""
+        if key in self.pending:
+            return
+        self.pending[key] = []
+        self.refreshes += 1
+        self.submit(self._current, (key,),
+                    lambda conditions, error: self._looked_up(key, conditions, error))
+
+    def _current(self, key):
+        # expected errors are returned, not to have them logged as crashes
+        try:
+            return self.provider.current(key)
+        except WeatherError as e:
+            return e
+
+    def refresh_due(self):
+        """Refresh the locations about to expire. Run this every minute or so"""
+        now = self.dtclass.now()
+        for key, (conditions, error, expires, asked) in self.entries.items():
+            if now >= expires and (error or now - asked > self.idle):
+                del self.entries[key]
+            elif conditions and now >= expires - self.refresh_ahead and now - asked <= self.idle:
+                self.refresh(key)
+
+    def _looked_up(self, key, conditions, error):
+        now = self.dtclass.now()
+        callbacks = self.pending.pop(key, [])
+        old = self.entries.pop(key, None)
+        if isinstance(conditions, WeatherError):
+            conditions, error = None, conditions
+        if error:
+            log.warning("Looking up the weather of %s failed: %s", key, error)
+            if not isinstance(error, WeatherError):
+                error = WeatherError("Failed to get the weather")
+        if error and old and old[0] and now < old[2]:
+            # a refresh failed, keep what we have and try again later
+            entry = old
+        else:
+            ttl = self.failure_ttl if error else self.ttl
+            entry = [conditions, error, now + ttl, old[3] if old else now]
+        self.entries[key] = entry
+        while len(self.entries) > self.max_locations:
+            self.entries.popitem(last=False)
+        for callback in callbacks:
+            callback(entry[0], entry[1])
+
+    def stats(self):
+        return {'locations': len(self.entries), 'pending': len(self.pending),
+                'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes}
+
+
+if __name__ == '__main__':
+    # Test the cache with the fixture provider and a fake worker queue
+    logging.basicConfig()
+    from tools import DummyDatetime
+    jobs = []
+    def submit(function, args, callback):
+        jobs.append((function, args, callback))
+    def run_jobs():
+        while jobs:
+            function, args, callback = jobs.pop(0)
+            try:
+                callback(function(*args), None)
+            except Exception as e:
+                callback(None, e)
+    answers = []
+    def answer(conditions, error):
+        answers.append((conditions and conditions.location, error and str(error)))
+
+    dt = DummyDatetime() # t=0
+    provider = FixtureProvider()
+    cache = WeatherCache(provider, submit, ttl=600, refresh_ahead=60,
+                         failure_ttl=30, idle=3600, datetime_class=dt)
+    cache.lookup("Nafpaktos", answer)
+    cache.lookup("nafpaktos ", answer)
+    assert len(jobs) == 1 and not answers # deduplicated
+    run_jobs()
+    assert answers == [("Nafpaktos", None)] * 2 and provider.calls == 1
+    dt.advance(300) # t=300
+    cache.lookup("nafpaktos", answer)
+    assert len(answers) == 3 and not jobs # from memory
+    dt.advance(250) # t=550, within refresh_ahead
+    cache.lookup("nafpaktos", answer)
+    assert len(answers) == 4 and len(jobs) == 1 # answered, and refreshing
+    run_jobs()
+    assert provider.calls == 2
+    dt.advance(550) # t=1100
+    cache.refresh_due()
+    assert len(jobs) == 1 # refreshed before expiring
+    run_jobs()
+    cache.lookup("atlantis", answer)
+    run_jobs()
+    assert answers[-1] == (None, "Couldn't find atlantis")
+    cache.lookup("atlantis", answer)
+    assert not jobs and answers[-1][1] # failure remembered
+    dt.advance(10000) # idle
+    cache.refresh_due()
+    assert not jobs and not cache.entries
+
+    # Test weather.com's feeds are read through the client it's given
+    class FakeResponse(object):
+        def __init__(self, content):
+            self.content = content
+        def raise_for_status(self):
+            pass
+    class FakeHttp(object):
+        feeds = {
+            WeatherComProvider.search_url:
+                '<search ver="3.0"><loc id="GRXX0004" type="1">Athens, Greece</loc>'
+                '<loc id="USGA0028" type="1">Athens, GA</loc></search>',
+            WeatherComProvider.weather_url % "GRXX0004":
+                '<weather ver="2.0"><loc id="GRXX0004"><dnam>Athens, Greece</dnam></loc>'
+                '<cc><lsup>10/19/26 9:50 AM EEST</lsup><tmp>27</tmp><t>Sunny</t></cc></weather>',
+            WeatherComProvider.weather_url % "XXXX0000":
+                '<error><err type="0">Invalid location provided</err></error>',
+        }
+        def __init__(self):
+            self.urls = []
+        def get(self, url, params=None, max_bytes=None):
+            self.urls.append(url)
+            if url not in self.feeds:
+                raise requests.ConnectionError("no route to %s" % url)
+            return FakeResponse(self.feeds[url])
+    http = FakeHttp()
+    provider = WeatherComProvider(http=http)
+    assert provider.current("athens") == Conditions("Athens, Greece", "27", "Sunny",
+                                                    "10/19/26 9:50 AM EEST")
+    assert http.urls == [WeatherComProvider.search_url, WeatherComProvider.weather_url % "GRXX0004"]
+    for location, message in (("XXXX0000", "Invalid location provided"),
+                              ("GRXX9999", "Couldn't reach weather.com")):
+        try:
+            provider.current(location)
+            assert False
+        except WeatherError as e:
+            assert str(e) == message, e
+    print "Everything in order"
@@ -0,0 +1,323 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Handing a live IRC connection over to a new bot process
+
+For an update without leaving the channel, the running bot starts the
+updated code with `--resume path`, keeping the server socket open in
+it. The new process connects to the old one over the Unix socket at
+path and gets the state of the session as a line of JSON: the socket's
+file descriptor, the nick, channels and their users, the identified
+flag, the throttles and the admin pool. It adopts the socket as its
+connection without registering again, and confirms. Only then does the
+old process exit, without sending QUIT, so the session carries on.
+
+Python 2 has no sendmsg() to pass descriptors with SCM_RIGHTS, so the
+socket is inherited instead: every other descriptor is closed in the
+new process. TLS connections can't be handed over this way.
+
+The new process isn't run.sh's child, so it leaves its pid in pid_file
+and its exit status in status_file for run.sh to wait on.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import select
+import subprocess
+from datetime import datetime
+
+import irc.connection
+
+import logging
+log = logging.getLogger(__name__)
+
+handoff_path = "data/handoff.sock"
+pid_file = "data/fidibot.pid"
+status_file = "data/fidibot.status"
+# seconds the new process has to start up and confirm
+handoff_timeout = 60
+# exit status telling run.sh another process took over
+handed_off = 43
+
+# user modes of channel members, by the Channel method listing them
+member_modes = (('opers', 'o'), ('voiced', 'v'), ('owners', 'q'), ('halfops', 'h'))
+
+
+class HandoffError(Exception):
+    """The connection couldn't be handed over"""
+
+
+def _timestamp(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+
+def dump_state(bot):
+    """Return the state of the bot's session, ready for JSON"""
+    c = bot.connection
+    channels = {}
+    for name, channel in bot.channels.items():
+        channels[name] = dict((method, getattr(channel, method)()) for method, mode in member_modes)
+        channels[name]['users'] = channel.users()
+        channels[name]['modes'] = channel.modes
+    return {
+        'fd': c.socket.fileno(),
+        'family': c.socket.family,
+        'buffer': c.buffer.buffer.decode('latin-1'),
+        'server': c.server,
+        'port': c.port,
+        'server_name': c.real_server_name,
+        'nickname': c.real_nickname,
+        'username': c.username,
+        'ircname': c.ircname,
+        'features': vars(c.features),
+        'nickname_wanted': bot._nickname_wanted,
+        'identified': bot.identified,
+        'last_kicker': bot._last_kicker,
+        'channels': channels,
+        'throttles': {
+            'join': dict((k, _timestamp(v)) for k, v in bot.join_throttle.dict.iteritems()),
+            'duh': dict((k, _timestamp(v)) for k, v in bot.duh_throttle.dict.iteritems()),
+        },
+        'admins': list(bot.admins.auth_pool),
+    }
+
+
+def restore_state(bot, state):
+    """Carry on the session described by state, on the inherited socket"""
+    c = bot.connection
+    sock = socket.fromfd(state['fd'], state['family'], socket.SOCK_STREAM)
+    # fromfd made a copy
+    os.close(state['fd'])
+    c.buffer = c.buffer_class()
+    c.buffer.buffer = state['buffer'].encode('latin-1')
+    c.handlers = {}
+    c.server = state['server']
+    c.port = state['port']
+    c.server_address = (c.server, c.port)
+    c.real_server_name = state['server_name']
+    c.real_nickname = c.nickname = state['nickname']
+    c.username = state['username']
+    c.ircname = state['ircname']
+    c.password = None
+    c.connect_factory = irc.connection.Factory()
+    for name, value in state['features'].iteritems():
+        c.features.set(name, value)
+    c.socket = sock
+    c.connected = True
+    bot.reactor._on_connect(sock)
+
+    bot.nickname = state['nickname']
+    bot._nickname_wanted = state['nickname_wanted']
+    bot.identified = state['identified']
+    bot._last_kicker = state['last_kicker']
+    bot.channels.clear()
+    for name, saved in state['channels'].iteritems():
+        channel = bot.channels.new(name)
+        for nick in saved['users']:
+            channel.add_user(nick)
+        for method, mode in member_modes:
+            for nick in saved[method]:
+                channel.set_mode(mode, nick)
+        channel.modes = saved['modes']
+    for throttle, saved in ((bot.join_throttle, state['throttles']['join']),
+                            (bot.duh_throttle, state['throttles']['duh'])):
+        throttle.dict.update((k, datetime.fromtimestamp(v)) for k, v in saved.iteritems())
+    for username in state['admins']:
+        bot.admins.add(username)
+
+
+def resume_args(argv, path):
+    """The command line arguments of the new process"""
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--resume':
+            skip = True
+        elif not arg.startswith('--resume='):
+            args.append(arg)
+    return args + ['--resume', path]
+
+
+def hand_off(bot, argv=None, path=handoff_path, timeout=handoff_timeout):
+    """
+    Start a new bot process and hand the connection over to it.
+
+    This blocks the reactor thread on purpose, so nothing more is read
+    from the socket until the new process has it. Returns once the new
+    process confirms, the caller should exit without disconnecting.
+    Raises HandoffError if it doesn't, having stopped it.
+    """
+    if not bot.connection.is_connected():
+        raise HandoffError("Not connected")
+    if hasattr(bot.connection.socket, 'cipher'):
+        raise HandoffError("Can't hand over a TLS connection")
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    child = None
+    try:
+        listener.bind(path)
+        listener.listen(1)
+        fd = bot.connection.socket.fileno()
+        def keep_socket():
+            # close everything but the IRC socket and stdio in the new process
+            os.closerange(3, fd)
+            os.closerange(fd + 1, subprocess.MAXFD)
+        command = [sys.executable] + resume_args(argv or sys.argv, path)
+        log.info("Handing the connection over to %s", " ".join(command))
+        child = subprocess.Popen(command, preexec_fn=keep_socket)
+        deadline = time.time() + timeout
+        conn = _accept(listener, child, deadline)
+        try:
+            conn.sendall(json.dumps(dump_state(bot)) + "\n")
+            reply = _read_line(conn, child, deadline)
+        finally:
+            conn.close()
+        if reply != "ok":
+            raise HandoffError("The new process answered %r" % reply)
+        log.info("Process %d took over the connection", child.pid)
+    except (HandoffError, socket.error, OSError) as e:
+        if child and child.poll() is None:
+            child.kill()
+            child.wait()
+        if isinstance(e, HandoffError):
+            raise
+        raise HandoffError(str(e))
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _wait(sock, child, deadline):
+    """Wait for sock to be readable, while the new process is alive"""
+    while True:
+        if child.poll() is not None:
+            raise HandoffError("The new process exited with %s" % child.returncode)
+        left = deadline - time.time()
+        if left <= 0:
+            raise HandoffError("The new process didn't answer in time")
+        if select.select([sock], [], [], min(left, 0.5))[0]:
+            return
+
+
+def _accept(listener, child, deadline):
+    _wait(listener, child, deadline)
+    conn, _ = listener.accept()
+    return conn
+
+
+def _read_line(conn, child, deadline):
+    data = ""
+    while not data.endswith("\n"):
+        _wait(conn, child, deadline)
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.strip()
+
+
+def receive(path, timeout=handoff_timeout):
+    """
+    In the new process, get the state from the old one.
+
+    Returns the state and the Unix socket to confirm() on.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    conn.connect(path)
+    data = ""
+    while not data.endswith("\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise HandoffError("The old process hung up")
+        data += chunk
+    return json.loads(data), conn
+
+
+def confirm(conn):
+    """Tell the old process we have the connection, so it can exit"""
+    write_pid()
+    conn.sendall("ok\n")
+    conn.close()
+
+
+def write_pid():
+    with open(pid_file, "w") as f:
+        f.write("%d\n" % os.getpid())
+
+
+def write_status(status):
+    with open(status_file, "w") as f:
+        f.write("%d\n" % status)
+
+
+if __name__ == '__main__':
+    # Test the arguments and a round trip of the state
+    assert resume_args(["fidibot.py", "irc.example", "chan", "nick"], "h.sock") == \
+        ["fidibot.py", "irc.example", "chan", "nick", "--resume", "h.sock"]
+    assert resume_args(["fidibot.py", "--resume", "old", "-a", "--resume=x"], "h.sock") == \
+        ["fidibot.py", "-a", "--resume", "h.sock"]
+
+    import irc.client
+    from channelstate import ChannelStore
+    from auth import AdminAuth
+    from tools import Throttle
+
+    class Bot(object):
+        def __init__(self):
+            self.reactor = irc.client.Reactor()
+            self.connection = self.reactor.server()
+            self.channels = ChannelStore()
+            self.nickname = self._nickname_wanted = "fidibot"
+            self.identified = False
+            self._last_kicker = ''
+            self.join_throttle = Throttle(600)
+            self.duh_throttle = Throttle(60)
+            self.admins = AdminAuth("pass")
+
+    # a connected socket pair stands in for the server
+    server, client = socket.socketpair()
+    old = Bot()
+    c = old.connection
+    c.socket, c.connected, c.buffer = client, True, c.buffer_class()
+    c.server, c.port, c.real_server_name = "irc.example", 6667, "hub.example"
+    c.real_nickname, c.username, c.ircname = "fidibot_", "fidibot", "A small python bot"
+    c.buffer.feed(":hub.example PING :par")
+    c.features.load(["fidibot_", "PREFIX=(ohv)@%+", "CHANTYPES=#", "are supported"])
+    old.identified, old._last_kicker = True, "mean"
+    old.channels.new("#fidibot")
+    old.channels["#fidibot"].add_user("fidibot_")
+    old.channels["#fidibot"].add_user("someone")
+    old.channels["#fidibot"].set_mode("o", "someone")
+    old.channels["#fidibot"].set_mode("t")
+    old.join_throttle.is_throttled("someone")
+    old.admins.add("someone")
+
+    state = json.loads(json.dumps(dump_state(old)))
+    # pretend we're the new process and own a copy of the descriptor
+    state['fd'] = os.dup(state['fd'])
+    new = Bot()
+    restore_state(new, state)
+    n = new.connection
+    assert n.is_connected() and n.get_nickname() == "fidibot_" and n.get_server_name() == "hub.example"
+    assert n.buffer.buffer == ":hub.example PING :par"
+    assert n.features.prefix == {'@': 'o', '%': 'h', '+': 'v'}
+    assert new.identified and new._last_kicker == "mean" and new.nickname == "fidibot_"
+    assert new.channels["#FidiBot"].has_user("someone") and new.channels["#fidibot"].is_oper("someone")
+    assert new.channels["#fidibot"].has_mode("t")
+    assert new.join_throttle.is_throttled("someone") and not new.duh_throttle.is_throttled("someone")
+    assert new.admins.is_admin("someone")
+    # the old side can go, the session goes on
+    client.close()
+    n.send_raw("PONG :par")
+    assert server.recv(100) == "PONG :par\r\n"
+    server.sendall(":someone!u@h PRIVMSG #fidibot :hi\r\n")
+    assert select.select([n.socket], [], [], 1)[0]
+    assert n.socket.recv(100).startswith(":someone")
+    print "Everything in order"
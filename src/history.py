@@ -0,0 +1,181 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Recent lines of the channels, for modules to look back at
+
+Every channel keeps its last lines in a ChannelHistory, a ring buffer
+bounded by a number of lines and by the bytes of their text, whichever
+fills first. The buffer is preallocated columns instead of a tuple
+per line:
+- the times, as doubles in an array
+- the nicks, and their lowercased forms to find their lines by, as
+  byte strings when they're ASCII, interned so the lines of a nick
+  share them
+- the texts, encoded in UTF-8, which for mostly ASCII chat is a
+  third of the memory of unicode strings
+
+Lines are read newest first, optionally only those of one nick, and
+are given back as (time, nick, text) with the text decoded again.
+"""
+
+import sys
+from array import array
+from irc.dict import IRCDict
+from channelstate import fold
+
+# default bounds of every channel
+default_lines = 500
+default_bytes = 64 * 1024
+
+
+def _compact_nick(nick):
+    try:
+        return intern(str(nick))
+    except UnicodeError:
+        return nick
+
+
+class ChannelHistory(object):
+    """The last max_lines lines of a channel, of at most max_bytes of text"""
+
+    def __init__(self, max_lines=default_lines, max_bytes=default_bytes):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.times = array('d', [0]) * max_lines
+        self.nicks = [None] * max_lines
+        self.keys = [None] * max_lines
+        self.texts = [None] * max_lines
+        # slot of the oldest line, and how many lines there are
+        self.start = self.count = 0
+        # bytes of text, and what the text strings take in memory
+        self.bytes = self.text_memory = 0
+
+    def append(self, when, nick, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if len(text) > self.max_bytes:
+            return
+        while self.count and (self.count == self.max_lines or
+                              self.bytes + len(text) > self.max_bytes):
+            self._drop_oldest()
+        slot = (self.start + self.count) % self.max_lines
+        self.times[slot] = when
+        self.nicks[slot] = _compact_nick(nick)
+        self.keys[slot] = _compact_nick(fold(nick))
+        self.texts[slot] = text
+        self.count += 1
+        self.bytes += len(text)
+        self.text_memory += sys.getsizeof(text)
+
+    def _drop_oldest(self):
+        text = self.texts[self.start]
+        self.bytes -= len(text)
+        self.text_memory -= sys.getsizeof(text)
+        self.nicks[self.start] = self.keys[self.start] = self.texts[self.start] = None
+        self.start = (self.start + 1) % self.max_lines
+        self.count -= 1
+
+    def lines(self, nick=None):
+        """Yield (time, nick, text) for every line, newest first, or only those of nick"""
+        key = fold(nick) if nick else None
+        times, nicks, keys, texts = self.times, self.nicks, self.keys, self.texts
+        size = self.max_lines
+        for i in xrange(self.start + self.count - 1, self.start - 1, -1):
+            slot = i % size
+            if key is None or keys[slot] == key:
+                yield times[slot], nicks[slot], texts[slot].decode('utf-8', 'replace')
+
+    __iter__ = lines
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.nicks[:] = self.keys[:] = self.texts[:] = [None] * self.max_lines
+        self.start = self.count = self.bytes = self.text_memory = 0
+
+    def memory(self):
+        """Bytes taken by the buffer and the texts in it"""
+        return (sys.getsizeof(self) + sys.getsizeof(self.times) + sys.getsizeof(self.nicks) +
+                sys.getsizeof(self.keys) + sys.getsizeof(self.texts) + self.text_memory)
+
+
+class History(IRCDict):
+    """The ChannelHistory of every channel, by name"""
+
+    def __init__(self, max_lines=default_lines, max_bytes=default_bytes):
+        super(History, self).__init__()
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+    def record(self, channel, when, nick, text):
+        if channel not in self:
+            self[channel] = ChannelHistory(self.max_lines, self.max_bytes)
+        self[channel].append(when, nick, text)
+
+    def lines(self, channel, nick=None):
+        """Lines of channel newest first, like ChannelHistory.lines()"""
+        if channel not in self:
+            return iter(())
+        return self[channel].lines(nick)
+
+    def discard(self, channel):
+        if channel in self:
+            del self[channel]
+
+    def stats(self):
+        return {'channels': len(self),
+                'lines': sum(len(h) for h in self.values()),
+                'bytes': sum(h.bytes for h in self.values()),
+                'memory': sum(h.memory() for h in self.values())}
+
+
+if __name__ == '__main__':
+    # Test the bounds of the ring and reading it back
+    h = ChannelHistory(max_lines=3, max_bytes=20)
+    for i, nick in enumerate(["Alice", "bob", "alice", "Carol"]):
+        h.append(float(i), nick, u"line %d" % i)
+    assert len(h) == 3 and [t for t, n, x in h] == [3.0, 2.0, 1.0]
+    assert list(h.lines("ALICE")) == [(2.0, "alice", u"line 2")]
+    # the byte cap drops more of the oldest lines
+    h.append(4.0, "dave", u"twelve bytes")
+    assert [n for t, n, x in h] == ["dave", "Carol"] and h.bytes == 18
+    h.append(5.0, "eve", u"x" * 21) # too big to keep at all
+    assert len(h) == 2
+    h.append(6.0, u"\u03bd\u03b9\u03ba\u03bf\u03c2", u"\u03b3\u03b5\u03b9\u03b1")
+    assert list(h)[0] == (6.0, u"\u03bd\u03b9\u03ba\u03bf\u03c2", u"\u03b3\u03b5\u03b9\u03b1")
+    assert h.bytes == 20
+    # nicks IRC folds differently from str.lower()
+    h.append(7.0, u"John^", u"hi")
+    h.append(8.0, u"[away]", u"back")
+    assert list(h.lines(u"bob")) == []
+    assert list(h.lines(u"john~")) == [(7.0, "John^", u"hi")]
+    assert list(h.lines(u"{AWAY}")) == [(8.0, "[away]", u"back")]
+    h.clear()
+    assert not list(h) and h.bytes == 0
+
+    history = History(max_lines=100)
+    history.record("#FidiBot", 1.0, "alice", u"hello")
+    assert list(history.lines("#fidibot")) == [(1.0, "alice", u"hello")]
+    assert list(history.lines("#other")) == []
+    history.discard("#fidibot")
+    assert not history
+
+    # Benchmark memory against a deque of tuples
+    import time
+    from collections import deque
+    from channelstate import deep_size
+    lines = [(1400000000.0 + i, u"user%d" % (i % 40),
+              u"this is line number %d of some typical chat in a channel" % i) for i in xrange(5000)]
+    old = deque(maxlen=5000)
+    new = ChannelHistory(max_lines=5000, max_bytes=10 ** 6)
+    for when, nick, text in lines:
+        old.append((when, nick, text))
+        new.append(when, nick, text)
+    start = time.time()
+    found = len(list(new.lines("user7")))
+    took = time.time() - start
+    assert found == 125
+    print "5000 lines: deque of tuples %.2fMB, ChannelHistory %.2fMB (reported %.2fMB), " \
+        "a nick's lines in %.1fms" % (deep_size(list(old)) / 1e6, deep_size(new) / 1e6,
+                                      new.memory() / 1e6, took * 1000)
+    print "Everything in order"
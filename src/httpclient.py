@@ -0,0 +1,158 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Shared HTTP client for the bot's modules
+
+A single requests Session is kept for the whole bot, so connections to
+hosts we talk to often are kept alive and reused instead of paying for
+a new TCP and TLS handshake on every request.
+
+On top of the session, every request gets default connect and read
+timeouts, bounded retries with backoff for idempotent requests, and
+a cap on how much of the response body is read. Waiting for a free
+connection to a busy host is bounded too.
+
+Modules reach it as `self.http` and should use it for all their
+outbound HTTP requests.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.exceptions import EmptyPoolError
+from resolver import ResolvingAdapter
+
+
+class ResponseTooLarge(requests.RequestException):
+    """The response body is larger than allowed"""
+
+
+class PoolTimeoutMixin(object):
+    """
+    Adapter mixin to wait at most pool_timeout seconds for a free
+    connection, instead of forever, when the pools block.
+
+    requests doesn't pass a pool timeout on, so the pools get one
+    when they're first handed out.
+    """
+
+    pool_timeout = 30
+
+    def get_connection(self, url, proxies=None):
+        pool = super(PoolTimeoutMixin, self).get_connection(url, proxies)
+        if not getattr(pool, 'pool_timeout', None):
+            get_conn = pool._get_conn
+            def _get_conn(timeout=None):
+                return get_conn(self.pool_timeout if timeout is None else timeout)
+            pool._get_conn = _get_conn
+            pool.pool_timeout = self.pool_timeout
+        return pool
+
+
+class TimeoutAdapter(PoolTimeoutMixin, HTTPAdapter):
+    pass
+
+
+class TimeoutResolvingAdapter(PoolTimeoutMixin, ResolvingAdapter):
+    pass
+
+
+class HttpClient(object):
+    """
+    Pooled HTTP client.
+
+    pool_hosts:      how many hosts to keep connection pools for
+    host_limit:      most connections open to a single host. Requests
+                     over that wait for a connection to be free
+    pool_timeout:    most seconds to wait for it
+    connect_timeout,
+    read_timeout:    default timeouts in seconds
+    retries:         retries of failed connections and reads,
+                     and of 502, 503 and 504 responses
+    backoff:         backoff factor between retries, in seconds
+    max_bytes:       default cap for response bodies
+    resolver:        a resolver.Resolver to look up and check hosts
+                     with, instead of a plain getaddrinfo
+    """
+
+    def __init__(self, pool_hosts=32, host_limit=4, pool_timeout=30, connect_timeout=3.05,
+                 read_timeout=10, retries=2, backoff=0.5, max_bytes=1024*1024,
+                 user_agent="fidibot https://github.com/nickraptis/fidibot",
+                 resolver=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        retry = Retry(total=retries, connect=retries, read=retries, redirect=5,
+                      status_forcelist=(502, 503, 504), backoff_factor=backoff,
+                      raise_on_redirect=False)
+        self.resolver = resolver
+        adapter_kwargs = dict(pool_connections=pool_hosts, pool_maxsize=host_limit,
+                              max_retries=retry, pool_block=True)
+        if resolver:
+            self.adapter = TimeoutResolvingAdapter(resolver, **adapter_kwargs)
+        else:
+            self.adapter = TimeoutAdapter(**adapter_kwargs)
+        self.adapter.pool_timeout = pool_timeout
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def request(self, method, url, max_bytes=None, truncate=False, **kwargs):
+        """
+        Make a request and read at most max_bytes of the response body.
+
+        If the body is larger, raise ResponseTooLarge, or with truncate
+        just keep the first max_bytes of it.
+        With stream=True the body is left unread for the caller to read,
+        and closing the response is up to them.
+        Other arguments are the same as requests'.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        stream = kwargs.pop('stream', False)
+        try:
+            resp = self.session.request(method, url, stream=True, **kwargs)
+        except EmptyPoolError as e:
+            raise requests.ConnectionError("No free connection to %s: %s" % (url, e))
+        if stream:
+            return resp
+        if method.upper() == 'HEAD':
+            # there's no body, reading it gives the connection back to the pool
+            resp.content
+            return resp
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        try:
+            length = int(resp.headers.get('content-length', 0))
+        except ValueError:
+            length = 0
+        if length > max_bytes and not truncate:
+            resp.close()
+            raise ResponseTooLarge("%s is %d bytes" % (url, length), response=resp)
+        chunks = []
+        read = 0
+        for chunk in resp.iter_content(8192):
+            chunks.append(chunk)
+            read += len(chunk)
+            if read > max_bytes:
+                # don't return the connection to the pool half read
+                resp.close()
+                if not truncate:
+                    raise ResponseTooLarge("%s is over %d bytes" % (url, max_bytes),
+                                           response=resp)
+                break
+        resp._content = b"".join(chunks)[:max_bytes]
+        resp._content_consumed = True
+        return resp
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def close(self):
+        self.session.close()
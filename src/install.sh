@@ -26,6 +26,11 @@ then
 	mkdir log/moolog
 fi
 
+if [ ! -d data ]
+then
+	mkdir data
+fi
+
 if [ ! -d alternatives ]
 then
 	if [ -d $FIDIBOT_STRINGS_DIR ]
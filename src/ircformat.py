@@ -0,0 +1,172 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Codec for IRC formatting codes
+
+Most lines on IRC carry no formatting at all, so every function here
+first checks for control characters and returns the text untouched
+if there are none.
+
+strip() removes all formatting. Byte strings without colors are
+stripped with a single translate() pass. Unicode translate() goes
+through a dict lookup per character and is much slower than a regular
+expression, so unicode strings use one compiled expression instead.
+parse() splits formatted text to spans with their style.
+"""
+
+import re
+from collections import namedtuple
+
+BOLD = '\x02'
+COLOR = '\x03'
+HEX_COLOR = '\x04'
+RESET = '\x0f'
+MONOSPACE = '\x11'
+REVERSE = '\x16'
+ITALIC = '\x1d'
+STRIKE = '\x1e'
+UNDERLINE = '\x1f'
+# CTCP delimiter, ie. for ACTION, and an old reverse code
+CTCP = '\x01'
+OLD_REVERSE = '\x12'
+
+toggles = {
+    BOLD: 'bold',
+    ITALIC: 'italic',
+    UNDERLINE: 'underline',
+    REVERSE: 'reverse',
+    OLD_REVERSE: 'reverse',
+    STRIKE: 'strike',
+    MONOSPACE: 'monospace',
+}
+
+codes = (CTCP + BOLD + COLOR + HEX_COLOR + RESET + MONOSPACE +
+         REVERSE + OLD_REVERSE + ITALIC + STRIKE + UNDERLINE)
+simple_codes = codes.replace(COLOR, '').replace(HEX_COLOR, '')
+
+any_code = re.compile(u'[%s]' % codes)
+every_code = re.compile(u"""
+    \x03(?:[0-9]{1,2}(?:,[0-9]{1,2})?)?         # mIRC color
+    |\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?  # hex color
+    |[%s]                                       # everything else
+    """ % simple_codes, re.VERBOSE)
+# match formatting codes one at a time, with color arguments as groups
+token = re.compile(u"""
+    \x03(?:([0-9]{1,2})(?:,([0-9]{1,2}))?)?
+    |\x04(?:([0-9a-fA-F]{6})(?:,([0-9a-fA-F]{6}))?)?
+    |[%s]
+    """ % simple_codes, re.VERBOSE)
+
+_find_code = any_code.search
+_sub_codes = every_code.sub
+
+
+def has_codes(text):
+    """Return True if text contains any formatting codes"""
+    return _find_code(text) is not None
+
+
+def strip(text):
+    """Remove all formatting codes from text"""
+    if _find_code(text) is None:
+        return text
+    if isinstance(text, str) and COLOR not in text and HEX_COLOR not in text:
+        return text.translate(None, simple_codes)
+    # keep the type of the text, str or unicode
+    return _sub_codes(text[:0], text)
+
+
+Style = namedtuple('Style', 'bold italic underline reverse strike monospace fg bg')
+Style.__new__.__defaults__ = (False,) * 6 + (None, None)
+plain = Style()
+
+Span = namedtuple('Span', 'text style')
+
+
+def parse(text):
+    """
+    Split formatted text to a list of Spans.
+
+    A Span has the text with no codes and the Style it was written in.
+    Colors are kept as they were sent, mIRC numbers or hex strings.
+    """
+    if not any_code.search(text):
+        return [Span(text, plain)]
+    spans = []
+    style = plain
+    pos = 0
+    for m in token.finditer(text):
+        if m.start() > pos:
+            spans.append(Span(text[pos:m.start()], style))
+        pos = m.end()
+        code = m.group()[0]
+        if code in toggles:
+            attr = toggles[code]
+            style = style._replace(**{attr: not getattr(style, attr)})
+        elif code == RESET:
+            style = plain
+        elif code in (COLOR, HEX_COLOR):
+            fg, bg = m.group(1, 2) if code == COLOR else m.group(3, 4)
+            if fg is None:
+                # a color code with no color resets them
+                style = style._replace(fg=None, bg=None)
+            elif bg is None:
+                style = style._replace(fg=fg)
+            else:
+                style = style._replace(fg=fg, bg=bg)
+    if pos < len(text):
+        spans.append(Span(text[pos:], style))
+    return spans
+
+
+if __name__ == '__main__':
+    # Test the codec
+    assert strip(u"plain text") == u"plain text"
+    assert strip("plain text") == "plain text"
+    assert strip(u"\x02bold\x02 and \x0304,12red on blue\x03") == u"bold and red on blue"
+    assert strip("\x0312,1x\x03,y\x031z") == "x,yz"
+    assert type(strip("\x02bold\x02")) is str
+    assert strip(u"\x01ACTION waves\x01") == u"ACTION waves"
+    assert strip(u"\x04ff0000hex\x0f") == u"hex"
+    assert strip(u"\x1ditalic\x1d \x1funder\x1f") == u"italic under"
+    assert parse(u"hi") == [Span(u"hi", plain)]
+    spans = parse(u"a\x02b\x0304c\x1dd\x03e\x0ff")
+    assert spans == [
+        Span(u"a", plain),
+        Span(u"b", Style(bold=True)),
+        Span(u"c", Style(bold=True, fg=u"04")),
+        Span(u"d", Style(bold=True, italic=True, fg=u"04")),
+        Span(u"e", Style(bold=True, italic=True)),
+        Span(u"f", plain),
+    ], spans
+    assert parse(u"\x0303,01x")[0].style == Style(fg=u"03", bg=u"01")
+
+    # Benchmark against the regular expression we used to use
+    import random, timeit
+    legacy = re.compile("""
+        \x1f|\x02|\x12|\x0f|\x16|\x01|
+        \x03(?:\d{1,2}(?:,\d{1,2})?)?
+        """, re.UNICODE | re.VERBOSE)
+    random.seed(42)
+    words = u"the bot is down again can someone check http://example.com/foo why".split()
+    traffic = []
+    for i in xrange(10000):
+        line = u" ".join(random.choice(words) for _ in xrange(random.randint(3, 20)))
+        r = random.random()
+        if r < 0.03:
+            line = u"\x0304,01" + line + u"\x03"
+        elif r < 0.05:
+            line = u"\x02" + line + u"\x02"
+        elif r < 0.06:
+            line = u"\x01ACTION " + line + u"\x01"
+        traffic.append(line)
+    for line in traffic:
+        assert strip(line) == legacy.sub(u"", line), line
+    bytes_traffic = [line.encode('utf-8') for line in traffic]
+    for kind, lines in (("unicode", traffic), ("bytes", bytes_traffic)):
+        t_legacy = min(timeit.repeat(lambda: [legacy.sub(l[:0], l) for l in lines],
+                                     number=5, repeat=3))
+        t_strip = min(timeit.repeat(lambda: [strip(l) for l in lines],
+                                    number=5, repeat=3))
+        print "%-7s regex: %.1fms  codec: %.1fms  (%d lines x5, 6%% formatted)" % (
+            kind, t_legacy * 1000, t_strip * 1000, len(lines))
+    print "Everything in order"
@@ -0,0 +1,181 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Measuring how lagged the bot is
+
+The bot pings the server with the time as the token, and the server
+sends it back in its PONG, so the round trip time needs no bookkeeping
+and works for any ping carrying a timestamp. Round trips go into a
+RollingHistogram covering the last hour.
+
+While a ping is unanswered for longer than the last round trip, the
+lag is how long it has been waiting, so a stalled link shows up as
+lag before the pong arrives.
+"""
+
+import time
+
+# upper bounds of the histogram buckets, in milliseconds
+default_buckets = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float('inf'))
+# ignore pong tokens older than that, in seconds
+max_token_age = 10 * 60
+
+
+class RollingHistogram(object):
+    """
+    Counts of values in buckets over the last window seconds.
+
+    The window is split in slots that are reset as time moves past
+    them, so memory stays the same however many values are recorded.
+    """
+
+    def __init__(self, buckets=default_buckets, window=60*60, slots=12, clock=time.time):
+        self.buckets = buckets
+        self.width = float(window) / slots
+        self.clock = clock
+        # [slot number, counts] for every slot
+        self.slots = [[None, [0] * len(buckets)] for i in xrange(slots)]
+
+    def record(self, value):
+        number = int(self.clock() // self.width)
+        slot = self.slots[number % len(self.slots)]
+        if slot[0] != number:
+            slot[0], slot[1] = number, [0] * len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                slot[1][i] += 1
+                break
+
+    def counts(self):
+        """Counts per bucket over the window"""
+        oldest = int(self.clock() // self.width) - len(self.slots) + 1
+        totals = [0] * len(self.buckets)
+        for number, counts in self.slots:
+            if number is not None and number >= oldest:
+                totals = [t + c for t, c in zip(totals, counts)]
+        return totals
+
+    def percentile(self, p, counts=None):
+        """Upper bound of the bucket the p-th percentile is in, or None"""
+        counts = counts or self.counts()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = total * p / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+    def __len__(self):
+        return sum(self.counts())
+
+
+class LagMeter(object):
+    """Round trip times of pings to the server"""
+
+    def __init__(self, threshold=5.0, clock=time.time):
+        self.threshold = threshold
+        self.clock = clock
+        self.histogram = RollingHistogram(clock=clock)
+        self.last_rtt = None
+        # when the oldest unanswered ping was sent
+        self.waiting = None
+
+    def ping(self, connection):
+        now = self.clock()
+        connection.ping("%.3f" % now)
+        if self.waiting is None:
+            self.waiting = now
+
+    def pong(self, token):
+        """Record the round trip of a ping. Returns it, or None for foreign tokens"""
+        now = self.clock()
+        try:
+            sent = float(token)
+        except (TypeError, ValueError):
+            return None
+        if not 0 <= now - sent <= max_token_age:
+            return None
+        rtt = now - sent
+        self.last_rtt = rtt
+        self.histogram.record(rtt * 1000)
+        self.waiting = None
+        return rtt
+
+    def reset(self):
+        """Forget pings sent on a connection that's gone"""
+        self.waiting = None
+
+    def current(self):
+        """The lag in seconds as far as we know, or None before any pong"""
+        lag = self.last_rtt
+        if self.waiting is not None:
+            lag = max(lag, self.clock() - self.waiting)
+        return lag
+
+    def lagged(self):
+        lag = self.current()
+        return bool(self.threshold) and lag is not None and lag > self.threshold
+
+    def stats(self):
+        counts = self.histogram.counts()
+        lag = self.current()
+        stats = {'lag_ms': int(round(lag * 1000)) if lag is not None else None,
+                 'pongs': sum(counts)}
+        for p in (50, 90, 99):
+            stats['p%d_ms' % p] = self.histogram.percentile(p, counts)
+        return stats
+
+    def describe(self):
+        """The lag and its percentiles, in a line"""
+        stats = self.stats()
+        if stats['lag_ms'] is None:
+            return "No pongs yet"
+        return "Lag %dms, last hour p50<=%sms p90<=%sms p99<=%sms over %d pongs" % (
+            stats['lag_ms'], stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['pongs'])
+
+
+if __name__ == '__main__':
+    # Test the histogram and the meter with a fake clock
+    now = [1000.0]
+    clock = lambda: now[0]
+    histogram = RollingHistogram((10, 100, float('inf')), window=60, slots=6, clock=clock)
+    for value in [5] * 90 + [50] * 9 + [500]:
+        histogram.record(value)
+    assert histogram.counts() == [90, 9, 1]
+    assert histogram.percentile(50) == 10 and histogram.percentile(95) == 100
+    assert histogram.percentile(100) == float('inf')
+    now[0] += 30
+    histogram.record(50)
+    assert len(histogram) == 101
+    now[0] += 40 # the first slot is out of the window
+    assert histogram.counts() == [0, 1, 0]
+    now[0] += 60
+    assert histogram.percentile(50) is None
+
+    class Connection(object):
+        def __init__(self):
+            self.sent = []
+        def ping(self, token):
+            self.sent.append(token)
+
+    c = Connection()
+    meter = LagMeter(threshold=2, clock=clock)
+    assert meter.current() is None and not meter.lagged()
+    meter.ping(c)
+    now[0] += 0.25
+    assert meter.pong(c.sent[-1]) == 0.25
+    assert meter.current() == 0.25 and not meter.lagged()
+    assert meter.pong("keep-alive") is None and meter.pong("12.5") is None
+    meter.ping(c)
+    now[0] += 3 # no pong yet
+    assert meter.lagged() and meter.current() == 3
+    meter.pong(c.sent[-1])
+    assert meter.lagged() and meter.stats()['p99_ms'] == 5000
+    meter.ping(c)
+    now[0] += 0.04
+    meter.pong(c.sent[-1])
+    assert not meter.lagged()
+    print meter.describe()
+    print "Everything in order"
@@ -0,0 +1,322 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Full text index over the moobot channel logs
+
+The channel logs written by logsetup.ChannelLogFormatter are tailed
+into a SQLite FTS5 index. Rotated log files, plain or compressed,
+are backfilled once.
+
+Every log file is identified by its first line rather than its name,
+so a file that gets rotated, or later compressed, is picked up from
+where we stopped reading it and never indexed twice.
+
+Indexing is done by LogIndexer in a background thread with its own
+database connection. Searches use a separate connection and are meant
+to be run from the reactor thread.
+"""
+
+import os, re, time, glob
+import gzip, bz2
+import sqlite3
+import threading
+from datetime import datetime
+from irc.strings import lower
+
+import logging
+log = logging.getLogger(__name__)
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    nick TEXT NOT NULL,
+    nick_key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_ts ON lines (ts);
+CREATE INDEX IF NOT EXISTS lines_nick ON lines (nick_key, ts);
+CREATE INDEX IF NOT EXISTS lines_channel ON lines (channel, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5(
+    text, content='lines', content_rowid='id'
+);
+CREATE TABLE IF NOT EXISTS sources (
+    fingerprint TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+line_regex = re.compile(r"""
+    ^(\d{4}-\d\d-\d\d\ \d\d:\d\d:\d\d)  # timestamp
+    \ :([^!\s]+)\S*                     # source nick, drop user@host
+    \ (PUBMSG|CTCP)                     # messages and actions
+    \ (\#\S+)                           # to a channel
+    \ :?(.*)$                           # the actual text
+    """, re.VERBOSE | re.UNICODE)
+
+time_format = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_line(line):
+    """
+    Parse a moobot log line.
+
+    Return a (ts, channel, nick, kind, text) tuple for channel messages
+    and actions, None for anything else.
+    """
+    m = line_regex.match(line)
+    if not m:
+        return None
+    stamp, nick, command, channel, text = m.groups()
+    try:
+        ts = int(time.mktime(time.strptime(stamp, time_format)))
+    except ValueError:
+        return None
+    kind = 'msg'
+    if command == 'CTCP':
+        if not text.startswith('ACTION '):
+            return None
+        kind = 'action'
+        text = text[7:]
+    return ts, lower(channel), nick, kind, text
+
+
+def open_log(path):
+    """Open a log file, transparently decompressing it"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+
+def fingerprint(path):
+    """Return the first full line of a log file, or None if there's none yet"""
+    with open_log(path) as f:
+        first = f.readline()
+    if not first.endswith('\n'):
+        return None
+    return first.rstrip('\r\n').decode('utf-8', 'replace')
+
+
+def connect(db_path, check_same_thread=True):
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    return conn
+
+
+class LogIndexer(threading.Thread):
+    """
+    Background thread that keeps the index up to date with the logs.
+
+    log_path is the live log file. Rotated files are expected next to it
+    with any suffix, ie. `moobot.log.2015-03-01` or `moobot.log.1.gz`.
+    """
+
+    def __init__(self, db_path, log_path, interval=30, batch_size=1000):
+        super(LogIndexer, self).__init__(name="LogIndexer")
+        self.daemon = True
+        self.db_path = db_path
+        self.log_path = log_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        conn = connect(self.db_path)
+        while not self._stop_event.is_set():
+            try:
+                self.index_pending(conn)
+            except Exception as e:
+                log.exception(e)
+            self._stop_event.wait(self.interval)
+        conn.close()
+
+    def log_files(self):
+        """Return the rotated log files, oldest first, then the live one"""
+        rotated = sorted(glob.glob(self.log_path + '.*'), key=os.path.getmtime)
+        return rotated + [self.log_path]
+
+    def index_pending(self, conn):
+        """Index every line not yet seen, in all log files"""
+        for path in self.log_files():
+            if self._stop_event.is_set():
+                return
+            if not os.path.exists(path):
+                continue
+            try:
+                fp = fingerprint(path)
+            except (IOError, EOFError) as e:
+                log.warning("Couldn't read log file %s: %s", path, e)
+                continue
+            if fp is None:
+                continue
+            row = conn.execute(
+                "SELECT offset, done FROM sources WHERE fingerprint = ?",
+                (fp,)).fetchone()
+            offset, done = row if row else (0, 0)
+            if done:
+                continue
+            is_live = path == self.log_path
+            self.index_file(conn, path, fp, offset, done=not is_live)
+
+    def index_file(self, conn, path, fp, offset, done=False):
+        """Index a single file from offset, committing in batches"""
+        name = os.path.basename(path)
+        count = 0
+        with open_log(path) as f:
+            if offset:
+                f.seek(offset)
+            while not self._stop_event.is_set():
+                batch = []
+                for _ in xrange(self.batch_size):
+                    line = f.readline()
+                    if not line.endswith('\n'):
+                        # a partial line will be complete on the next run
+                        break
+                    offset += len(line)
+                    entry = parse_line(line.rstrip('\r\n').decode('utf-8', 'replace'))
+                    if entry:
+                        batch.append(entry)
+                else:
+                    line = None
+                self._store(conn, batch, fp, name, offset)
+                count += len(batch)
+                if line is not None:
+                    break
+        if done:
+            conn.execute("UPDATE sources SET done = 1 WHERE fingerprint = ?", (fp,))
+            conn.commit()
+        if count:
+            log.info("Indexed %d lines from %s", count, name)
+
+    def _store(self, conn, batch, fp, name, offset):
+        with conn:
+            for ts, channel, nick, kind, text in batch:
+                cur = conn.execute(
+                    "INSERT INTO lines (ts, channel, nick, nick_key, kind, text)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (ts, channel, nick, lower(nick), kind, text))
+                conn.execute("INSERT INTO lines_fts (rowid, text) VALUES (?, ?)",
+                             (cur.lastrowid, text))
+            conn.execute(
+                "INSERT OR REPLACE INTO sources (fingerprint, name, offset, done)"
+                " VALUES (?, ?, ?, 0)", (fp, name, offset))
+
+
+def fts_query(terms):
+    """Quote each term so user input can't use FTS syntax"""
+    return " ".join('"%s"' % t.replace('"', '""') for t in terms)
+
+
+class LogIndex(object):
+    """
+    Query side of the channel log index.
+
+    Safe to search from any thread, one search at a time.
+    """
+
+    def __init__(self, db_path):
+        self.conn = connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def search(self, terms=(), nick=None, channel=None,
+               since=None, until=None, page=1, page_size=5):
+        """
+        Search the index, newest lines first.
+
+        terms are matched as whole words, all of them must be present.
+        since and until are unix timestamps.
+        Return a list of (datetime, channel, nick, kind, text) for the
+        requested page and whether there are more pages.
+        """
+        where = []
+        params = []
+        if terms:
+            tables = "lines_fts JOIN lines l ON l.id = lines_fts.rowid"
+            where.append("lines_fts MATCH ?")
+            params.append(fts_query(terms))
+        else:
+            tables = "lines l"
+        if nick:
+            where.append("l.nick_key = ?")
+            params.append(lower(nick))
+        if channel:
+            where.append("l.channel = ?")
+            params.append(lower(channel))
+        if since is not None:
+            where.append("l.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("l.ts < ?")
+            params.append(until)
+        sql = "SELECT l.ts, l.channel, l.nick, l.kind, l.text FROM " + tables
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY l.ts DESC, l.id DESC LIMIT ? OFFSET ?"
+        params.extend((page_size + 1, (page - 1) * page_size))
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        more = len(rows) > page_size
+        results = [(datetime.fromtimestamp(ts), ch, n, kind, text)
+                   for ts, ch, n, kind, text in rows[:page_size]]
+        return results, more
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == '__main__':
+    # Index a few sample lines and search them
+    import tempfile, shutil
+    tmp = tempfile.mkdtemp()
+    try:
+        log_path = os.path.join(tmp, "moobot.log")
+        db_path = os.path.join(tmp, "history.db")
+        with open(log_path + ".2015-03-01", "w") as f:
+            f.write("2015-03-01 10:00:00 :alice!a@host PUBMSG #foss :hello world\n")
+            f.write("2015-03-01 10:01:00 :bob!b@host JOIN #foss\n")
+        with gzip.open(log_path + ".2015-02-28.gz", "wb") as f:
+            f.write("2015-02-28 09:00:00 :bob!b@host PUBMSG #foss :old news\n")
+        with open(log_path, "w") as f:
+            f.write("2015-03-02 11:00:00 :Bob!b@host PUBMSG #foss :hello there\n")
+            f.write("2015-03-02 11:00:05 :alice!a@host CTCP #FOSS :ACTION waves\n")
+            f.write("2015-03-02 11:00:09 :alice!a@host PUBMSG #foss :partial")
+        indexer = LogIndexer(db_path, log_path)
+        conn = connect(db_path)
+        indexer.index_pending(conn)
+        indexer.index_pending(conn)  # nothing new, must not duplicate
+        index = LogIndex(db_path)
+        results, more = index.search(["hello"])
+        assert [r[2] for r in results] == ["Bob", "alice"], results
+        assert not more
+        results, more = index.search(nick="bob")
+        assert len(results) == 2, results
+        results, more = index.search(["waves"], channel="#foss")
+        assert results[0][3] == 'action', results
+        results, more = index.search(page_size=1)
+        assert more and len(results) == 1
+        since = int(time.mktime(time.strptime("2015-03-02", "%Y-%m-%d")))
+        results, more = index.search(["hello"], since=since)
+        assert len(results) == 1, results
+        # complete the partial line and rotate the live file
+        with open(log_path, "a") as f:
+            f.write(" line\n")
+        os.rename(log_path, log_path + ".2015-03-02")
+        indexer.index_pending(conn)
+        results, more = index.search(["partial"])
+        assert len(results) == 1, results
+        assert len(index.search(page_size=50)[0]) == 5
+        print "Everything in order"
+    finally:
+        shutil.rmtree(tmp)
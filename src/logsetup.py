@@ -6,22 +6,16 @@ import logging
 import re, sys
 import irc.events
 from logging.handlers import TimedRotatingFileHandler as TRHandler
+from tools import reverse_lines
+from ircformat import strip as strip_codes
 
-colors = """
-        \x1f|        # Underline
-        \x02|        # Bold
-        \x12|        # Reverse
-        \x0f|        # Normal
-        \x16|        # Italic
-        
-        \x01|        # ACTION Heading
-        
-        \x03         # Color
-        (?:\d{1,2}   # with one or two digits for foreground
-        (?:,\d{1,2}  # and maybe a comma and another 2 digits
-        )?)?         # for background
-         """
-strip_colors = re.compile(colors, re.UNICODE | re.VERBOSE)
+error_log = "log/errors.log"
+error_header = re.compile(r"""
+    ^(\d{4}-\d\d-\d\d\ \d\d:\d\d:\d\d)  # asctime
+    \ (\w+)\ +                          # levelname
+    (\S+)\ +                             # logger name
+    (.*)$                                # message
+    """, re.VERBOSE)
 
 class LowLevelFilter(logging.Filter):
     """A filter for irc.client low level events"""
@@ -101,7 +95,7 @@ class ServerMsgFormatter(logging.Formatter):
                     message = message[1:]
             except IndexError:
                 message = ''
-            message = strip_colors.sub("", message)
+            message = strip_codes(message)
             # if the command is numeric map it to a string
             if command in irc.events.numeric:
                 command = irc.events.numeric[command].upper()
@@ -132,7 +126,7 @@ class ChannelLogFormatter(logging.Formatter):
     def format(self, record):
         from_to = record.msg
         arg = record.args[0]
-        arg = strip_colors.sub("", arg)
+        arg = strip_codes(arg)
         if "TO SERVER" in from_to:
             arg = ":%s %s" % (self.bot.nickname, arg)
         if "ACTION" in arg:
@@ -152,6 +146,61 @@ def escape(string):
     return string
 
 
+def error_records(path=error_log, max_bytes=1024*1024):
+    """
+    Yield the records of the error log, newest first.
+
+    Each record is an (asctime, levelname, name, lines) tuple, where lines
+    holds the message and any traceback that followed it.
+    Reading stops after max_bytes from the end of the file.
+    """
+    lines = []
+    read = 0
+    for line in reverse_lines(path):
+        read += len(line) + 1
+        if read > max_bytes:
+            return
+        lines.append(line)
+        m = error_header.match(line)
+        if m:
+            asctime, level, name, message = m.groups()
+            lines[-1] = message
+            lines.reverse()
+            yield asctime, level, name, lines
+            lines = []
+
+
+def filter_error_records(records, level=None, logger=None, since=None, until=None):
+    """
+    Filter error records by minimum level, logger and time range.
+
+    The logger matches any of its parents or children,
+    ie. `urlparser` and `modules` both match `modules.urlparser`.
+    since and until are prefixes of asctime, ie. `2015-03-01 10`.
+    """
+    if level:
+        level = logging.getLevelName(level.upper())
+    for record in records:
+        asctime, levelname, name, lines = record
+        if since and asctime < since:
+            # records are newest first, so the rest are older too
+            return
+        if until and asctime[:len(until)] > until:
+            continue
+        if level and logging.getLevelName(levelname) < level:
+            continue
+        if logger and logger not in name.split('.') and \
+                not name.startswith(logger + '.'):
+            continue
+        yield record
+
+
+def exception_name(record):
+    """Return the exception line of a record, or its message"""
+    asctime, levelname, name, lines = record
+    return lines[-1].strip()
+
+
 def setup_logging():
     """Set up logger options"""
     # Setup root logger
@@ -164,7 +213,7 @@ def setup_logging():
     handler.setFormatter(logging.Formatter(fmt))
     logger.addHandler(handler)
     # Log errors to a file
-    error_handler = logging.FileHandler("log/errors.log")
+    error_handler = logging.FileHandler(error_log)
     error_handler.setFormatter(logging.Formatter(
         "%%(asctime)s %s" % fmt, datefmt=datefmt))
     error_handler.setLevel(logging.ERROR)
@@ -0,0 +1,239 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Matching IRC users against many hostmasks at once
+
+Masks are `nick!user@host` with `*` and `?` wildcards, a bare nick
+being short for `nick!*@*`, or `$a:account` for a services account.
+Everything is compared in IRC lowercase.
+
+MaskSet sorts its masks by what it takes to match them:
+- plain nicks (`nick!*@*`) and plain hosts (`*!*@host`) go in sets,
+  along with masks without wildcards and accounts, so they're a
+  hash lookup each
+- the rest are compiled into a single regex, factored like a trie
+  on their common prefixes, so one pass over the user's prefix
+  checks all of them
+- except masks with more than max_regex_stars `*`, which would make
+  the regex backtrack for ages, and are matched one by one instead by
+  glob_match(), that never backtracks more than a character
+
+Nothing is recompiled until the masks change and the next match.
+"""
+
+import re
+from irc.strings import lower
+
+wildcards = re.compile(r"[*?]")
+stars = re.compile(r"\*+")
+# most stars in a mask to match with the regex
+max_regex_stars = 3
+
+
+def normalize(mask):
+    """Return the canonical, lowercase form of a mask"""
+    mask = mask.strip()
+    if mask.lower().startswith("$a:"):
+        return "$a:" + lower(mask[3:])
+    mask = stars.sub("*", lower(mask))
+    if '!' not in mask and '@' not in mask:
+        return mask + "!*@*"
+    nick, _, rest = mask.partition('!') if '!' in mask else ('*', '', mask)
+    user, _, host = rest.rpartition('@') if '@' in rest else (rest, '', '*')
+    return "%s!%s@%s" % (nick or '*', user or '*', host or '*')
+
+
+def matches_everyone(mask):
+    """Whether a mask matches every user there can be"""
+    mask = normalize(mask)
+    return not mask.startswith("$a:") and not mask.strip("*?!@")
+
+
+def mask_tokens(mask):
+    """Regex pieces of a wildcard mask, one per character"""
+    for char in mask:
+        if char == '*':
+            yield '.*'
+        elif char == '?':
+            yield '.'
+        else:
+            yield re.escape(char)
+
+
+def glob_match(mask, text):
+    """
+    Whether text matches a wildcard mask, in O(len(mask) * len(text))
+    at worst, however many stars it has.
+    """
+    m = t = 0
+    # where the last star was, and the text it matched up to
+    star, matched = -1, 0
+    while t < len(text):
+        if m < len(mask) and mask[m] in ('?', text[t]):
+            m += 1
+            t += 1
+        elif m < len(mask) and mask[m] == '*':
+            star, matched = m, t
+            m += 1
+        elif star >= 0:
+            # let the last star match one more character
+            matched += 1
+            m, t = star + 1, matched
+        else:
+            return False
+    while m < len(mask) and mask[m] == '*':
+        m += 1
+    return m == len(mask)
+
+
+def trie_regex(patterns):
+    """
+    Combine lists of regex tokens into a single regex, factoring out
+    their common prefixes.
+    """
+    trie = {}
+    for tokens in patterns:
+        node = trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node[''] = None
+
+    def build(node):
+        ends = '' in node
+        branches = [token + build(child) for token, child in
+                    sorted(node.iteritems()) if token]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not ends:
+            return branches[0]
+        body = "(?:%s)" % "|".join(branches)
+        return body + "?" if ends else body
+
+    return build(trie)
+
+
+class MaskSet(object):
+    """A set of masks that can tell if a user matches any of them"""
+
+    def __init__(self, masks=()):
+        self.masks = set()
+        self._compiled = None
+        for mask in masks:
+            self.add(mask)
+
+    def add(self, mask):
+        """Add a mask, returning its normalized form"""
+        mask = normalize(mask)
+        self.masks.add(mask)
+        self._compiled = None
+        return mask
+
+    def discard(self, mask):
+        """Remove a mask, returning whether it was there"""
+        mask = normalize(mask)
+        if mask not in self.masks:
+            return False
+        self.masks.discard(mask)
+        self._compiled = None
+        return True
+
+    def __contains__(self, mask):
+        return normalize(mask) in self.masks
+
+    def __len__(self):
+        return len(self.masks)
+
+    def _compile(self):
+        nicks, hosts, exact, accounts, patterns, globs = set(), set(), set(), set(), [], []
+        for mask in self.masks:
+            if mask.startswith("$a:"):
+                accounts.add(mask[3:])
+                continue
+            nick, rest = mask.split('!', 1)
+            user, host = rest.rsplit('@', 1)
+            if user == '*' and host == '*' and not wildcards.search(nick):
+                nicks.add(nick)
+            elif nick == '*' and user == '*' and not wildcards.search(host):
+                hosts.add(host)
+            elif not wildcards.search(mask):
+                exact.add(mask)
+            elif mask.count('*') > max_regex_stars:
+                globs.append(mask)
+            else:
+                patterns.append(list(mask_tokens(mask)))
+        regex = re.compile(trie_regex(patterns) + r"\Z", re.DOTALL) if patterns else None
+        self._compiled = nicks, hosts, exact, accounts, regex, globs
+        return self._compiled
+
+    def match(self, source, account=None):
+        """
+        Return whether a user matches any mask.
+
+        source is the user's `nick!user@host`, account their services
+        account, if known.
+        """
+        nicks, hosts, exact, accounts, regex, globs = self._compiled or self._compile()
+        source = lower(source)
+        nick, _, rest = source.partition('!')
+        if nick in nicks or source in exact:
+            return True
+        if hosts and rest.rpartition('@')[2] in hosts:
+            return True
+        if account and lower(account) in accounts:
+            return True
+        if regex and regex.match(source):
+            return True
+        return any(glob_match(mask, source) for mask in globs)
+
+
+if __name__ == '__main__':
+    # Test the normalization and matching
+    assert normalize("FossBot") == "fossbot!*@*"
+    assert normalize("*@Example.COM") == "*!*@example.com"
+    assert normalize("nick!user") == "nick!user@*"
+    assert normalize("$a:Someone") == "$a:someone"
+    assert matches_everyone("*") and matches_everyone("!") and matches_everyone("?*@*")
+    assert not matches_everyone("*!*@*.net") and not matches_everyone("$a:*")
+    masks = MaskSet(["fossbot", "*!*@spam.example.com", "bad!*@*.evil.net",
+                     "?oe!joe@host", "exact!user@host.org", "$a:troll"])
+    assert masks.match("FossBot!bot@anywhere")
+    assert masks.match("x!y@SPAM.example.com")
+    assert masks.match("bad!u@a.b.evil.net") and not masks.match("bad!u@evil.net")
+    assert masks.match("zoe!joe@host") and not masks.match("zooe!joe@host")
+    assert masks.match("exact!user@host.org") and not masks.match("exact!user@host.org.uk")
+    assert masks.match("nick!u@h", account="Troll") and not masks.match("nick!u@h")
+    assert not masks.match("good!user@example.com")
+    # rfc1459 lowercase, [] are {}
+    masks.add("nick[away]")
+    assert masks.match("NICK{AWAY}!u@h")
+    assert masks.discard("FOSSBOT") and not masks.match("fossbot!bot@anywhere")
+    assert not masks.discard("fossbot")
+    # runs of stars are one star, and many stars don't backtrack for ages
+    import time
+    from fnmatch import fnmatchcase
+    assert normalize("**x***") == "*x*!*@*"
+    starry = MaskSet(["*" * 12 + "x!*@*", "*a*b*c*d*e*!*@*", "?*?*?*?*z!u@h"])
+    start = time.time()
+    assert not starry.match("innocent" * 8 + "!user@some.where.org")
+    assert starry.match("onex!u@h") and starry.match("-a-b-c-d-e-!u@h")
+    assert starry.match("q1w2z!u@h") and not starry.match("q1wz!u@h")
+    assert time.time() - start < 0.1
+    for mask, text in [("*a*b", "xaxb"), ("*a*b", "xaxbx"), ("a*", "a"), ("*", ""),
+                       ("?", ""), ("a?c*", "abcde"), ("*?*?", "x"), ("*b*b*", "abab")]:
+        assert glob_match(mask, text) == fnmatchcase(text, mask), (mask, text)
+
+    # Benchmark against trying every mask
+    import timeit
+    many = MaskSet()
+    for i in xrange(5000):
+        many.add("*!*@host%d.example.com" % i)     # plain hosts
+        many.add("spammer%d" % i)                   # plain nicks
+        many.add("*!bot%d@*.cloud%d.net" % (i, i))  # wildcards
+    plain = list(many.masks)
+    source = "innocent!user@some.where.org"
+    assert not many.match(source) and many.match("x!bot42@a.cloud42.net")
+    t_set = min(timeit.repeat(lambda: many.match(source), number=100, repeat=3)) / 100
+    t_loop = min(timeit.repeat(lambda: any(fnmatchcase(source, m) for m in plain),
+                               number=3, repeat=3)) / 3
+    print "%d masks: %.1fus per match, %.1fms trying each one" % (
+        len(many), t_set * 1e6, t_loop * 1e3)
+    print "Everything in order"
@@ -0,0 +1,279 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Metadata of media files from their first few bytes
+
+Links to images, documents and audio or video files are described by
+what their headers carry, so only the start of the file has to be
+fetched, with a Range request.
+
+    images:  PNG, GIF, JPEG, WebP, BMP dimensions
+    PDF:     the document title, when its info is near the start
+    audio,
+    video:   MP4 (when the moov box comes first), WAV and FLAC duration
+"""
+
+import re
+import struct
+from collections import namedtuple
+
+MediaInfo = namedtuple('MediaInfo', 'format width height duration title')
+MediaInfo.__new__.__defaults__ = (None, None, None, None)
+
+# JPEG start of frame markers, the ones that carry the dimensions
+jpeg_sof = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+pdf_title = re.compile(r"/Title\s*(?:\(((?:\\.|[^\\)])*)\)|<([0-9A-Fa-f\s]*)>)", re.DOTALL)
+pdf_escapes = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f'}
+
+
+def read_prefix(chunks, max_bytes):
+    """Join chunks until there are max_bytes of them"""
+    data = []
+    read = 0
+    for chunk in chunks:
+        data.append(chunk)
+        read += len(chunk)
+        if read >= max_bytes:
+            break
+    return b"".join(data)[:max_bytes]
+
+
+def total_size(headers):
+    """Size of the whole file from the headers of a response, or None"""
+    content_range = headers.get('content-range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+    elif not content_range:
+        total = headers.get('content-length', '')
+    else:
+        return None
+    return int(total) if total.isdigit() else None
+
+
+def image_info(data):
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return MediaInfo("PNG", width, height)
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        width, height = struct.unpack("<HH", data[6:10])
+        return MediaInfo("GIF", width, height)
+    if data[:2] == b"BM" and len(data) >= 26:
+        if struct.unpack("<I", data[14:18])[0] == 12:
+            width, height = struct.unpack("<HH", data[18:22])
+        else:
+            width, height = struct.unpack("<ii", data[18:26])
+        return MediaInfo("BMP", width, abs(height))
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return MediaInfo("WebP", width & 0x3fff, height & 0x3fff)
+        if chunk == b"VP8L":
+            bits = struct.unpack("<I", data[21:25])[0]
+            return MediaInfo("WebP", (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+        if chunk == b"VP8X":
+            width = struct.unpack("<I", data[24:27] + b"\0")[0] + 1
+            height = struct.unpack("<I", data[27:30] + b"\0")[0] + 1
+            return MediaInfo("WebP", width, height)
+    if data[:2] == b"\xff\xd8":
+        return jpeg_info(data)
+    return None
+
+
+def jpeg_info(data):
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != b"\xff":
+            return None
+        marker = ord(data[i + 1])
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in jpeg_sof:
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return MediaInfo("JPEG", width, height)
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            i += 2
+        else:
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+
+def pdf_info(data):
+    if not data.startswith(b"%PDF-"):
+        return None
+    title = None
+    m = pdf_title.search(data)
+    if m:
+        if m.group(1) is not None:
+            raw = re.sub(r"\\([0-7]{1,3}|.)", unescape_pdf, m.group(1))
+        else:
+            raw = "".join(m.group(2).split())
+            raw = (raw + "0" * (len(raw) % 2)).decode('hex')
+        if raw.startswith(b"\xfe\xff"):
+            title = raw[2:].decode('utf-16-be', 'replace')
+        else:
+            title = raw.decode('latin-1')
+        title = title.strip() or None
+    return MediaInfo("PDF", title=title)
+
+
+def unescape_pdf(m):
+    escape = m.group(1)
+    if escape[0] in "01234567":
+        return chr(int(escape, 8) & 0xff)
+    return pdf_escapes.get(escape, escape)
+
+
+def boxes(data, start=0, end=None):
+    """Iterate over the (type, data start, data end) of MP4 boxes"""
+    end = len(data) if end is None else end
+    i = start
+    while i + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[i:i + 8])
+        header = 8
+        if size == 1:
+            if i + 16 > end:
+                return
+            size = struct.unpack(">Q", data[i + 8:i + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - i
+        if size < header:
+            return
+        yield kind, i + header, i + size
+        i += size
+
+
+def mp4_info(data):
+    if data[4:8] != b"ftyp":
+        return None
+    for kind, start, end in boxes(data):
+        if kind == b"moov":
+            for kind, start, end in boxes(data, start, min(end, len(data))):
+                if kind == b"mvhd" and start + 32 <= len(data):
+                    if data[start] == b"\x01":
+                        timescale, duration = struct.unpack(">IQ", data[start + 20:start + 32])
+                    else:
+                        timescale, duration = struct.unpack(">II", data[start + 12:start + 20])
+                    if timescale:
+                        return MediaInfo("MP4", duration=float(duration) / timescale)
+    return MediaInfo("MP4")
+
+
+def wav_info(data):
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    byte_rate = None
+    i = 12
+    while i + 8 <= len(data):
+        kind, size = struct.unpack("<4sI", data[i:i + 8])
+        if kind == b"fmt " and i + 20 <= len(data):
+            byte_rate = struct.unpack("<I", data[i + 16:i + 20])[0]
+        elif kind == b"data":
+            if byte_rate:
+                return MediaInfo("WAV", duration=float(size) / byte_rate)
+            break
+        i += 8 + size + (size & 1)
+    return MediaInfo("WAV")
+
+
+def flac_info(data):
+    if data[:4] != b"fLaC":
+        return None
+    if len(data) >= 26 and ord(data[4]) & 0x7f == 0:
+        # STREAMINFO: 20 bits sample rate, 8 bits of channels and
+        # sample size, 36 bits of total samples
+        bits = struct.unpack(">Q", data[18:26])[0]
+        rate, samples = bits >> 44, bits & 0xfffffffff
+        if rate and samples:
+            return MediaInfo("FLAC", duration=float(samples) / rate)
+    return MediaInfo("FLAC")
+
+
+probes = (image_info, pdf_info, mp4_info, wav_info, flac_info)
+
+
+def probe(data):
+    """Return the MediaInfo of the start of a file, or None"""
+    for function in probes:
+        try:
+            info = function(data)
+        except (struct.error, ValueError, TypeError):
+            info = None
+        if info:
+            return info
+    return None
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024.0
+    return ("%d%s" if unit == "B" else "%.1f%s") % (size, unit)
+
+
+def human_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+
+def describe(info, content_type=None, size=None):
+    """Describe a file in a few words, with whatever we know of it"""
+    parts = []
+    if info:
+        parts.append(info.format)
+        if info.width and info.height:
+            parts.append("%dx%d" % (info.width, info.height))
+        if info.duration:
+            parts.append(human_duration(info.duration))
+        if info.title:
+            parts.append(u'"%s"' % info.title)
+    elif content_type:
+        parts.append(content_type)
+    if size is not None:
+        parts.append(human_size(size))
+    return u", ".join(parts) or None
+
+
+if __name__ == '__main__':
+    # Test every format with hand made headers
+    png = b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR" + struct.pack(">II", 800, 600)
+    assert probe(png) == MediaInfo("PNG", 800, 600)
+    assert probe(b"GIF89a" + struct.pack("<HH", 16, 32)) == MediaInfo("GIF", 16, 32)
+    bmp = b"BM" + b"\0" * 12 + struct.pack("<Iii", 40, 640, -480)
+    assert probe(bmp) == MediaInfo("BMP", 640, 480)
+    webp = b"RIFF\0\0\0\0WEBPVP8X" + b"\0" * 8 + b"\x1f\x03\0\xdf\x01\0"
+    assert probe(webp) == MediaInfo("WebP", 800, 480)
+    jpeg = (b"\xff\xd8\xff\xe0" + struct.pack(">H", 16) + b"JFIF" + b"\0" * 10 +
+            b"\xff\xc0\0\x11\x08" + struct.pack(">HH", 1080, 1920))
+    assert probe(jpeg) == MediaInfo("JPEG", 1920, 1080)
+    pdf = b"%PDF-1.4\n1 0 obj << /Title (Caf\\351 \\(draft\\)) >>"
+    assert probe(pdf).title == u"Caf\xe9 (draft)"
+    pdf = b"%PDF-1.7\n<< /Title <FEFF00480069> >>"
+    assert probe(pdf).title == u"Hi"
+    mvhd = b"\0" * 12 + struct.pack(">II", 1000, 95000) + b"\0" * 80
+    mp4 = (struct.pack(">I", 16) + b"ftypisom" + b"\0" * 4 +
+           struct.pack(">I", len(mvhd) + 16) + b"moov" +
+           struct.pack(">I", len(mvhd) + 8) + b"mvhd" + mvhd)
+    assert probe(mp4) == MediaInfo("MP4", duration=95.0)
+    wav = (b"RIFF\0\0\0\0WAVEfmt " + struct.pack("<IHHIIHH", 16, 1, 2, 44100, 176400, 4, 16) +
+           b"data" + struct.pack("<I", 176400 * 61))
+    assert probe(wav) == MediaInfo("WAV", duration=61.0)
+    flac = b"fLaC\0\0\0\x22" + b"\0" * 10 + struct.pack(">Q", (48000 << 44) | 48000 * 3600)
+    assert probe(flac) == MediaInfo("FLAC", duration=3600.0)
+    assert probe(b"garbage") is None and probe(b"") is None
+    assert probe(b"\xff\xd8\xff\xe0\0") is None
+
+    assert describe(probe(png), "image/png", 2500000) == u"PNG, 800x600, 2.4MB"
+    assert describe(probe(flac)) == u"FLAC, 1:00:00"
+    assert describe(None, "application/zip", 500) == u"application/zip, 500B"
+    assert total_size({'content-range': 'bytes 0-99/12345'}) == 12345
+    assert total_size({'content-range': 'bytes 0-99/*'}) is None
+    assert total_size({'content-length': '42'}) == 42
+    assert read_prefix(iter(["abc", "def", "ghi"]), 5) == "abcde"
+    print "Everything in order"
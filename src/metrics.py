@@ -0,0 +1,42 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Registry of runtime metrics for the bot
+
+Anything that keeps counters can register a provider, a function
+returning a dict of its current values, under a name.
+The admin `metrics` command shows them all.
+"""
+
+from collections import OrderedDict
+
+providers = OrderedDict()
+
+
+def register(name, provider):
+    """Register a function returning a dict of metrics under name"""
+    providers[name] = provider
+
+
+def unregister(name):
+    providers.pop(name, None)
+
+
+def snapshot():
+    """Return the current metrics of all providers"""
+    return OrderedDict((name, provider()) for name, provider in providers.items())
+
+
+def format_metrics(name, values):
+    """Format a provider's metrics to a single line"""
+    items = " ".join("%s=%s" % (k, values[k]) for k in sorted(values))
+    return "%s: %s" % (name, items)
+
+
+if __name__ == '__main__':
+    register("test", lambda: {'b': 2, 'a': 1})
+    snap = snapshot()
+    assert snap == {'test': {'a': 1, 'b': 2}}
+    assert format_metrics("test", snap['test']) == "test: a=1 b=2"
+    unregister("test")
+    assert snapshot() == {}
+    print "Everything in order"
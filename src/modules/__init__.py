@@ -13,7 +13,7 @@ Base classes live in the 'basemodule' file.
 
 # define modules to get functionality from
 system_mods = ["ignore", "basiccmds", "update", "help"]
-user_mods = ["fail", "weather", "dnd", "urlparser"]
+user_mods = ["fail", "weather", "dnd", "urlparser", "search", "seen", "remind", "tell"]
 final_mods = []
 
 active = system_mods + user_mods + final_mods
@@ -30,6 +30,7 @@ For an example, look at the `basiccmds` module.
 
 import logging
 from logsetup import escape as esc
+from storage import Namespace
 
 
 class BaseContext(object):
@@ -203,6 +204,8 @@ class BaseModule(object):
     ---------------------
     bot:    The bot we are a part of.
     logger: The logger we should be using.
+    http:   The bot's HTTP client. Use it for all HTTP requests.
+    store:  What the module remembers between runs, by key.
     
     Usage:
     ------
@@ -210,6 +213,15 @@ class BaseModule(object):
     If you need to init state, you can use the hook method `init`.
     Send text through the `send` method. Handy for messages that are not
     the result of an event, perhaps responding to a timer.
+    Run anything that blocks, like network requests, through `defer`.
+    Run something later with `self.bot.timers.schedule`, which returns a
+    timer you can cancel.
+    To follow what goes on in the channels, override the observer hooks
+    `on_message`, `on_join`, `on_part`, `on_quit` and `on_nick`.
+    Look back at what was said before with `history`.
+    Keep anything that should survive a restart in `store`, with its
+    get, set, delete, incr and compare_and_set methods. Writes are
+    cached and saved in the background, so it's fine on every message.
     """
     
     context_class = BaseContext
@@ -217,6 +229,7 @@ class BaseModule(object):
     def __init__(self, bot):
         self.bot = bot
         self.logger = logging.getLogger(self.__module__)
+        self.store = Namespace(bot.storage, self.__module__.rpartition(".")[2])
         self.init()
         
     def init(self):
@@ -242,6 +255,34 @@ class BaseModule(object):
         context = self.context_class(connection, event, self)
         return context.do_private()
     
+    # Observer hooks. Every module gets these events, whether or not
+    # another module handles them, and can't stop them. Only events
+    # of users a module says are ignored don't get here.
+
+    def is_ignored(self, connection, event):
+        """Whether the observers shouldn't hear of the user behind event"""
+        return False
+
+    def on_message(self, connection, event):
+        """Called for every public message, before it is dispatched"""
+        pass
+
+    def on_join(self, connection, event):
+        """Called when someone, the bot included, joins a channel"""
+        pass
+
+    def on_part(self, connection, event):
+        """Called when someone leaves a channel"""
+        pass
+
+    def on_quit(self, connection, event):
+        """Called when someone quits IRC"""
+        pass
+
+    def on_nick(self, connection, event):
+        """Called when someone changes nick"""
+        pass
+
     def send(self, target, msgformat, *args, **kargs):
         """
         Send a formatted message to target.
@@ -261,5 +302,28 @@ class BaseModule(object):
                 line = " "
             connection.privmsg(target, line)
     
+    def defer(self, function, args=(), callback=None):
+        """
+        Run function(*args) in one of the bot's worker threads.
+
+        The optional callback(result, error) is run back on the reactor
+        thread when the function returns. error is the exception the
+        function raised, if any.
+        """
+        self.bot.workers.submit(function, args, callback)
+
+    def history(self, channel, nick=None):
+        """
+        Iterate over the recent lines of a channel, newest first.
+
+        Lines are (time, nick, text) tuples, only those of nick if given.
+        The line being handled isn't in it yet.
+        """
+        return self.bot.history.lines(channel, nick)
+
+    @property
+    def http(self):
+        return self.bot.http
+
     def is_admin(self, username):
         return self.bot.admins.is_admin(username)
@@ -8,6 +8,10 @@ serves as an example of how to build a module for fidibot.
 # As such, be sure to spend extra care while developing,
 # so it is always clean and understandable ;)
 
+import logging
+import metrics
+from collections import Counter
+from logsetup import error_records, filter_error_records, exception_name
 from basemodule import BaseModule, BaseCommandContext
 from alternatives import _
 
@@ -100,20 +104,83 @@ class BasicCommandsContext(BaseCommandContext):
             self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "crash"))
 
     def cmd_error_private(self, argument):
-        """Print the last lines of the error log"""
+        """
+        Print the last lines of the error log
+
+        Usage: error [lines|count] [level:<level>] [logger:<name>]
+        [since:<time>] [until:<time>]
+        Times are in the log's format, or a prefix of it, ie. 2015-03-01
+        """
         if self.is_admin:
-            if argument.isdigit():
-                n = min(int(argument), 50)
-            else:
-                n = 5
-            with open("log/errors.log") as f:
-                lines = f.readlines()
-            err = "".join(lines[-n:]).rstrip()
+            n = 5
+            count = False
+            filters = {}
+            for token in argument.split():
+                key, sep, value = token.partition(':')
+                if token.isdigit():
+                    n = min(int(token), 50)
+                elif token.lower() == 'count':
+                    count = True
+                elif sep and key in ('since', 'until'):
+                    # ISO times, ie. 2015-03-01T12:00
+                    filters[key] = value.replace('T', ' ')
+                elif sep and key in ('level', 'logger'):
+                    filters[key] = value
+            level = filters.get('level')
+            if level and not isinstance(logging.getLevelName(level.upper()), int):
+                self.send(self.target, _("There's no level %s"), level)
+                return
+            try:
+                records = filter_error_records(error_records(), **filters)
+                if count:
+                    err = self._count_errors(records)
+                else:
+                    err = self._last_errors(records, n)
+            except IOError as e:
+                self.logger.warning(e)
+                return
             if err:
                 self.send(self.target, "%s", err)
         else:
             self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "error"))
 
+    def _last_errors(self, records, n):
+        lines = []
+        for asctime, level, name, msg_lines in records:
+            record_lines = ["%s %-8s %-10s  %s" % (asctime, level, name, msg_lines[0])]
+            record_lines.extend(msg_lines[1:])
+            lines[:0] = record_lines
+            if len(lines) >= n:
+                break
+        return "\n".join(lines[-n:]).rstrip()
+
+    def _count_errors(self, records):
+        counts = Counter(exception_name(r) for r in records)
+        return "\n".join("%4dx %s" % (c, exc) for exc, c in counts.most_common(10))
+
+    def cmd_metrics_private(self, argument):
+        """Print the bot's metrics, optionally only the named ones"""
+        if self.is_admin:
+            snapshot = metrics.snapshot()
+            names = argument.split() or snapshot.keys()
+            lines = [metrics.format_metrics(name, snapshot[name])
+                     for name in names if name in snapshot]
+            if lines:
+                self.send(self.target, "%s", "\n".join(lines))
+            else:
+                self.send(self.target, _("No metrics found"))
+        else:
+            self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "metrics"))
+
+    def cmd_lag_private(self, argument):
+        """Print how lagged the bot is, and send a ping to measure it again"""
+        if self.is_admin:
+            self.send(self.target, _("%s, %d held back"), self.bot.lag.describe(),
+                      self.bot.shed + len(self.bot.deferred))
+            self.bot.lag.ping(self.connection)
+        else:
+            self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "lag"))
+
     # hide commands from help
     cmd_enable_private.hidden = True
     cmd_disable_private.hidden = True
@@ -123,6 +190,8 @@ class BasicCommandsContext(BaseCommandContext):
     cmd_die_private.hidden = True
     cmd_crash_private.hidden = True
     cmd_error_private.hidden = True
+    cmd_metrics_private.hidden = True
+    cmd_lag_private.hidden = True
 
 
 class BasicCommandsModule(BaseModule):
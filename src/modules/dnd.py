@@ -1,10 +1,26 @@
 # Author: John Giannakopoulos <giannakopoulosj@gmail.com>
 
-import random        
+import re
+import random
+import dice
 from basemodule import BaseModule, BaseCommandContext
 
 from alternatives import _
 
+# rolls for the stats command
+default_trials = 10000
+max_trials = 100000
+
+trials_regex = re.compile(r"\s+x(\d+)$", re.IGNORECASE)
+compare_regex = re.compile(r"\s*(>=|<=|==|=|>|<)\s*(-?\d+)$")
+
+def checked(function, *args):
+    """Run function, returning a DiceError instead of raising it"""
+    try:
+        return function(*args)
+    except dice.DiceError as e:
+        return e
+
 class dndContext(BaseCommandContext):
 
     def cmd_roll(self, argument):
@@ -12,8 +28,67 @@ class dndContext(BaseCommandContext):
         Rolling D&D style
         
         Usage: roll attack|save modifiers difficulty
+        or:    roll expression, ie. roll 4d6kh3+2, roll d20adv, roll 2d6!
         """
-        
+        words = argument.split()
+        if words and words[0].isalpha() and words[0].lower() not in ("adv", "dis"):
+            return self.roll_check(argument)
+        try:
+            total, rolled = dice.roll(argument or "d20")
+        except dice.DiceError as e:
+            self.send(self.target, _("DM: %s"), e)
+            return
+        self.send(self.target, _("You roll %s = %s"), rolled, total)
+
+    def cmd_stats(self, argument):
+        """
+        Roll a dice expression many times and show how it went
+
+        Usage: stats expression [xTIMES], ie. stats 4d6kh3 x50000
+        """
+        m = trials_regex.search(argument)
+        trials = min(int(m.group(1)), max_trials) if m else default_trials
+        expression = argument[:m.start()] if m else argument
+        if not expression.strip() or not trials:
+            self.send(self.target, _("DM: Read The Freaking PHB"))
+            return
+        def announce(result, error):
+            if error or isinstance(result, dice.DiceError):
+                self.send(self.target, _("DM: %s"), error or result)
+                return
+            mean, sd, low, high = result
+            self.send(self.target, "%d rolls of %s: mean %.2f, sd %.2f, min %d, max %d",
+                      trials, expression.strip(), mean, sd, low, high)
+        self.module.defer(checked, (dice.stats, expression, trials), announce)
+
+    def cmd_odds(self, argument):
+        """
+        Work out the exact odds of a dice expression
+
+        Usage: odds expression [>= number], ie. odds 2d20kh1+5 >= 15
+        """
+        m = compare_regex.search(argument)
+        expression = argument[:m.start()] if m else argument
+        if not expression.strip():
+            self.send(self.target, _("DM: Read The Freaking PHB"))
+            return
+        def announce(dist, error):
+            if error or isinstance(dist, dice.DiceError):
+                self.send(self.target, _("DM: %s"), error or dist)
+                return
+            low, high = dist.range()
+            mode, chance = dist.mode()
+            text = "%s: mean %.2f, sd %.2f, range %d-%d, most likely %d (%.2f%%)" % (
+                expression.strip(), dist.mean(), dist.sd(), low, high, mode, chance * 100)
+            if m:
+                compare, target = m.group(1), int(m.group(2))
+                text += ", chance of %s %d: %.2f%%" % (compare, target,
+                                                      dist.chance(compare, target) * 100)
+            self.send(self.target, "%s", text)
+        self.module.defer(checked, (dice.dist, expression), announce)
+
+    def roll_check(self, argument):
+        """Roll a d20 attack or save against a difficulty"""
         # Analyze Arguments
         argument = argument.split()
         try:
@@ -2,35 +2,208 @@
 """
 Module to ignore certain users
 
-Just a simple list based ignore.
+Users are ignored by `nick!user@host` masks with wildcards, or by
+their services account as `$a:account`, everywhere or in one channel.
+See the masks module for how matching works.
 Place this module early in the active chain.
-If the user matches, the message will stop right there.
+If the user matches, the message will stop right there, and no module
+observes what they do, messages, joins, parts, quits and nick changes.
+
+Admins can edit the list in private with ignore, unignore and ignores.
+It is saved in ignore_file. What they say in private is never ignored,
+so a mask that covers them can't lock them out of unignore.
+
+Accounts are only known from WHOIS replies, and the bot only asks who
+a user is when they talk to it, so not everyone who speaks costs a
+WHOIS. Until the reply, their messages are let through.
 """
 
-from basemodule import BaseModule, BaseContext
+import os
+import json
+from fnmatch import fnmatchcase
+from irc.strings import lower
+from masks import MaskSet, normalize, matches_everyone
+from tools import Throttle
+from basemodule import BaseModule, BaseCommandContext
 
+from alternatives import _
 
-ignore_list = ('fossbot', 'fossbot_')
+ignore_file = "data/ignore.json"
+# ignored when there's no ignore file yet
+default_masks = ('fossbot', 'fossbot_')
 ignore_startswith ='!@'
+# most entries listed by the ignores command
+max_listed = 20
+
+
+class IgnoreList(object):
+    """Global and per channel masks, saved to a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        # channel, or None for global -> MaskSet
+        self.scopes = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                entries = json.load(f)
+        else:
+            entries = [[mask, None] for mask in default_masks]
+        for mask, channel in entries:
+            self.scopes.setdefault(channel, MaskSet()).add(mask)
+
+    def save(self):
+        entries = self.entries()
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(entries, f, indent=1)
+        os.rename(temp, self.path)
+
+    def entries(self):
+        """Return every [mask, channel], global ones first"""
+        return [[mask, channel] for channel in sorted(self.scopes)
+                for mask in sorted(self.scopes[channel].masks)]
+
+    def add(self, mask, channel=None):
+        """Add a mask, returning its normalized form, or None if it was there"""
+        channel = lower(channel) if channel else None
+        masks = self.scopes.setdefault(channel, MaskSet())
+        if mask in masks:
+            return None
+        mask = masks.add(mask)
+        self.save()
+        return mask
+
+    def remove(self, mask, channel=None):
+        channel = lower(channel) if channel else None
+        masks = self.scopes.get(channel)
+        if not masks or not masks.discard(mask):
+            return False
+        if not masks:
+            del self.scopes[channel]
+        self.save()
+        return True
+
+    def has_accounts(self):
+        return any(mask.startswith("$a:") for masks in self.scopes.itervalues()
+                   for mask in masks.masks)
+
+    def match(self, source, channel=None, account=None):
+        masks = self.scopes.get(None)
+        if masks and masks.match(source, account):
+            return True
+        masks = self.scopes.get(lower(channel)) if channel else None
+        return bool(masks and masks.match(source, account))
 
-class IgnoreContext(BaseContext):
+
+class IgnoreContext(BaseCommandContext):
 
     def do_public(self):
         if self.input[0] in ignore_startswith:
             return True
-        return self._do()
+        if self._do():
+            return True
+        return super(IgnoreContext, self).do_public()
 
     def do_private(self):
-        return self._do()
+        if not self.is_admin and self._do():
+            return True
+        return super(IgnoreContext, self).do_private()
+
+    def _addressed(self):
+        """Whether the line could be a command to the bot"""
+        if self.target != self.channel:
+            return True
+        tokens = self.input.split(None, 1)
+        return len(tokens) == 2 and self.bot.callsign in tokens[0].lower()
 
     def _do(self):
-        if self.nick in ignore_list:
+        account = None
+        if self.module.account_masks:
+            account = self.bot.accounts.get(lower(self.nick))
+            if (account is None and self._addressed() and
+                    not self.module.whois_throttle.is_throttled(lower(self.nick))):
+                self.connection.whois(self.nick)
+        channel = self.channel if self.target == self.channel else None
+        if self.module.ignores.match(self.event.source, channel, account):
             return True
         else:
             return False
 
+    def _mask_and_channel(self, argument):
+        words = argument.split()
+        if len(words) == 1:
+            return words[0], None
+        if len(words) == 2 and words[1].startswith("#"):
+            return words[0], words[1]
+        return None, None
+
+    def cmd_ignore_private(self, argument):
+        """Ignore a nick!user@host mask or a $a:account, everywhere or in a channel"""
+        if self.is_admin:
+            mask, channel = self._mask_and_channel(argument)
+            if not mask:
+                self.send(self.nick, _("Usage: ignore mask [#channel]"))
+                return
+            if matches_everyone(mask):
+                self.send(self.nick, _("%s would ignore everyone"), normalize(mask))
+                return
+            added = self.module.ignores.add(mask, channel)
+            self.module.account_masks = self.module.ignores.has_accounts()
+            if added:
+                self.send(self.nick, _("Ignoring %s in %s"), added, channel or "all channels")
+                self.logger.info("User %s ignored %s in %s" % (self.nick, added, channel or "all channels"))
+            else:
+                self.send(self.nick, _("Already ignoring %s"), normalize(mask))
+        else:
+            self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "ignore"))
+
+    def cmd_unignore_private(self, argument):
+        """Stop ignoring a mask, everywhere or in a channel"""
+        if self.is_admin:
+            mask, channel = self._mask_and_channel(argument)
+            if not mask:
+                self.send(self.nick, _("Usage: unignore mask [#channel]"))
+                return
+            if self.module.ignores.remove(mask, channel):
+                self.module.account_masks = self.module.ignores.has_accounts()
+                self.send(self.nick, _("Not ignoring %s anymore"), normalize(mask))
+                self.logger.info("User %s unignored %s in %s" % (self.nick, normalize(mask), channel or "all channels"))
+            else:
+                self.send(self.nick, _("I wasn't ignoring %s"), normalize(mask))
+        else:
+            self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "unignore"))
+
+    def cmd_ignores_private(self, argument):
+        """List the ignored masks matching a wildcard pattern, or all of them"""
+        if self.is_admin:
+            pattern = argument.strip()
+            entries = self.module.ignores.entries()
+            if pattern:
+                entries = [e for e in entries if fnmatchcase(e[0], lower(pattern))]
+            for mask, channel in entries[:max_listed]:
+                self.send(self.nick, "%s %s", mask, channel or "")
+            if len(entries) > max_listed:
+                self.send(self.nick, _("and %d more"), len(entries) - max_listed)
+            elif not entries:
+                self.send(self.nick, _("Not ignoring anyone"))
+        else:
+            self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "ignores"))
+
 
 class IgnoreModule(BaseModule):
     context_class = IgnoreContext
 
+    def init(self):
+        self.ignores = IgnoreList(ignore_file)
+        self.account_masks = self.ignores.has_accounts()
+        self.whois_throttle = Throttle(10 * 60)
+
+    def is_ignored(self, connection, event):
+        account = self.bot.accounts.get(lower(event.source.nick)) if self.account_masks else None
+        channel = event.target if event.target and event.target.startswith("#") else None
+        return self.ignores.match(event.source, channel, account)
+
 module = IgnoreModule
@@ -0,0 +1,182 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Module for reminders that survive restarts
+
+Reminders are kept in the module's store and scheduled on the bot's
+timer wheel, so after a restart or an update every pending one is
+scheduled again. Those that came due while the bot was away, or not
+in their channel, are delivered as soon as it's back there, saying how
+late they are.
+"""
+
+import re
+import time
+from irc.strings import lower
+from tools import parse_duration, human_delta
+from basemodule import BaseModule, BaseCommandContext
+from alternatives import _
+import metrics
+
+# most pending reminders a nick can set, and in all
+max_per_nick = 20
+max_reminders = 5000
+# longest a reminder can be set for
+max_delay = 365 * 86400
+# say how late a reminder is when it's later than that, in seconds
+late_after = 60
+
+remind_regex = re.compile(r"^(\S+)\s+(?:in\s+)?((?:\d+\s*[smhdw]\s*)+)\s+(?:to\s+)?(\S.*)$",
+                          re.IGNORECASE)
+
+# a reminder is [when, target, setter, nick, text], where target is
+# the channel it was set in, or the nick it is for when set privately
+WHEN, TARGET, SETTER, NICK, TEXT = range(5)
+
+
+class RemindContext(BaseCommandContext):
+
+    def cmd_remind(self, argument):
+        """
+        Remind you or someone else of something later
+
+        Usage: remind me|nick [in] 1h30m [to] text
+        Units are s, m, h, d and w.
+        """
+        m = remind_regex.match(argument.strip())
+        delay = parse_duration(m.group(2)) if m else None
+        if not delay:
+            self.send(self.target, _("Usage: remind me|nick [in] 1h30m [to] text"))
+            return
+        if delay > max_delay:
+            self.send(self.target, _("That's too far away, %s"), self.nick)
+            return
+        who, text = m.group(1), m.group(3)
+        nick = self.nick if lower(who) == "me" else who
+        mine = self.module.of(self.nick)
+        if len(mine) >= max_per_nick or len(self.module.reminders) >= max_reminders:
+            self.send(self.target, _("I have too much to remember already, %s"), self.nick)
+            return
+        # private reminders go to whoever they're for
+        target = nick if self.target == self.nick else self.target
+        self.module.add([time.time() + delay, target, self.nick, nick, text])
+        if nick == self.nick:
+            self.send(self.target, _("I'll remind you in %s, %s"), human_delta(delay), self.nick)
+        else:
+            self.send(self.target, _("I'll remind %s in %s, %s"), nick, human_delta(delay), self.nick)
+
+    def cmd_reminders(self, argument):
+        """List the reminders you've set"""
+        mine = self.module.of(self.nick)
+        if not mine:
+            self.send(self.target, _("You haven't set any reminders, %s"), self.nick)
+            return
+        now = time.time()
+        self.send(self.target, "%s", "\n".join(
+            "#%s in %s for %s: %s" % (rid, human_delta(r[WHEN] - now), r[NICK], r[TEXT])
+            for rid, r in mine))
+
+    def cmd_unremind(self, argument):
+        """
+        Cancel a reminder you've set, or all of them
+
+        Usage: unremind number|all
+        """
+        mine = dict(self.module.of(self.nick))
+        rid = argument.strip().lstrip("#")
+        if rid.lower() == "all":
+            ids = mine.keys()
+        elif rid in mine:
+            ids = [rid]
+        else:
+            self.send(self.target, _("You have no reminder %s, %s"), argument, self.nick)
+            return
+        for rid in ids:
+            self.module.remove(rid)
+        self.send(self.target, _("Forgot %d of your reminders, %s"), len(ids), self.nick)
+
+
+class RemindModule(BaseModule):
+    context_class = RemindContext
+
+    def init(self):
+        # reminders by id, as strings to be keys in JSON
+        self.reminders = dict(self.store.get("reminders", {}))
+        self.timers = {}
+        # ids of reminders due while we couldn't deliver them
+        self.held = set()
+        self.delivered = self.late = 0
+        for rid, reminder in self.reminders.iteritems():
+            self.timers[rid] = self.bot.timers.schedule_at(reminder[WHEN], self.due, rid)
+        if self.reminders:
+            self.logger.info("Scheduled %d reminders again", len(self.reminders))
+        metrics.register("remind", self.stats)
+
+    def stats(self):
+        return {'pending': len(self.reminders), 'held': len(self.held),
+                'delivered': self.delivered, 'late': self.late}
+
+    def _save(self):
+        # a copy, the store writes it from another thread
+        self.store.set("reminders", dict(self.reminders))
+
+    def of(self, nick):
+        """The (id, reminder) pairs nick has set, soonest first"""
+        return sorted(((rid, r) for rid, r in self.reminders.iteritems()
+                       if lower(r[SETTER]) == lower(nick)),
+                      key=lambda item: item[1][WHEN])
+
+    def add(self, reminder):
+        rid = str(self.store.incr("next_id"))
+        self.reminders[rid] = reminder
+        self.timers[rid] = self.bot.timers.schedule_at(reminder[WHEN], self.due, rid)
+        self._save()
+        return rid
+
+    def remove(self, rid):
+        timer = self.timers.pop(rid, None)
+        if timer:
+            timer.cancel()
+        self.held.discard(rid)
+        if self.reminders.pop(rid, None) is not None:
+            self._save()
+
+    def _can_deliver(self, target):
+        # being in a channel means we're connected and registered too
+        if not self.bot.connection.is_connected() or not self.bot.channels:
+            return False
+        return not target.startswith("#") or target in self.bot.channels
+
+    def due(self, rid):
+        self.timers.pop(rid, None)
+        reminder = self.reminders.get(rid)
+        if reminder is None:
+            return
+        if self._can_deliver(reminder[TARGET]):
+            self.deliver(rid)
+        else:
+            self.held.add(rid)
+
+    def deliver(self, rid):
+        when, target, setter, nick, text = self.reminders[rid]
+        if lower(setter) == lower(nick):
+            line = _("%s, you asked me to remind you: %s") % (nick, text)
+        else:
+            line = _("%s, %s asked me to remind you: %s") % (nick, setter, text)
+        late = time.time() - when
+        if late > late_after:
+            line += " (%s late)" % human_delta(late)
+            self.late += 1
+        self.send(target, "%s", line)
+        self.delivered += 1
+        self.remove(rid)
+
+    def on_join(self, connection, event):
+        if event.source.nick != connection.get_nickname() or not self.held:
+            return
+        # we're back, catch up on what came due meanwhile
+        for rid in sorted(self.held, key=lambda rid: self.reminders[rid][WHEN]):
+            if self._can_deliver(self.reminders[rid][TARGET]):
+                self.deliver(rid)
+
+
+module = RemindModule
@@ -0,0 +1,117 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Module for searching the channel history
+
+The channel logs are indexed in the background, see logindex.
+"""
+
+import time
+from logindex import LogIndex, LogIndexer
+from basemodule import BaseModule, BaseCommandContext
+from alternatives import _
+
+alternatives_dict = {
+}
+
+db_path = "data/history.db"
+log_path = "log/moolog/moobot.log"
+page_size = 5
+# last page there is to ask for
+max_page = 1000
+
+filters = {
+    'nick': 'nick',
+    'chan': 'channel',
+    'channel': 'channel',
+    'since': 'since',
+    'from': 'since',
+    'until': 'until',
+    'to': 'until',
+    'page': 'page',
+}
+
+
+def parse_date(value, end=False):
+    """Parse a YYYY-MM-DD date to a timestamp. With end, to the next day"""
+    ts = int(time.mktime(time.strptime(value, "%Y-%m-%d")))
+    if end:
+        ts += 24 * 60 * 60
+    return ts
+
+
+def parse_query(argument):
+    """Split a search argument to terms and filters"""
+    terms = []
+    query = {}
+    for token in argument.split():
+        key, sep, value = token.partition(':')
+        key = filters.get(key.lower())
+        if sep and key and value:
+            query[key] = value
+        else:
+            terms.append(token)
+    if 'since' in query:
+        query['since'] = parse_date(query['since'])
+    if 'until' in query:
+        query['until'] = parse_date(query['until'], end=True)
+    query['page'] = min(max(int(query.get('page', 1)), 1), max_page)
+    return terms, query
+
+
+class SearchContext(BaseCommandContext):
+
+    def cmd_search(self, argument):
+        """
+        Search the channel history.
+
+        Usage: search [words] [nick:<nick>] [chan:<channel>]
+        [since:YYYY-MM-DD] [until:YYYY-MM-DD] [page:<n>]
+        """
+        try:
+            terms, query = parse_query(argument)
+        except (ValueError, OverflowError):
+            self.send(self.target, _("Dates are YYYY-MM-DD and pages are numbers"))
+            return
+        if not terms and len(query) == 1:
+            self.send(self.target, _("What should I search for?"))
+            return
+        def reply(found, error):
+            if error:
+                self.logger.warning("Searching for %s failed: %s", argument, error)
+                self.send(self.target, _("I can't search right now"))
+            else:
+                self.announce(found[0], found[1], query['page'])
+        # the index is on disk
+        self.module.defer(self.module.search, (terms, query), reply)
+
+    def announce(self, results, more, page):
+        """Send a page of search results"""
+        if not results:
+            self.send(self.target, _("Nothing found"))
+            return
+        lines = []
+        for dt, channel, nick, kind, text in results:
+            stamp = dt.strftime("%Y-%m-%d %H:%M")
+            if kind == 'action':
+                lines.append("%s %s * %s %s" % (stamp, channel, nick, text))
+            else:
+                lines.append("%s %s <%s> %s" % (stamp, channel, nick, text))
+        if more:
+            lines.append(_("more with page:%d") % (page + 1))
+        self.send(self.target, "%s", "\n".join(lines))
+
+
+class SearchModule(BaseModule):
+    context_class = SearchContext
+
+    def init(self):
+        # the index creates the schema, so make it before the indexer
+        self.index = LogIndex(db_path)
+        self.indexer = LogIndexer(db_path, log_path)
+        self.indexer.start()
+
+    def search(self, terms, query):
+        """Search the index, blocking. Returns (results, more)"""
+        return self.index.search(terms, page_size=page_size, **query)
+
+module = SearchModule
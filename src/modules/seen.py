@@ -0,0 +1,244 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Module that tells when a nick was last seen, and doing what
+
+Every public message, join, part, quit and nick change is recorded
+for its nick. The most recently active nicks are kept in memory, the
+rest only in data/seen.db, where every record is written behind in
+batches by a storage.Store, so recording never waits on the disk.
+
+A nick change is recorded for both nicks, so asking about an old nick
+follows it to what the nick became, and what that did last.
+"""
+
+import time
+from collections import OrderedDict
+from irc.strings import lower
+from storage import Store
+from tools import human_delta
+from basemodule import BaseModule, BaseCommandContext
+from alternatives import _
+import metrics
+
+seen_db = "data/seen.db"
+
+# nicks to keep in memory, the rest are only on disk
+max_entries = 10000
+# most characters of a message to remember
+max_text = 100
+# most nick changes to follow from the nick asked about
+max_hops = 5
+
+# a record is [nick, time, event, channel, text], where text is the
+# message, the part or quit message, or the other nick of a nick change
+NICK, TIME, EVENT, CHANNEL, TEXT = range(5)
+
+
+class SeenIndex(object):
+    """
+    The last record of every nick, by lowercased nick.
+
+    Records are written to the store and kept in memory for the
+    max_entries most recently active nicks.
+    """
+
+    def __init__(self, store, max_entries=max_entries, clock=time.time):
+        self.store = store
+        self.max_entries = max_entries
+        self.clock = clock
+        self.recent = OrderedDict()
+        self.records = self.hits = self.misses = self.evictions = 0
+
+    def record(self, nick, event, channel=None, text=None):
+        key = lower(nick)
+        if text and len(text) > max_text:
+            text = text[:max_text - 3] + "..."
+        record = [nick, self.clock(), event, channel, text]
+        self.recent.pop(key, None)
+        self.recent[key] = record
+        if len(self.recent) > self.max_entries:
+            self.recent.popitem(last=False)
+            self.evictions += 1
+        self.store.set(key, record)
+        self.records += 1
+
+    def cached(self, nick):
+        """The record of nick if it's in memory, else None"""
+        record = self.recent.get(lower(nick))
+        if record is not None:
+            self.hits += 1
+        return record
+
+    def lookup(self, nick):
+        """
+        The record of nick, or None if it was never seen.
+
+        Reads from the disk when it's not in memory, so run it in a
+        worker thread.
+        """
+        record = self.recent.get(lower(nick))
+        if record is not None:
+            self.hits += 1
+            return record
+        self.misses += 1
+        return self.store.get(lower(nick))
+
+    def chain(self, nick, hops=max_hops):
+        """
+        The records of nick and the nicks it changed to, in order.
+
+        Follows at most hops nick changes, and never the same nick twice.
+        Blocks like lookup().
+        """
+        records = []
+        visited = set()
+        while lower(nick) not in visited:
+            visited.add(lower(nick))
+            record = self.lookup(nick)
+            if record is None:
+                break
+            records.append(record)
+            if record[EVENT] != "nick" or len(records) > hops:
+                break
+            nick = record[TEXT]
+        return records
+
+    def stats(self):
+        return {'cached': len(self.recent), 'records': self.records, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+def describe(record, now):
+    """Say what a record means, ie. 'Nick was last seen 5m ago in #chan saying: hi'"""
+    nick, when, event, channel, text = record
+    ago = human_delta(now - when)
+    if event == "message":
+        return _("%s was last seen %s ago in %s saying: %s") % (nick, ago, channel, text)
+    if event == "join":
+        return _("%s was last seen %s ago joining %s") % (nick, ago, channel)
+    if event == "part":
+        return _("%s was last seen %s ago leaving %s") % (nick, ago, channel)
+    if event == "quit":
+        return _("%s was last seen %s ago quitting (%s)") % (nick, ago, text or "")
+    if event == "nick":
+        return _("%s was last seen %s ago changing nick to %s") % (nick, ago, text)
+    return _("%s was last seen %s ago changing nick from %s") % (nick, ago, text)
+
+
+def describe_chain(records, now):
+    """Say what the last of records did, and how the nick got there"""
+    changes = ["%s became %s %s ago" % (record[NICK], record[TEXT], human_delta(now - record[TIME]))
+               for record in records[:-1]]
+    return ", ".join(changes + [describe(records[-1], now)])
+
+
+class SeenContext(BaseCommandContext):
+
+    def cmd_seen(self, argument):
+        """
+        Say when someone was last seen, and doing what
+
+        Usage: seen nick
+        """
+        nick = argument.strip()
+        if not nick:
+            self.send(self.target, _("Seen who?"))
+            return
+        if lower(nick) == lower(self.nick):
+            self.send(self.target, _("Looking for yourself, %s?"), self.nick)
+            return
+        if lower(nick) == lower(self.connection.get_nickname()):
+            self.send(self.target, _("I'm right here!"))
+            return
+        channel = self.bot.channels.get(self.channel)
+        if channel is not None and channel.has_user(nick):
+            self.send(self.target, _("%s is right here!"), nick)
+            return
+        index = self.module.index
+        record = index.cached(nick)
+        if record is not None and record[EVENT] != "nick":
+            self.send(self.target, "%s", describe(record, time.time()))
+            return
+        def reply(records, error):
+            if error:
+                self.logger.warning("Looking up %s failed: %s", nick, error)
+                self.send(self.target, _("I can't remember right now"))
+            elif not records:
+                self.send(self.target, _("I haven't seen %s"), nick)
+            else:
+                self.send(self.target, "%s", describe_chain(records, time.time()))
+        # the records of cold nicks and old nick changes are on disk
+        self.module.defer(index.chain, (nick,), reply)
+
+
+class SeenModule(BaseModule):
+    context_class = SeenContext
+
+    def init(self):
+        self.index = SeenIndex(Store(seen_db, "seen"))
+        metrics.register("seen", self.stats)
+
+    def stats(self):
+        stats = self.index.stats()
+        stats.update(self.index.store.stats())
+        return stats
+
+    def on_message(self, connection, event):
+        self.index.record(event.source.nick, "message", event.target, event.arguments[0])
+
+    def on_join(self, connection, event):
+        self.index.record(event.source.nick, "join", event.target)
+
+    def on_part(self, connection, event):
+        text = event.arguments[0] if event.arguments else None
+        self.index.record(event.source.nick, "part", event.target, text)
+
+    def on_quit(self, connection, event):
+        text = event.arguments[0] if event.arguments else None
+        self.index.record(event.source.nick, "quit", None, text)
+
+    def on_nick(self, connection, event):
+        before, after = event.source.nick, event.target
+        self.index.record(before, "nick", None, after)
+        self.index.record(after, "renamed", None, before)
+
+
+module = SeenModule
+
+
+if __name__ == '__main__':
+    # Test the index and its nick chains against a store on disk
+    import os, tempfile, shutil
+    tmp = tempfile.mkdtemp()
+    try:
+        now = [1000.0]
+        store = Store(os.path.join(tmp, "seen.db"), "seen", flush_interval=60)
+        index = SeenIndex(store, max_entries=2, clock=lambda: now[0])
+        index.record("Alice", "message", "#fidibot", "x" * 200)
+        assert len(index.cached("alice")[TEXT]) == max_text
+        now[0] += 60
+        index.record("Alice", "nick", None, "Alice_away")
+        index.record("Alice_away", "renamed", None, "Alice")
+        index.record("Bob", "join", "#fidibot")
+        # alice fell out of memory, but not off the disk
+        assert index.cached("alice") is None and index.evictions == 1
+        store.flush()
+        now[0] += 120
+        index.record("alice_away", "nick", None, "Alice")
+        index.record("Alice", "renamed", None, "alice_away")
+        records = index.chain("ALICE_AWAY")
+        # alice_away -> alice, whose last record is becoming alice again
+        assert [r[EVENT] for r in records] == ["nick", "renamed"]
+        assert describe_chain(records, now[0] + 5).startswith("alice_away became Alice 5s ago, ")
+        # cycles stop
+        index.record("a", "nick", None, "b")
+        index.record("b", "nick", None, "a")
+        assert [r[NICK] for r in index.chain("a")] == ["a", "b"]
+        assert index.chain("nobody") == []
+        store.close()
+        store = Store(os.path.join(tmp, "seen.db"), "seen")
+        assert SeenIndex(store).lookup("bob")[EVENT] == "join"
+        store.close()
+    finally:
+        shutil.rmtree(tmp)
+    print "Everything in order"
@@ -0,0 +1,194 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Module to leave messages for nicks that aren't around
+
+Messages wait in the mailbox of their recipient, in the module's
+store, and are delivered the next time the recipient speaks or joins
+a channel the bot is in.
+
+That has to be checked on every line of every channel, so the nicks
+with mail are also kept in memory as a set, by irc.strings.lower, and
+a line from anyone else costs one lookup in it. Mailboxes are only
+read when there's mail in them.
+"""
+
+import time
+from irc.client import ServerNotConnectedError
+from irc.strings import lower
+from tools import human_delta
+from basemodule import BaseModule, BaseCommandContext
+from alternatives import _
+import metrics
+
+# most messages waiting for a nick, and nicks with messages waiting
+max_mail = 10
+max_recipients = 2000
+# longest message to keep, in bytes of UTF-8 like everything on IRC
+max_text = 300
+# longest line the server takes, line ending and all
+max_line = 512
+
+
+def size(text):
+    """Bytes text takes on the wire"""
+    if isinstance(text, unicode):
+        return len(text.encode('utf-8'))
+    return len(text)
+
+
+def truncate(text, width):
+    """Cut text to at most width bytes, without splitting a character"""
+    if size(text) <= width:
+        return text
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return text.encode('utf-8')[:width - 3].decode('utf-8', 'ignore') + u"..."
+
+
+def line_width(target):
+    """Bytes left for the text of a message to target"""
+    return max_line - size(u"PRIVMSG %s :\r\n" % target)
+
+
+def batch(prefix, items, width=max_line):
+    """Join items in as few lines of at most width bytes as possible, prefix first"""
+    lines = []
+    line, used = prefix, size(prefix)
+    for item in items:
+        item = truncate(item, width - size(prefix))
+        length = size(item)
+        if line != prefix and used + 3 + length > width:
+            lines.append(line)
+            line, used = prefix, size(prefix)
+        if line == prefix:
+            line += item
+            used += length
+        else:
+            line += " | " + item
+            used += 3 + length
+    lines.append(line)
+    return lines
+
+
+class TellContext(BaseCommandContext):
+
+    def cmd_tell(self, argument):
+        """
+        Leave a message for someone, for when they're around next
+
+        Usage: tell nick message
+        """
+        tokens = argument.split(None, 1)
+        if len(tokens) < 2:
+            self.send(self.target, _("Usage: tell nick message"))
+            return
+        nick, text = tokens[0].rstrip(":,"), tokens[1].strip()
+        if lower(nick) == lower(self.nick):
+            self.send(self.target, _("Tell yourself, %s"), self.nick)
+            return
+        if lower(nick) == lower(self.connection.get_nickname()):
+            self.send(self.target, _("I'm listening, %s"), self.nick)
+            return
+        text = truncate(text, max_text)
+        error = self.module.leave(nick, self.nick, text)
+        if error:
+            self.send(self.target, error)
+        else:
+            self.send(self.target, _("I'll pass that on to %s, %s"), nick, self.nick)
+
+
+class TellModule(BaseModule):
+    context_class = TellContext
+
+    def init(self):
+        # lowercased nicks with mail waiting
+        self.waiting = set(self.store.get("waiting", []))
+        self.left = self.delivered = self.lines = 0
+        metrics.register("tell", self.stats)
+
+    def stats(self):
+        return {'waiting': len(self.waiting), 'left': self.left,
+                'delivered': self.delivered, 'lines': self.lines}
+
+    def _save_waiting(self):
+        self.store.set("waiting", list(self.waiting))
+
+    def leave(self, nick, sender, text):
+        """Put a message in nick's mailbox. Returns why it couldn't, if it couldn't"""
+        key = lower(nick)
+        mailbox = self.store.get("mail:" + key, []) if key in self.waiting else []
+        if len(mailbox) >= max_mail:
+            return _("%s has too many messages waiting already") % nick
+        if key not in self.waiting and len(self.waiting) >= max_recipients:
+            return _("I have too many messages to pass on already")
+        # a new list, the store may be writing the old one
+        self.store.set("mail:" + key, mailbox + [[time.time(), sender, text]])
+        if key not in self.waiting:
+            self.waiting.add(key)
+            self._save_waiting()
+        self.left += 1
+
+    def deliver(self, nick, target):
+        """Send nick its mail, in as few lines as it takes"""
+        key = lower(nick)
+        mailbox = self.store.get("mail:" + key, [])
+        if mailbox:
+            now = time.time()
+            items = [u"%s %s ago: %s" % (sender, human_delta(now - when), text)
+                     for when, sender, text in mailbox]
+            lines = batch(_("%s, messages for you: ") % nick, items, line_width(target))
+            try:
+                self.send(target, "%s", "\n".join(lines))
+            except ServerNotConnectedError as e:
+                # keep it for next time
+                self.logger.warning("Couldn't deliver mail to %s: %s", nick, e)
+                return
+            self.delivered += len(mailbox)
+            self.lines += len(lines)
+        # only gone once it's sent
+        self.store.delete("mail:" + key)
+        self.waiting.discard(key)
+        self._save_waiting()
+
+    def on_message(self, connection, event):
+        if self.waiting and lower(event.source.nick) in self.waiting:
+            self.deliver(event.source.nick, event.target)
+
+    def on_join(self, connection, event):
+        if self.waiting and lower(event.source.nick) in self.waiting:
+            self.deliver(event.source.nick, event.target)
+
+
+module = TellModule
+
+
+if __name__ == '__main__':
+    # Test that deliveries take as few lines as they fit in
+    assert batch("nick: ", []) == ["nick: "]
+    assert batch("nick: ", ["a", "b"]) == ["nick: a | b"]
+    lines = batch("n: ", ["x" * 10] * 5, width=30)
+    assert lines == ["n: " + " | ".join(["x" * 10] * 2)] * 2 + ["n: " + "x" * 10]
+    assert all(len(line) <= 30 for line in lines)
+    assert batch("n: ", ["y" * 40], width=30) == ["n: " + "y" * 24 + "..."]
+    # widths are in bytes, and items too long are cut between characters
+    greek = u"\u03b3\u03b5\u03b9\u03b1 " * 20
+    assert size(truncate(greek, max_text)) <= max_text
+    assert truncate(greek, 8) == u"\u03b3\u03b5..."
+    width = line_width("#fidibot")
+    assert width == 512 - len("PRIVMSG #fidibot :\r\n")
+    lines = batch(u"nick, messages for you: ", [u"alice 5m ago: " + greek * 2] * max_mail, width)
+    assert len(lines) == max_mail and all(size(line) <= width for line in lines)
+    # and a full mailbox of the longest messages fits in the lines the server takes
+    text = truncate(u"\u20ac" * 400, max_text)
+    lines = batch(u"SomeLongNickname, messages for you: ",
+                  [u"AnotherLongNick 3w 6d ago: " + text] * max_mail, width)
+    assert all(size(u"PRIVMSG #fidibot :%s\r\n" % line) <= 512 for line in lines)
+
+    # Measure the check every line goes through
+    import timeit
+    waiting = set("nick%d" % i for i in xrange(max_recipients))
+    setup = "from irc.strings import lower; from __main__ import waiting"
+    took = min(timeit.repeat("waiting and lower('SomeNick') in waiting", setup,
+                             number=100000, repeat=3)) / 100000
+    print "Checking for mail: %.2fus a line" % (took * 1e6)
+    print "Everything in order"
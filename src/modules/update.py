@@ -2,21 +2,35 @@
 """
 Module for auto updating the fidibot
 
-When an update command occurs, the bot will exit
+When an update command occurs, the bot runs `install.sh update`
+and hands its connection over to a process running the new code,
+exiting with exit code 43 once that one has taken over.
+See the handoff module for how.
+
+If that fails, or handoff_enabled is off, the bot will exit
 with exit code 42. It is then a shell scripts job
 to update it and bring it back online.
 """
 
+import subprocess
+import handoff
+import storage
 from basemodule import BaseModule, BaseCommandContext
 from alternatives import _
 
+import logging
+log = logging.getLogger(__name__)
+
+# hand the connection over instead of reconnecting
+handoff_enabled = True
+update_command = ["./install.sh", "update"]
+
 
 class UpdateContext(BaseCommandContext):
 
     def cmd_update_private(self, argument):
-        """Exit, pending an update"""
-        self.bot.disconnect(_("Going for an update"))
-        raise SystemExit(42)
+        """Update, without leaving if we can help it"""
+        self.module.update()
 
     # hide command from help
     cmd_update_private.hidden = True
@@ -32,8 +46,39 @@ class UpdateContext(BaseCommandContext):
         return False
 
 
+def install_update():
+    return subprocess.call(update_command)
+
 
 class UpdateModule(BaseModule):
     context_class = UpdateContext
 
+    def init(self):
+        self.updating = False
+
+    def update(self):
+        if not handoff_enabled:
+            self.restart()
+        if self.updating:
+            return
+        self.updating = True
+        self.defer(install_update, (), self.installed)
+
+    def installed(self, status, error):
+        if error or status:
+            log.warning("Updating exited with %s, going on anyway", error or status)
+        # the new process reads what the modules stored from the disk
+        storage.flush_all()
+        try:
+            handoff.hand_off(self.bot)
+        except handoff.HandoffError as e:
+            log.warning("Couldn't hand the connection over: %s", e)
+            self.restart()
+        raise SystemExit(handoff.handed_off)
+
+    def restart(self):
+        """Exit, pending an update"""
+        self.bot.disconnect(_("Going for an update"))
+        raise SystemExit(42)
+
 module = UpdateModule
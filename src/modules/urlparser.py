@@ -4,11 +4,19 @@ Module for parsing URLs in chat or on demand
 """
 
 import re
+from datetime import datetime
+import urllib
+import urlparse
 import requests
-from googl import Googl
-from bs4 import BeautifulSoup
-from logsetup import strip_colors
+from collections import namedtuple
+from ircformat import strip as strip_codes
+from titles import extract_title
+import media
+from shortener import Shortener, RedirectServer
+from tools import LRUCache, CircuitBreakers, human_delta
+from workers import KeyedSemaphore
 from basemodule import BaseModule, BaseCommandContext
+import metrics
 
 regex = re.compile("""
                    ^(                # Starts with
@@ -17,11 +25,93 @@ regex = re.compile("""
                    )\S+$             # more characters until the end
                    """, re.IGNORECASE | re.VERBOSE | re.UNICODE)
 
+# query parameters that only track where a link came from
+tracking_params = ('utm_', 'fbclid', 'gclid', 'dclid', 'mc_cid', 'mc_eid',
+                   'igshid', 'yclid', '_hsenc', '_hsmi')
+default_ports = {'http': 80, 'https': 443}
+
+shortener_db = "data/shortener.db"
+
+# cache settings, ttls in seconds
+cache_entries = 2000
+cache_bytes = 1024 * 1024
+cache_ttl = 6 * 60 * 60
+cache_failure_ttl = 5 * 60
+
+# most bytes of a page to read looking for its title
+title_max_bytes = 256 * 1024
+# most bytes of other files to read looking for their metadata
+media_max_bytes = 64 * 1024
+
+# seconds until unresolved urls of a line are reported as timed out
+line_deadline = 10
+# seconds a url posted in a channel isn't looked up again there,
+# and how many posted urls to remember
+dedup_window = 15 * 60
+dedup_entries = 5000
+
+# most concurrent lookups to the same host
+host_limit = 2
+# failures in a row before we stop looking up urls of a host,
+# and seconds until we try it again
+breaker_threshold = 3
+breaker_cooldown = 5 * 60
+
+# host_error is set when the host itself failed us, by not answering
+# or with a server error, instead of just not having the page
+UrlInfo = namedtuple('UrlInfo', 'url title short_url content_type failed host_error')
+UrlInfo.__new__.__defaults__ = (False,)
+
+
 def is_url(token):
     """Return true if the input is a URL"""
     return regex.match(token)
 
 
+def is_page(content_type):
+    """Return true if a Content-Type is of a page that has a title"""
+    return "html" in content_type or "xml" in content_type
+
+
+def normalize_url(url):
+    """
+    Normalize a URL so the same page always gives the same string.
+
+    The scheme and host are lowercased, default ports and fragments
+    dropped, and tracking parameters removed from the query.
+    """
+    url = strip_codes(url)
+    if url.find("://") == -1:
+        url = "http://" + url
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ''
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != default_ports.get(scheme):
+        netloc = "%s:%d" % (netloc, port)
+    if parts.username:
+        # keep user info, it may select a different page
+        userinfo = parts.username
+        if parts.password:
+            userinfo += ":" + parts.password
+        netloc = userinfo + "@" + netloc
+    query = parts.query
+    if query and any(p in query for p in tracking_params):
+        pairs = urlparse.parse_qsl(query, keep_blank_values=True)
+        pairs = [(k, v) for k, v in pairs
+                 if not k.lower().startswith(tracking_params)]
+        query = urllib.urlencode(pairs)
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def info_size(info):
+    """Approximate the memory an UrlInfo takes in the cache"""
+    return sum(len(v) for v in info if isinstance(v, basestring)) + 100
+
+
 class UrlParserContext(BaseCommandContext):
 
     def parse_urls(self, txt):
@@ -30,51 +120,91 @@ class UrlParserContext(BaseCommandContext):
         return urls
 
     def find_url_title(self, url):
-        """Retrieve the title of a given URL"""
-        url = strip_colors.sub("", url)
+        """
+        Retrieve the title of a given URL
+
+        For anything other than a page, the title describes the file
+        from the metadata in its first few bytes.
+        Return an UrlInfo with no short url.
+        """
+        url = strip_codes(url)
         headers = {'User-Agent': 'Wget/1.13.4 (linux-gnu)'}
         if url.find("://") == -1:
             url = "http://" + url
         try:
             # a HEAD first to thwart attacks
-            head = requests.head(url, headers=headers, timeout=5)
+            head = self.module.http.head(url, headers=headers)
             cont_type = head.headers.get('content-type')
-            head.raise_for_status()
-            if cont_type and ("html" not in cont_type and
-                              "xml" not in cont_type):
-                return head.url, cont_type.split(';')[0]
-            # now the actual request
-            resp = requests.get(url, headers=headers)
-            html = resp.content
+            if head.status_code in (405, 501):
+                # the server doesn't do HEAD, find out with the GET
+                cont_type = None
+            else:
+                head.raise_for_status()
+            if not cont_type or is_page(cont_type):
+                budget = title_max_bytes
+            else:
+                budget = media_max_bytes
+            if not cont_type or budget == media_max_bytes:
+                # ask for only what we'll read, in case it's a huge file
+                headers['Range'] = "bytes=0-%d" % (budget - 1)
+                headers['Accept-Encoding'] = "identity"
+            # now the actual request, reading only up to the title
+            resp = self.module.http.get(url, headers=headers, stream=True)
+            try:
+                resp.raise_for_status()
+                cont_type = resp.headers.get('content-type') or cont_type
+                if not cont_type or is_page(cont_type):
+                    title = extract_title(resp.iter_content(8192), cont_type,
+                                          title_max_bytes)
+                else:
+                    cont_type = cont_type.split(';')[0].strip()
+                    data = media.read_prefix(resp.iter_content(8192), media_max_bytes)
+                    title = media.describe(media.probe(data), cont_type,
+                                           media.total_size(resp.headers))
+            finally:
+                resp.close()
         except requests.RequestException as e:
             self.logger.warning(e)
-            return url, e.__doc__
+            host_error = (isinstance(e, (requests.ConnectionError, requests.Timeout)) or
+                          (e.response is not None and e.response.status_code >= 500))
+            return UrlInfo(url, e.__doc__, None, None, True, host_error)
         except ValueError as e:
             self.logger.warning(e)
-            return url, "Failed to parse url"
-        else:
-            soup = BeautifulSoup(html)
-            try:
-                title = soup.title.text.strip()
-            except AttributeError as e:
-                self.logger.warning("Soup couldn't parse url %s", resp.url)
-                title = None
-            if not title:
-                title = "Could not find page title!"
-        return resp.url, title
+            return UrlInfo(url, "Failed to parse url", None, None, True)
+        if not title:
+            self.logger.warning("Couldn't find a title in url %s", resp.url)
+            title = "Could not find page title!"
+        return UrlInfo(resp.url, title, None, cont_type, False)
 
     def shorten(self, long_url):
-        if self.bot.google_api_key:
-            goog = Googl(self.bot.google_api_key)
+        return self.module.shortener.shorten(long_url)
+
+    def fetch(self, url, host):
+        """
+        Find the UrlInfo of a URL, short url included.
+
+        This blocks, so it runs in a worker thread.
+        """
+        with self.module.host_slots.slot(host):
+            info = self.find_url_title(url)
+            if not info.failed:
+                info = info._replace(short_url=self.shorten(info.url))
+        return info
+
+    def cache_info(self, key, info):
+        ttl = cache_failure_ttl if info.failed else cache_ttl
+        self.module.cache.set(key, info, ttl, info_size(info))
+
+    def record_health(self, host, info):
+        """Let the circuit breaker of host know how a lookup went"""
+        breakers = self.module.breakers
+        if info.host_error:
+            breakers.failure(host, info.title)
+            if breakers.state(host) == breakers.OPEN:
+                self.logger.warning("Not looking up urls of %s for %d seconds",
+                                    host, breaker_cooldown)
         else:
-            goog = Googl()
-        resp = goog.shorten(long_url)
-        if resp.get('error'):
-            error = resp['error']['message']
-            self.logger.warning("Failed to shorten %s - %s", long_url, error)
-            return long_url
-        short_url = resp['id']
-        return short_url
+            breakers.success(host)
 
     def do_public(self):
         """
@@ -84,7 +214,7 @@ class UrlParserContext(BaseCommandContext):
         if super(UrlParserContext, self).do_public():
             return True
         urls = self.parse_urls(self.input)
-        return self._do_urls(urls)
+        return self._do_urls(urls, dedup=True, optional=True)
 
     def cmd_title(self, argument):
         """Shorten url(s) and return page title(s)."""
@@ -97,19 +227,136 @@ class UrlParserContext(BaseCommandContext):
         """Shorten url(s) and return page title(s)."""
         self.cmd_title(argument)
 
-    def _do_urls(self, urls):
-        if urls:
-            for url in urls:
-                final_url, title = self.find_url_title(url)
-                short_url = self.shorten(final_url)
-                self.send(self.target, "%s -- %s", short_url, title)
-            return True
-        return False
+    def cmd_urlcache_private(self, argument):
+        """Show the url cache metrics, or purge it"""
+        if self.is_admin:
+            if argument.strip().lower() == "purge":
+                count = self.module.cache.purge()
+                self.send(self.nick, "Purged %d urls from the cache", count)
+                self.logger.info("User %s purged the url cache" % self.nick)
+            else:
+                stats = self.module.cache.stats()
+                self.send(self.nick, "%s", metrics.format_metrics("urlcache", stats))
+        else:
+            self.logger.warning("User %s tried to use '%s' without being admin" % (self.nick, "urlcache"))
+
+    # hide command from help
+    cmd_urlcache_private.hidden = True
+
+    def repost(self, key, url):
+        """
+        Remember a url posted in the channel, checking if it's a repost.
+
+        Return None for new urls, False for urls the same user posted
+        recently, or else an UrlInfo saying who posted it and when.
+        """
+        dedup_key = (self.channel.lower(), key)
+        posted = self.module.posted.get(dedup_key)
+        if posted is None:
+            self.module.posted.set(dedup_key, (self.nick, datetime.now()), dedup_window,
+                                   len(key) + len(self.nick) + 100)
+            return None
+        nick, when = posted
+        if nick == self.nick:
+            return False
+        info = self.module.cache.get(key)
+        short_url = info.short_url if info else None
+        ago = human_delta((datetime.now() - when).total_seconds())
+        return UrlInfo(url, "already posted by %s %s ago" % (nick, ago), short_url, None, False)
+
+    def _do_urls(self, urls, dedup=False, optional=False):
+        """
+        Look up all urls concurrently and announce them in order.
+
+        Cached urls are answered right away, and so are urls of hosts
+        whose circuit breaker is open, with the host's last error.
+        With dedup, urls posted in the channel in the last dedup_window
+        are only pointed out as reposts, or skipped if it's the same user.
+        Every url is announced as soon as it and all the ones before it
+        are resolved, and any still missing after the line deadline are
+        reported as timed out.
+        Optional titles, ie. of urls nobody asked for, are held back
+        while the bot is lagged.
+        """
+        if not urls:
+            return False
+        keys = [normalize_url(url) for url in urls]
+        hosts = [urlparse.urlsplit(key).hostname for key in keys]
+        results = [None] * len(urls)
+        sent = [0]
+
+        def flush():
+            while sent[0] < len(urls) and results[sent[0]] is not None:
+                info = results[sent[0]]
+                if info and optional:
+                    self.bot.when_not_lagged(self.send, self.target, "%s -- %s",
+                                             info.short_url or info.url, info.title)
+                elif info:
+                    self.send(self.target, "%s -- %s", info.short_url or info.url, info.title)
+                sent[0] += 1
+
+        def resolved(i, info, error):
+            if info:
+                self.record_health(hosts[i], info)
+            if results[i] is not None:
+                # came in after the deadline, but still worth caching
+                if info:
+                    self.cache_info(keys[i], info)
+                return
+            if error:
+                info = UrlInfo(urls[i], "Failed to parse url", None, None, True)
+            self.cache_info(keys[i], info)
+            results[i] = info
+            flush()
+
+        def deadline():
+            for i, url in enumerate(urls):
+                if results[i] is None:
+                    self.logger.warning("Timed out looking up %s", url)
+                    results[i] = UrlInfo(url, "timed out", None, None, True)
+            flush()
+
+        breakers = self.module.breakers
+        dedup = dedup and self.target == self.channel
+        for i, url in enumerate(urls):
+            info = self.repost(keys[i], url) if dedup else None
+            if info is None:
+                info = self.module.cache.get(keys[i])
+            if info is not None:
+                results[i] = info
+            elif not breakers.allow(hosts[i]):
+                reason = breakers.reason(hosts[i]) or "Host is down"
+                results[i] = UrlInfo(url, "%s (not retrying for now)" % reason,
+                                     None, None, True, True)
+            else:
+                callback = lambda info, error, i=i: resolved(i, info, error)
+                self.module.defer(self.fetch, (url, hosts[i]), callback)
+        flush()
+        if sent[0] < len(urls):
+            self.connection.execute_delayed(line_deadline, deadline)
+        return True
 
 
 class UrlParserModule(BaseModule):
     context_class = UrlParserContext
 
+    def init(self):
+        self.cache = LRUCache(cache_entries, cache_bytes)
+        self.posted = LRUCache(dedup_entries, dedup_entries * 300)
+        self.host_slots = KeyedSemaphore(host_limit)
+        self.breakers = CircuitBreakers(breaker_threshold, breaker_cooldown)
+        # links only get shorter with a base URL others can reach,
+        # without one the full URLs are announced
+        self.shortener = Shortener(shortener_db, self.bot.short_url)
+        if self.bot.short_port:
+            if not self.bot.short_url:
+                self.logger.warning("Serving short links on port %d, but not shortening "
+                                    "any without --short-url", self.bot.short_port)
+            RedirectServer(self.shortener, self.bot.short_port).start()
+        metrics.register("urlcache", self.cache.stats)
+        metrics.register("urlposts", self.posted.stats)
+        metrics.register("urlbreakers", self.breakers.stats)
+
 module = UrlParserModule
 
 
@@ -130,5 +377,21 @@ def test_regex():
         else:
             print "FAIL: %s should have failed" % i
 
+normalized_urls = (
+    ('HTTP://Example.COM:80/a?b=1#frag', 'http://example.com/a?b=1'),
+    ('www.example.com', 'http://www.example.com/'),
+    ('https://example.com:443/?utm_source=x&id=2&fbclid=y', 'https://example.com/?id=2'),
+    ('https://example.com:8443/x', 'https://example.com:8443/x'),
+)
+
+def test_normalize():
+    for url, expected in normalized_urls:
+        result = normalize_url(url)
+        if result == expected:
+            print "PASS: %s normalized" % url
+        else:
+            print "FAIL: %s normalized to %s instead of %s" % (url, result, expected)
+
 if __name__ == '__main__':
     test_regex()
+    test_normalize()
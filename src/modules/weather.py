@@ -1,39 +1,76 @@
 # Author: John Giannakopoulos <giannakopoulosj@gmail.com>
 
-import pywapi
+from forecast import WeatherCache, WeatherComProvider, FixtureProvider
 from basemodule import BaseModule, BaseCommandContext
+import metrics
 
 from alternatives import _
 
+# provider to use, one of providers
+provider_name = "weather.com"
+providers = {
+    "weather.com": WeatherComProvider,
+    "fixture": FixtureProvider,
+}
+# location for the weather command without arguments, Nafpaktos
+default_location = "GRXX1283:1"
+
+# cache settings, in seconds
+weather_ttl = 30 * 60
+refresh_ahead = 5 * 60
+refresh_interval = 60
+
 class WeatherContext(BaseCommandContext):
 
-    def cmd_keros(self, argument):
-        """Gives The Temperature and Weather of Nafpaktos """
-        
-        # Get the weather for Nafpaktos
-        nafpaktos = pywapi.get_weather_from_weather_com('GRXX1283:1')
-        
-        # Check for errors
-        error = nafpaktos.get('error')
+    def cmd_weather(self, argument):
+        """Gives the temperature and weather of a location, Nafpaktos by default"""
+        location = argument.strip()
+        if location:
+            self.module.lookup(location, self.announce)
+        else:
+            self.cmd_keros(argument)
+
+    def announce(self, conditions, error):
+        """Send the conditions of a location, or the error getting them"""
         if error:
-            self.logger.error(error)
             self.send(self.target, _("Error retrieving data: %s"), error)
             return
-        
-        # Get the Current Weather
-        curcond = nafpaktos.get('current_conditions', {})
-        temp = curcond.get('temperature')
-        text = curcond.get('text')
-        time = curcond.get('last_updated')
-        
+        fmt_str = _("The Temperature is %s\nThe Weather is %s\n%s %s")
+        self.send(self.target, fmt_str, conditions.temperature,
+                  _(conditions.text or ""), conditions.location, conditions.updated)
+
+    def announce_default(self, conditions, error):
+        """Send the conditions of the default location, in the format it always had"""
+        if error:
+            self.announce(conditions, error)
+            return
+        # keeps the alternatives written for it before any location could be asked for
         fmt_str = _("The Temperature is %s\nThe Weather is %s\nNafpaktos %s")
-        self.send(self.target, fmt_str, temp, _(text), time)
+        self.send(self.target, fmt_str, conditions.temperature,
+                  _(conditions.text or ""), conditions.updated)
+
+    def cmd_keros(self, argument):
+        """Gives The Temperature and Weather of Nafpaktos """
+        self.module.lookup(default_location, self.announce_default)
 
     def cmd_kairos(self, argument):
         """Gives The Temperature and Weather of Nafpaktos """
         self.cmd_keros(argument)
 
 class WeatherModule(BaseModule):
-        context_class = WeatherContext
+    context_class = WeatherContext
+
+    def init(self):
+        provider = providers[provider_name](http=self.http)
+        self.cache = WeatherCache(provider, self.defer, weather_ttl, refresh_ahead)
+        self.refreshing = False
+        metrics.register("weather", self.cache.stats)
+
+    def lookup(self, location, callback):
+        if not self.refreshing:
+            # there's no connection to schedule on before the first event
+            self.bot.connection.execute_every(refresh_interval, self.cache.refresh_due)
+            self.refreshing = True
+        self.cache.lookup(location, callback)
 
 module = WeatherModule
@@ -0,0 +1,334 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Caching, SSRF safe name resolution for outbound HTTP
+
+Resolver looks up the A and AAAA records of a host in parallel and
+keeps the addresses in memory, so hot domains skip DNS entirely.
+getaddrinfo doesn't tell us the record TTLs, so entries are kept for a
+configured ttl instead, and failed lookups for a shorter one.
+
+Every address is checked against a blocklist of networks after the
+lookup, so links can't make the bot fetch from loopback, private or
+link local addresses. A host with any blocked address is refused,
+which also covers names resolving to both public and private ones.
+
+Connections race the addresses happy eyeballs style: the next address
+is tried if the previous hasn't connected within attempt_delay, and
+the first to connect wins.
+
+ResolvingAdapter mounts the resolver on a requests Session, see
+HttpClient's resolver argument.
+"""
+
+import errno
+import select
+import socket
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.poolmanager import PoolManager, SSL_KEYWORDS
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.connection import HTTPConnection, VerifiedHTTPSConnection
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from tools import LRUCache
+
+import logging
+log = logging.getLogger(__name__)
+
+# networks no module should be fetching from
+blocked_networks = (
+    "0.0.0.0/8", "10.0.0.0/8", "100.64.0.0/10", "127.0.0.0/8",
+    "169.254.0.0/16", "172.16.0.0/12", "192.0.0.0/24", "192.168.0.0/16",
+    "198.18.0.0/15", "224.0.0.0/4", "240.0.0.0/4",
+    "::/128", "::1/128", "64:ff9b::/96", "fc00::/7", "fe80::/10", "ff00::/8",
+)
+
+
+class BlockedAddress(requests.RequestException):
+    """The host resolves to a blocked address"""
+
+
+def parse_network(network):
+    """Parse a network in CIDR notation to (family, number, mask)"""
+    address, _, prefix = network.partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    number = address_number(family, address)
+    bits = 128 if family == socket.AF_INET6 else 32
+    prefix = int(prefix) if prefix else bits
+    mask = ((1 << bits) - 1) ^ ((1 << (bits - prefix)) - 1)
+    return family, number & mask, mask
+
+
+def address_number(family, address):
+    packed = socket.inet_pton(family, address)
+    return int(packed.encode('hex'), 16)
+
+
+class Resolver(object):
+    """
+    DNS cache and address checks.
+
+    ttl, failure_ttl: seconds to keep addresses and failed lookups
+    blocked:          networks to refuse, in CIDR notation
+    attempt_delay:    seconds to wait on a connection attempt
+                      before also trying the next address
+    """
+
+    def __init__(self, ttl=300, failure_ttl=30, blocked=blocked_networks,
+                 max_entries=1000, attempt_delay=0.25):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.blocked = [parse_network(network) for network in blocked]
+        self.attempt_delay = attempt_delay
+        self.cache = LRUCache(max_entries, max_entries * 200)
+        self.lock = threading.Lock()
+        self.lookups = {}
+
+    def is_blocked(self, family, address):
+        number = address_number(family, address)
+        if family == socket.AF_INET6 and number >> 32 == 0xffff:
+            # IPv4 mapped
+            family, number = socket.AF_INET, number & 0xffffffff
+        return any(family == net_family and number & mask == net_number
+                   for net_family, net_number, mask in self.blocked)
+
+    def lookup(self, host):
+        """
+        Look up the A and AAAA records of host in parallel.
+
+        Return the addresses as (family, address) with the IPv6 and IPv4
+        ones interleaved, IPv6 first. Raise socket.gaierror if none found.
+        """
+        results = {}
+
+        def query(family):
+            try:
+                results[family] = socket.getaddrinfo(host, None, family, socket.SOCK_STREAM)
+            except socket.error as e:
+                results[family] = e
+
+        thread = threading.Thread(target=query, args=(socket.AF_INET6,), name="resolver")
+        thread.daemon = True
+        thread.start()
+        query(socket.AF_INET)
+        thread.join()
+        found = {}
+        for family in (socket.AF_INET6, socket.AF_INET):
+            result = results.get(family)
+            if isinstance(result, list):
+                found[family] = []
+                for info in result:
+                    address = info[4][0].split('%')[0]
+                    if address not in found[family]:
+                        found[family].append(address)
+        if not found:
+            raise results[socket.AF_INET]
+        v6, v4 = found.get(socket.AF_INET6, []), found.get(socket.AF_INET, [])
+        addresses = []
+        for i in xrange(max(len(v6), len(v4))):
+            addresses.extend((family, pair[i]) for family, pair in
+                             ((socket.AF_INET6, v6), (socket.AF_INET, v4)) if i < len(pair))
+        return addresses
+
+    def resolve(self, host):
+        """
+        Return the allowed addresses of host, from the cache if we can.
+
+        Raise BlockedAddress if any of them is blocked. Concurrent
+        resolves of the same host share a single lookup.
+        """
+        with self.lock:
+            result = self.cache.get(host)
+            if result is None:
+                waiting = self.lookups.get(host)
+                if waiting is None:
+                    waiting = self.lookups[host] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+        if result is None:
+            if owner:
+                try:
+                    result = self.lookup(host)
+                    ttl = self.ttl
+                except socket.error as e:
+                    result, ttl = e, self.failure_ttl
+                finally:
+                    with self.lock:
+                        if result is not None:
+                            self.cache.set(host, result, ttl, 100 + len(host))
+                        del self.lookups[host]
+                    waiting.set()
+            else:
+                waiting.wait()
+                with self.lock:
+                    result = self.cache.get(host)
+                if result is None:
+                    return self.resolve(host)
+        if isinstance(result, Exception):
+            raise result
+        for family, address in result:
+            if self.is_blocked(family, address):
+                log.warning("Refusing %s, it resolves to %s", host, address)
+                raise BlockedAddress("%s resolves to blocked address %s" % (host, address))
+        return result
+
+    def connect(self, address, timeout=None, source_address=None, socket_options=None):
+        """
+        Connect to (host, port), racing its addresses.
+
+        Works like socket.create_connection, and raises socket.timeout
+        if nothing connects within timeout.
+        """
+        host, port = address
+        if not isinstance(timeout, (int, float)):
+            timeout = None
+        deadline = time.time() + timeout if timeout is not None else None
+        remaining = list(self.resolve(host))
+        pending = {}
+        error = None
+        next_attempt = 0
+        try:
+            while remaining or pending:
+                now = time.time()
+                if remaining and (not pending or now >= next_attempt):
+                    family, ip = remaining.pop(0)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    for option in socket_options or ():
+                        sock.setsockopt(*option)
+                    if source_address:
+                        sock.bind(source_address)
+                    sock.setblocking(0)
+                    code = sock.connect_ex((ip, port))
+                    if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        pending[sock] = ip
+                        next_attempt = now + self.attempt_delay
+                    else:
+                        error = socket.error(code, "%s: %s" % (ip, errno.errorcode.get(code, code)))
+                        sock.close()
+                    continue
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout("timed out connecting to %s" % host)
+                wait = [next_attempt - now] if remaining else []
+                if deadline is not None:
+                    wait.append(deadline - now)
+                socks = list(pending)
+                _, writable, _ = select.select([], socks, socks, min(wait) if wait else None)
+                for sock in writable:
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    ip = pending.pop(sock)
+                    if code == 0:
+                        sock.settimeout(timeout)
+                        return sock
+                    error = socket.error(code, "%s: %s" % (ip, errno.errorcode.get(code, code)))
+                    sock.close()
+        finally:
+            for sock in pending:
+                sock.close()
+        raise error or socket.error("No addresses for %s" % host)
+
+    def stats(self):
+        with self.lock:
+            return self.cache.stats()
+
+
+class ResolvingMixin(object):
+    """Make a urllib3 connection connect through a Resolver"""
+
+    def __init__(self, *args, **kwargs):
+        self.resolver = kwargs.pop('resolver')
+        super(ResolvingMixin, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        try:
+            return self.resolver.connect((self.host, self.port), self.timeout,
+                                         self.source_address, self.socket_options)
+        except socket.timeout:
+            raise ConnectTimeoutError(self, "Connection to %s timed out. (connect timeout=%s)" %
+                                      (self.host, self.timeout))
+
+
+class ResolvingConnection(ResolvingMixin, HTTPConnection):
+    pass
+
+
+class ResolvingHTTPSConnection(ResolvingMixin, VerifiedHTTPSConnection):
+    pass
+
+
+class ResolvingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = ResolvingConnection
+
+
+class ResolvingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = ResolvingHTTPSConnection
+
+
+class ResolvingPoolManager(PoolManager):
+    """PoolManager whose pools pass their resolver to their connections"""
+
+    pool_classes = {'http': ResolvingHTTPConnectionPool,
+                    'https': ResolvingHTTPSConnectionPool}
+
+    def _new_pool(self, scheme, host, port):
+        kwargs = self.connection_pool_kw
+        if scheme == 'http':
+            kwargs = kwargs.copy()
+            for kw in SSL_KEYWORDS:
+                kwargs.pop(kw, None)
+        return self.pool_classes[scheme](host, port, **kwargs)
+
+
+class ResolvingAdapter(HTTPAdapter):
+    """HTTPAdapter connecting through a Resolver"""
+
+    def __init__(self, resolver, **kwargs):
+        self.resolver = resolver
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = ResolvingPoolManager(num_pools=connections, maxsize=maxsize,
+                                                block=block, strict=True,
+                                                resolver=self.resolver, **pool_kwargs)
+
+
+if __name__ == '__main__':
+    # Test the blocklist, the cache and the connection race
+    logging.basicConfig()
+    resolver = Resolver()
+    assert resolver.is_blocked(socket.AF_INET, "127.0.0.1")
+    assert resolver.is_blocked(socket.AF_INET, "172.31.0.1")
+    assert not resolver.is_blocked(socket.AF_INET, "172.32.0.1")
+    assert resolver.is_blocked(socket.AF_INET6, "::ffff:192.168.1.1")
+    assert not resolver.is_blocked(socket.AF_INET6, "2001:db8::1")
+    try:
+        resolver.resolve("localhost")
+        assert False, "localhost should be blocked"
+    except BlockedAddress:
+        pass
+    assert resolver.stats()['entries'] == 1
+
+    resolver = Resolver(blocked=())
+    # 127.0.0.2 never accepts, its backlog is full, so 127.0.0.1 wins
+    stuck = socket.socket()
+    stuck.bind(("127.0.0.2", 0))
+    stuck.listen(0)
+    port = stuck.getsockname()[1]
+    backlog = [socket.socket() for _ in xrange(3)]
+    for sock in backlog:
+        sock.setblocking(0)
+        sock.connect_ex(("127.0.0.2", port))
+    server = socket.socket()
+    server.bind(("127.0.0.1", port))
+    server.listen(5)
+    resolver.cache.set("race.test", [(socket.AF_INET, "127.0.0.2"),
+                                     (socket.AF_INET, "127.0.0.1")], 60)
+    start = time.time()
+    sock = resolver.connect(("race.test", port), 3)
+    assert sock.getpeername()[0] == "127.0.0.1"
+    print "Connected to the second address in %.3fs" % (time.time() - start)
+    print "Everything in order"
@@ -34,9 +34,59 @@ then
 	FIDI_COMMAND+=" -s \"$FIDI_ADMIN"\"
 fi
 
-if [[ "$FIDI_GOOGLE_API" != "" ]]
+if [[ "$FIDI_SHORT_URL" != "" ]]
 then
-	FIDI_COMMAND+=" -g \"$FIDI_GOOGLE_API"\"
+	FIDI_COMMAND+=" -u \"$FIDI_SHORT_URL\""
+fi
+
+if [[ "$FIDI_SHORT_PORT" != "" ]]
+then
+	FIDI_COMMAND+=" --short-port $FIDI_SHORT_PORT"
+fi
+
+if [[ "$FIDI_AUTOCOMPLETE" != "" ]]
+then
+	FIDI_COMMAND+=" -a"
+fi
+
+for FAILOVER in $FIDI_FAILOVER
+do
+	FIDI_COMMAND+=" -f $FAILOVER"
+done
+
+if [[ "$FIDI_PING_INTERVAL" != "" ]]
+then
+	FIDI_COMMAND+=" --ping-interval $FIDI_PING_INTERVAL"
+fi
+
+if [[ "$FIDI_PING_TIMEOUT" != "" ]]
+then
+	FIDI_COMMAND+=" --ping-timeout $FIDI_PING_TIMEOUT"
+fi
+
+if [[ "$FIDI_LAG_THRESHOLD" != "" ]]
+then
+	FIDI_COMMAND+=" --lag-threshold $FIDI_LAG_THRESHOLD"
+fi
+
+if [[ "$FIDI_LAG_DEFER" != "" ]]
+then
+	FIDI_COMMAND+=" --lag-defer"
+fi
+
+for UNTRACKED in $FIDI_UNTRACKED
+do
+	FIDI_COMMAND+=" --untracked \"$UNTRACKED\""
+done
+
+if [[ "$FIDI_HISTORY_LINES" != "" ]]
+then
+	FIDI_COMMAND+=" --history-lines $FIDI_HISTORY_LINES"
+fi
+
+if [[ "$FIDI_HISTORY_BYTES" != "" ]]
+then
+	FIDI_COMMAND+=" --history-bytes $FIDI_HISTORY_BYTES"
 fi
 
 FIDI_COMMAND+=" $FIDI_SERVER $FIDI_CHANNEL $FIDI_USERNAME"
@@ -57,6 +107,19 @@ RET=$?
 
 while [ $RET -gt 0 ]
 do
+	if [ $RET -eq 43 ]
+	then
+		echo "------------ Handed off ------------"
+		# the updated bot has the connection, wait for it to exit
+		while kill -0 $(cat data/fidibot.pid 2>/dev/null) 2>/dev/null
+		do
+			sleep 5
+		done
+		RET=$(cat data/fidibot.status 2>/dev/null || echo 1)
+		rm -f data/fidibot.pid data/fidibot.status
+		continue
+	fi
+
 	if [ $RET -eq 42 ]
 	then
 		echo "------------- Updating -------------"
@@ -0,0 +1,213 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Local URL shortener
+
+URLs are stored in a SQLite database and get the base62 encoding of
+their row id as a short code, so identical URLs always get the same
+code and shortening never leaves the machine.
+
+RedirectServer is a tiny HTTP server answering requests for short
+codes with a redirect to the full URL. Run it behind the base URL the
+short links are made with.
+"""
+
+import errno
+import socket
+import sqlite3
+import string
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from tools import LRUCache
+
+import logging
+log = logging.getLogger(__name__)
+
+alphabet = string.digits + string.ascii_letters
+
+
+def base62(number):
+    """Encode a non negative integer in base62"""
+    if number == 0:
+        return alphabet[0]
+    digits = []
+    while number:
+        number, rem = divmod(number, 62)
+        digits.append(alphabet[rem])
+    return "".join(reversed(digits))
+
+
+def unbase62(code):
+    """Decode a base62 string, raising ValueError for invalid ones"""
+    number = 0
+    for char in code:
+        value = alphabet.find(char)
+        if value < 0:
+            raise ValueError("Invalid short code %r" % code)
+        number = number * 62 + value
+    return number
+
+
+class Shortener(object):
+    """
+    Persistent URL shortener.
+
+    Recently used codes are kept in memory, so shortening a popular URL
+    again doesn't touch the database. It is safe to use from any thread.
+    """
+
+    def __init__(self, db_path, base_url=None, cache_entries=10000):
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS urls ("
+                          "id INTEGER PRIMARY KEY, "
+                          "url TEXT UNIQUE NOT NULL, "
+                          "created INTEGER NOT NULL)")
+        self.conn.commit()
+        self.cache = LRUCache(cache_entries, cache_entries * 200)
+
+    def code(self, url):
+        """Return the short code of a URL, storing it if it's new"""
+        with self.lock:
+            code = self.cache.get(url)
+            if code is None:
+                with self.conn:
+                    row = self.conn.execute("SELECT id FROM urls WHERE url = ?",
+                                            (url,)).fetchone()
+                    if row:
+                        number = row[0]
+                    else:
+                        number = self.conn.execute(
+                            "INSERT INTO urls (url, created) VALUES (?, ?)",
+                            (url, int(time.time()))).lastrowid
+                code = base62(number)
+                self.cache.set(url, code, 24 * 60 * 60, len(url) + 50)
+            return code
+
+    def shorten(self, url):
+        """
+        Return the short URL for url.
+
+        Without a base URL to make links with, return url as it is.
+        """
+        if not self.base_url:
+            return url
+        return self.base_url + self.code(url)
+
+    def expand(self, code):
+        """Return the URL of a short code, or None"""
+        try:
+            number = unbase62(code)
+        except ValueError:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT url FROM urls WHERE id = ?",
+                                    (number,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    server_version = "fidibot"
+
+    def do_GET(self):
+        code = self.path.lstrip('/').split('?', 1)[0]
+        url = self.server.shortener.expand(code) if code else None
+        if url:
+            self.send_response(301)
+            self.send_header("Location", url.encode('utf-8'))
+        else:
+            self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_HEAD = do_GET
+
+    def log_message(self, fmt, *args):
+        log.debug("%s %s", self.address_string(), fmt % args)
+
+
+class RedirectServer(HTTPServer):
+    """HTTP server redirecting short codes, serving from a daemon thread"""
+
+    allow_reuse_address = True
+    # seconds to keep trying for the port, while a bot we took over from exits
+    bind_timeout = 30
+
+    def __init__(self, shortener, port, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), RedirectHandler, bind_and_activate=False)
+        self.shortener = shortener
+
+    def start(self):
+        try:
+            self._bind()
+            bound = True
+        except socket.error as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            bound = False
+        thread = threading.Thread(target=self._serve, args=(bound,), name="RedirectServer")
+        thread.daemon = True
+        thread.start()
+
+    def _bind(self):
+        self.server_bind()
+        self.server_activate()
+
+    def _serve(self, bound):
+        deadline = time.time() + self.bind_timeout
+        while not bound:
+            time.sleep(1)
+            try:
+                self._bind()
+                bound = True
+            except socket.error as e:
+                if time.time() > deadline:
+                    log.error("Can't serve short urls on %s:%d: %s",
+                              self.server_address[0], self.server_address[1], e)
+                    return
+        log.info("Serving short urls on %s:%d", *self.server_address)
+        self.serve_forever()
+
+
+if __name__ == '__main__':
+    # Test the shortener and the redirect server
+    import os, tempfile, shutil, httplib
+    assert [base62(n) for n in (0, 61, 62, 3843)] == ['0', 'Z', '10', 'ZZ']
+    assert all(unbase62(base62(n)) == n for n in xrange(5000))
+    tmp = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmp, "short.db")
+        short = Shortener(db_path, "http://s.example/")
+        a = short.shorten(u"http://example.com/a")
+        b = short.shorten(u"http://example.com/b")
+        assert a == "http://s.example/1" and b == "http://s.example/2"
+        assert short.shorten(u"http://example.com/a") == a
+        # codes persist
+        short.close()
+        short = Shortener(db_path, "http://s.example/")
+        assert short.shorten(u"http://example.com/b") == b
+        assert short.expand("2") == u"http://example.com/b"
+        assert short.expand("9") is None and short.expand("!") is None
+        assert Shortener(db_path).shorten(u"http://x") == u"http://x"
+
+        server = RedirectServer(short, 0)
+        server.start()
+        conn = httplib.HTTPConnection(*server.server_address)
+        conn.request("GET", "/1")
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 301, resp.status
+        assert resp.getheader("location") == "http://example.com/a"
+        conn.request("GET", "/nope")
+        resp = conn.getresponse()
+        assert resp.status == 404
+        server.shutdown()
+        print "Everything in order"
+    finally:
+        shutil.rmtree(tmp)
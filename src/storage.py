@@ -0,0 +1,349 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Write-behind persistence to SQLite
+
+A Store is a table of JSON values by key in a SQLite database, in WAL
+mode. Writes only go to a dict of pending changes in memory, which a
+thread of the store writes to the database every flush_interval
+seconds, or sooner when max_pending changes pile up, in a single
+transaction. So the bot never waits on the disk to remember something,
+and a busy minute costs a handful of commits instead of one per write.
+
+Reads see the pending changes first, then the database. Reading from
+the database blocks, so do it from a worker thread when it matters.
+
+Values JSON can't encode are logged and left out. A batch that fails
+to commit stays pending, to be tried again with the next one.
+
+What's pending is written at exit too, though a crash loses up to
+flush_interval seconds of changes. flush_all() writes every open store
+at once, ie. before handing over to a new process.
+
+Modules share one store, each with its own Namespace of keys in it. A
+namespace caches what it reads and writes, so only the first read of a
+key goes to the disk, and updates like incr() and compare_and_set()
+are atomic without ever waiting on it.
+"""
+
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger(__name__)
+
+# pending value of deleted keys
+deleted = object()
+# cached value of keys that aren't there
+missing = object()
+# every Store not closed yet
+open_stores = set()
+open_stores_lock = threading.Lock()
+
+
+def flush_all():
+    """Write the pending changes of every open store"""
+    with open_stores_lock:
+        stores = list(open_stores)
+    for store in stores:
+        store.flush()
+
+
+class Store(object):
+    """
+    JSON values by key, written behind to a SQLite table.
+
+    Safe to use from any thread.
+    """
+
+    def __init__(self, path, table, flush_interval=5, max_pending=1000):
+        self.table = table
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.db_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS %s ("
+                          "key TEXT PRIMARY KEY, "
+                          "value TEXT NOT NULL, "
+                          "updated REAL NOT NULL)" % table)
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.pending = {}
+        # changes being written, still to be read from memory
+        self.flushing = {}
+        self.writes = self.flushes = self.reads = self.errors = 0
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="store-%s" % table)
+        self.thread.daemon = True
+        self.thread.start()
+        with open_stores_lock:
+            open_stores.add(self)
+        atexit.register(self.close)
+
+    def set(self, key, value):
+        with self.lock:
+            self.pending[key] = value
+            self.writes += 1
+            full = len(self.pending) >= self.max_pending
+        if full:
+            self.wakeup.set()
+
+    def delete(self, key):
+        self.set(key, deleted)
+
+    def get(self, key, default=None):
+        """The value of key, from the database if it isn't pending"""
+        with self.lock:
+            value = self.pending.get(key, self.flushing.get(key))
+        if value is deleted:
+            return default
+        if value is not None:
+            return value
+        with self.db_lock:
+            self.reads += 1
+            row = self.conn.execute("SELECT value FROM %s WHERE key = ?" % self.table,
+                                    (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def flush(self):
+        """Write the pending changes to the database"""
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.flushing = pending
+            if not pending:
+                return
+            now = time.time()
+            upserts, deletes, bad = [], [], []
+            for key, value in pending.iteritems():
+                if value is deleted:
+                    deletes.append((key,))
+                    continue
+                try:
+                    upserts.append((key, json.dumps(value), now))
+                except (TypeError, ValueError) as e:
+                    # one bad value mustn't cost the rest of the batch
+                    log.error("Not storing %s in %s: %s", key, self.table, e)
+                    bad.append(key)
+            for key in bad:
+                del pending[key]
+            self.errors += len(bad)
+            try:
+                with self.db_lock:
+                    with self.conn:
+                        self.conn.executemany("INSERT OR REPLACE INTO %s (key, value, updated) "
+                                              "VALUES (?, ?, ?)" % self.table, upserts)
+                        self.conn.executemany("DELETE FROM %s WHERE key = ?" % self.table,
+                                              deletes)
+                    self.flushes += 1
+            except Exception:
+                with self.lock:
+                    # try the batch again next time, under what was set since
+                    pending.update(self.pending)
+                    self.pending = pending
+                    self.flushing = {}
+                raise
+            with self.lock:
+                self.flushing = {}
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception(e)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with open_stores_lock:
+            open_stores.discard(self)
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        with self.db_lock:
+            self.conn.close()
+
+    def __len__(self):
+        """Keys in the database, pending ones included"""
+        self.flush()
+        with self.db_lock:
+            return self.conn.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+
+    def stats(self):
+        return {'pending': len(self.pending), 'writes': self.writes,
+                'flushes': self.flushes, 'reads': self.reads, 'errors': self.errors}
+
+
+class Namespace(object):
+    """
+    The keys of a module in a shared Store, cached in memory.
+
+    Values are anything JSON can take. Set them again when they change,
+    changing them in place doesn't write them.
+    """
+
+    def __init__(self, store, name, cache_entries=1000):
+        self.store = store
+        self.prefix = name + ":"
+        self.cache_entries = cache_entries
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+
+    def _cache(self, key, value):
+        self.cache.pop(key, None)
+        self.cache[key] = value
+        if len(self.cache) > self.cache_entries:
+            self.cache.popitem(last=False)
+
+    def get(self, key, default=None):
+        """The value of key. Reads the disk the first time, unless it's cached"""
+        with self.lock:
+            if key in self.cache:
+                value = self.cache[key]
+            else:
+                value = self.store.get(self.prefix + key, missing)
+            self._cache(key, value)
+        return default if value is missing else value
+
+    def set(self, key, value):
+        with self.lock:
+            self._cache(key, value)
+            self.store.set(self.prefix + key, value)
+
+    def delete(self, key):
+        with self.lock:
+            self._cache(key, missing)
+            self.store.delete(self.prefix + key)
+
+    def incr(self, key, amount=1):
+        """Add amount to the number at key, 0 if it isn't there. Returns the new number"""
+        with self.lock:
+            value = self.get(key, 0) + amount
+            self.set(key, value)
+        return value
+
+    def compare_and_set(self, key, expected, value):
+        """Set key to value only if it is expected now, None if it isn't there. Returns whether it did"""
+        with self.lock:
+            if self.get(key) != expected:
+                return False
+            self.set(key, value)
+        return True
+
+    def __contains__(self, key):
+        return self.get(key, missing) is not missing
+
+
+if __name__ == '__main__':
+    # Test that writes are batched and survive reopening
+    import os, tempfile, shutil
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "test.db")
+        store = Store(path, "things", flush_interval=60, max_pending=1000)
+        store.set("a", {'n': 1})
+        store.set("b", [1, 2])
+        store.set("a", {'n': 2})
+        assert store.get("a") == {'n': 2} and store.flushes == 0 # from memory
+        store.flush()
+        assert store.flushes == 1 and not store.pending
+        assert store.get("a") == {'n': 2} and store.reads == 1
+        store.delete("b")
+        assert store.get("b") is None
+        assert len(store) == 1
+        # a full batch wakes the writer up
+        for i in xrange(1000):
+            store.set("k%d" % i, i)
+        for i in xrange(50):
+            if not store.pending:
+                break
+            time.sleep(0.01)
+        assert not store.pending and store.get("k999") == 999
+        # values JSON can't take are dropped, the rest are written
+        logging.disable(logging.ERROR)
+        store.set("bad", set([1]))
+        store.set("good", 1)
+        store.flush()
+        assert store.errors == 1 and store.get("bad") is None and store.get("good") == 1
+        # a batch that fails to commit is kept, under newer values
+        conn = store.conn
+        class Failing(object):
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc):
+                pass
+            def executemany(self, *args):
+                store.set("good", 3)
+                raise sqlite3.OperationalError("disk I/O error")
+        store.set("good", 2)
+        store.set("also", 2)
+        store.conn = Failing()
+        try:
+            store.flush()
+            assert False
+        except sqlite3.OperationalError:
+            pass
+        store.conn = conn
+        logging.disable(logging.NOTSET)
+        assert store.pending == {"good": 3, "also": 2}
+        store.flush()
+        store.set("last", "one")
+        other = Store(os.path.join(tmp, "other.db"), "others", flush_interval=60)
+        other.set("too", 2)
+        flush_all()
+        assert not store.pending and not other.pending and other.flushes == 1
+        other.close()
+        assert other not in open_stores and store in open_stores
+        store.close()
+        store = Store(path, "things")
+        assert store.get("last") == "one" and store.get("a") == {'n': 2}
+        assert store.get("good") == 3 and store.get("also") == 2
+        assert store.get("b", "gone") == "gone"
+        store.close()
+
+        # writing is only a dict assignment
+        store = Store(path, "things", flush_interval=60, max_pending=10 ** 6)
+        start = time.time()
+        for i in xrange(100000):
+            store.set("nick%d" % i, [i, "message", "#fidibot", "hello"])
+        set_time = time.time() - start
+        start = time.time()
+        store.flush()
+        flush_time = time.time() - start
+        print "100000 writes: %.1fus each, flushed in %.2fs" % (set_time * 10, flush_time)
+        store.close()
+
+        # namespaces keep apart, and counting never waits on the disk
+        store = Store(path, "modules", flush_interval=60)
+        karma = Namespace(store, "karma")
+        other = Namespace(store, "other")
+        assert karma.incr("fidibot") == 1 and karma.incr("fidibot", 2) == 3
+        assert "fidibot" not in other and other.get("fidibot", 0) == 0
+        assert karma.compare_and_set("topic", None, "old")
+        assert not karma.compare_and_set("topic", "new", "newer")
+        assert karma.compare_and_set("topic", "old", "new") and karma.get("topic") == "new"
+        karma.delete("topic")
+        assert "topic" not in karma
+        start = time.time()
+        for i in xrange(100000):
+            karma.incr("nick%d" % (i % 100))
+        print "100000 increments: %.1fus each, %d reads" % ((time.time() - start) * 10, store.reads)
+        store.close()
+        store = Store(path, "modules")
+        karma = Namespace(store, "karma")
+        assert karma.get("fidibot") == 3 and karma.get("nick7") == 1000 and "topic" not in karma
+        store.close()
+    finally:
+        shutil.rmtree(tmp)
+    print "Everything in order"
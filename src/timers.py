@@ -0,0 +1,251 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+A hierarchical timer wheel, to schedule lots of timers cheaply
+
+irc.client keeps its delayed commands in a sorted list, which is fine
+for a few of them but costs more with every one added. A TimerWheel
+instead drops every timer in a slot of a wheel of 256 ticks. Timers
+further away go to the slots of coarser wheels, each 256 times longer
+than the one below it, and cascade down a wheel whenever the one
+below it goes round. Scheduling and cancelling are O(1) and a tick
+costs the same however many timers are pending.
+
+With the default tick of a tenth of a second, four wheels cover 13
+years. Timers beyond that wait in an overflow list.
+
+The bot drives its wheel from the reactor, so timers fire at most a
+tick late, plus however long the reactor is busy. Timers missed while
+it was busy all fire on the next run, in the order they were due.
+"""
+
+import math
+import time
+from lag import RollingHistogram
+
+import logging
+log = logging.getLogger(__name__)
+
+slot_bits = 8
+slot_mask = (1 << slot_bits) - 1
+default_tick = 0.1
+default_levels = 4
+
+
+class Timer(object):
+    """A scheduled call, that can be cancelled"""
+
+    __slots__ = ('due', 'tick', 'function', 'args', 'wheel')
+
+    def __init__(self, wheel, due, tick, function, args):
+        self.wheel = wheel
+        self.due = due
+        self.tick = tick
+        self.function = function
+        self.args = args
+
+    @property
+    def active(self):
+        return self.wheel is not None
+
+    def cancel(self):
+        """Don't run it, if it hasn't run yet. Returns whether it was pending"""
+        if self.wheel is None:
+            return False
+        self.wheel.pending -= 1
+        self.wheel.cancelled += 1
+        self.wheel = None
+        return True
+
+
+class TimerWheel(object):
+    """
+    Timers by tick in a hierarchy of wheels.
+
+    Call run_due() every tick or so, from the thread the timers should
+    run in. Timers are only safe to schedule from that thread too.
+    """
+
+    def __init__(self, tick=default_tick, levels=default_levels, clock=time.time):
+        self.tick = tick
+        self.levels = levels
+        self.clock = clock
+        self.wheels = [[[] for i in xrange(1 << slot_bits)] for level in xrange(levels)]
+        self.overflow = []
+        # timers in the slots of each wheel, cancelled ones included
+        self.counts = [0] * levels
+        # the last tick that was run
+        self.current = self._tick_of(clock())
+        self.pending = self.fired = self.cancelled = 0
+        # how late timers ran, in milliseconds
+        self.lateness = RollingHistogram(clock=clock)
+
+    def _tick_of(self, when):
+        # not //, which floors the exact quotient of the binary fractions
+        return int(math.floor(when / self.tick))
+
+    def schedule(self, delay, function, *args):
+        """Run function(*args) in delay seconds, returning its Timer"""
+        return self.schedule_at(self.clock() + delay, function, *args)
+
+    def schedule_at(self, when, function, *args):
+        """Run function(*args) at the time when, or as soon as possible if it's past"""
+        # the end of a tick is the earliest we can tell it has passed
+        tick = max(int(math.ceil(when / self.tick)), self.current + 1)
+        timer = Timer(self, when, tick, function, args)
+        self._add(timer)
+        self.pending += 1
+        return timer
+
+    def _add(self, timer):
+        # a wheel holds the timers in the turn of the wheel above it
+        # that the next tick is in
+        following = self.current + 1
+        tick = max(timer.tick, following)
+        for level in xrange(self.levels):
+            shift = slot_bits * (level + 1)
+            if tick >> shift == following >> shift:
+                self.wheels[level][(tick >> (slot_bits * level)) & slot_mask].append(timer)
+                self.counts[level] += 1
+                return
+        self.overflow.append(timer)
+
+    def _cascade(self, tick):
+        """Move the timers of the coarser wheels down as the finer ones go round"""
+        for level in xrange(1, self.levels):
+            shift = slot_bits * level
+            if tick & ((1 << shift) - 1):
+                return
+            wheel = self.wheels[level]
+            index = (tick >> shift) & slot_mask
+            timers, wheel[index] = wheel[index], []
+            self.counts[level] -= len(timers)
+            for timer in timers:
+                if timer.wheel is not None:
+                    self._add(timer)
+        if not tick & ((1 << (slot_bits * self.levels)) - 1):
+            timers, self.overflow = self.overflow, []
+            for timer in timers:
+                if timer.wheel is not None:
+                    self._add(timer)
+
+    def expire(self, now=None):
+        """Advance the wheel to now, returning the timers that are due, in order"""
+        target = self._tick_of(self.clock() if now is None else now)
+        due = []
+        if not self.pending:
+            # nothing to cascade, jump straight there
+            self.current = max(self.current, target)
+            return due
+        wheel = self.wheels[0]
+        while self.current < target:
+            # skip to where the next wheel with timers cascades
+            level = 0
+            while level < self.levels and not self.counts[level]:
+                level += 1
+            if level:
+                span = 1 << (slot_bits * level)
+                self.current = min(target, (self.current // span + 1) * span - 1)
+                if self.current == target:
+                    break
+            # run the first wheel up to where it goes round, or target
+            first = self.current + 1
+            if not first & slot_mask:
+                self._cascade(first)
+            last = min(target, first | slot_mask)
+            for index in xrange(first & slot_mask, (last & slot_mask) + 1):
+                if wheel[index]:
+                    timers, wheel[index] = wheel[index], []
+                    self.counts[0] -= len(timers)
+                    due.extend(timer for timer in timers if timer.wheel is not None)
+            self.current = last
+        # timers added to the same slot out of order
+        due.sort(key=lambda timer: timer.due)
+        return due
+
+    def run_due(self):
+        """Run the timers that are due"""
+        now = self.clock()
+        for timer in self.expire(now):
+            if timer.wheel is None:
+                # cancelled by a timer before it
+                continue
+            timer.wheel = None
+            self.pending -= 1
+            self.fired += 1
+            self.lateness.record(max(now - timer.due, 0) * 1000)
+            try:
+                timer.function(*timer.args)
+            except Exception as e:
+                log.exception(e)
+
+    def __len__(self):
+        return self.pending
+
+    def stats(self):
+        counts = self.lateness.counts()
+        return {'pending': self.pending, 'fired': self.fired, 'cancelled': self.cancelled,
+                'late_p50_ms': self.lateness.percentile(50, counts),
+                'late_p99_ms': self.lateness.percentile(99, counts)}
+
+
+if __name__ == '__main__':
+    # Test with a fake clock that every timer runs in its tick, in order
+    import random
+    now = [1000.0]
+    wheel = TimerWheel(tick=0.1, clock=lambda: now[0])
+    ran = []
+    def record(due):
+        ran.append((now[0], due))
+    rnd = random.Random(49)
+    delays = [rnd.choice([rnd.uniform(0, 30), rnd.uniform(0, 2 * 3600), rnd.uniform(0, 40 * 86400)])
+              for i in xrange(200000)]
+    start = time.time()
+    timers = [wheel.schedule(d, record, 1000.0 + d) for d in delays]
+    took = time.time() - start
+    print "200000 timers scheduled, %.1fus each" % (took * 5)
+    for timer in timers[::10]:
+        assert timer.cancel()
+    assert not timers[0].cancel() and len(wheel) == 180000
+    # a day at a time, then catching up on the rest at once
+    start = time.time()
+    for day in xrange(40):
+        now[0] += 86400
+        wheel.run_due()
+    now[0] += 86400
+    wheel.run_due()
+    took = time.time() - start
+    assert len(ran) == 180000 and not len(wheel) and wheel.fired == 180000
+    assert all(a[1] <= b[1] for a, b in zip(ran, ran[1:]))
+    print "41 days run through in %.2fs" % took
+
+    # run every tick, every timer runs within the tick it's due in
+    ran[:] = []
+    now[0] = 5000.0
+    wheel = TimerWheel(tick=0.1, clock=lambda: now[0])
+    for i in xrange(2000):
+        delay = rnd.uniform(0, 600)
+        wheel.schedule(delay, record, now[0] + delay)
+    while len(wheel):
+        now[0] += 0.1
+        wheel.run_due()
+    assert len(ran) == 2000 and all(0 <= when - due < 0.1 + 1e-6 for when, due in ran)
+    # a timer cancelled by one before it in the same run doesn't run
+    wheel = TimerWheel(tick=0.1, clock=lambda: now[0])
+    later = wheel.schedule(0.05, record, "cancelled")
+    wheel.schedule(0.01, later.cancel)
+    now[0] += 1
+    ran[:] = []
+    wheel.run_due()
+    assert not ran and wheel.cancelled == 1 and wheel.fired == 1
+
+    # Measure the precision on the real clock
+    wheel = TimerWheel(tick=0.05)
+    for i in xrange(100):
+        wheel.schedule(rnd.uniform(0, 2), lambda: None)
+    while len(wheel):
+        time.sleep(0.01)
+        wheel.run_due()
+    stats = wheel.stats()
+    print "100 timers on the real clock: p50 late <=%sms, p99 late <=%sms" % (
+        stats['late_p50_ms'], stats['late_p99_ms'])
+    print "Everything in order"
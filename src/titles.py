@@ -0,0 +1,173 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Streaming extraction of page titles
+
+Instead of downloading a whole page and building a full tree of it,
+the page is fed chunk by chunk to an incremental parser that stops
+as soon as it has seen the `<title>`, or an `og:title` meta tag,
+or a byte budget runs out.
+
+The title is decoded with the charset from the response headers,
+or a meta tag, falling back to UTF-8 and then Windows-1252.
+"""
+
+import re
+import codecs
+from HTMLParser import HTMLParser, HTMLParseError
+
+charset_regex = re.compile(r"charset\s*=\s*[\"']?([\w.:-]+)", re.IGNORECASE)
+whitespace = re.compile(r"\s+", re.UNICODE)
+
+
+def charset_from_content_type(content_type):
+    """Return the charset of a Content-Type value, if it names a known one"""
+    if not content_type:
+        return None
+    m = charset_regex.search(content_type)
+    if not m:
+        return None
+    try:
+        return codecs.lookup(m.group(1)).name
+    except LookupError:
+        return None
+
+
+class TitleParser(HTMLParser):
+    """
+    Incremental parser looking for the page title.
+
+    Feed it and check `done` after every chunk.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.in_title = False
+        self.title_parts = None
+        self.og_title = None
+        self.charset = None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and self.title_parts is None:
+            self.in_title = True
+            self.title_parts = []
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            if attrs.get('charset'):
+                self.charset = charset_from_content_type("charset=" + attrs['charset'])
+            elif (attrs.get('http-equiv') or '').lower() == 'content-type':
+                self.charset = charset_from_content_type(attrs.get('content'))
+            elif attrs.get('property') == 'og:title' and attrs.get('content'):
+                self.og_title = attrs['content']
+                self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self.done = True
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data("&%s;" % name)
+
+    def handle_charref(self, name):
+        self.handle_data("&#%s;" % name)
+
+    def unescape(self, s):
+        # HTMLParser unescapes attributes with this while they're still
+        # bytes. extract_title() unescapes the title once it's decoded instead
+        return s
+
+    def raw_title(self):
+        if self.title_parts:
+            title = "".join(self.title_parts)
+            if title.strip():
+                return title
+        return self.og_title
+
+
+def decode(raw, charsets):
+    """Decode raw bytes with the first charset that works"""
+    if isinstance(raw, unicode):
+        return raw
+    for charset in charsets:
+        if not charset:
+            continue
+        try:
+            return raw.decode(charset)
+        except (UnicodeDecodeError, LookupError):
+            pass
+    return raw.decode('cp1252', 'replace')
+
+
+def extract_title(chunks, content_type=None, max_bytes=256*1024):
+    """
+    Find the title of a page from an iterable of byte chunks.
+
+    Reading stops at the end of the title, or the head, or after
+    max_bytes. Return the title with whitespace collapsed, or None.
+    """
+    parser = TitleParser()
+    read = 0
+    for chunk in chunks:
+        if read + len(chunk) > max_bytes:
+            chunk = chunk[:max_bytes - read]
+        read += len(chunk)
+        try:
+            parser.feed(chunk)
+        except HTMLParseError:
+            break
+        if parser.done or read >= max_bytes:
+            break
+    raw = parser.raw_title()
+    if raw is None:
+        return None
+    charsets = (charset_from_content_type(content_type), parser.charset, 'utf-8')
+    title = HTMLParser.unescape(parser, decode(raw, charsets))
+    return whitespace.sub(u" ", title).strip() or None
+
+
+if __name__ == '__main__':
+    # Test the extractor
+    def chunked(data, size=7):
+        return (data[i:i + size] for i in xrange(0, len(data), size))
+    page = "<html><head><meta charset='utf-8'><title>\n Caf\xc3\xa9 &amp; bar </title></head>"
+    assert extract_title(chunked(page)) == u"Caf\xe9 & bar"
+    page = "<html><head><title>Caf\xe9</title></head>"
+    assert extract_title(chunked(page), "text/html; charset=ISO-8859-1") == u"Caf\xe9"
+    assert extract_title(chunked(page)) == u"Caf\xe9"
+    page = '<html><head><meta property="og:title" content="Open graph"></head>'
+    assert extract_title(chunked(page)) == u"Open graph"
+    # entities are unescaped once, wherever the title comes from
+    page = '<html><head><meta property="og:title" content="a &amp;lt; b"></head>'
+    assert extract_title(chunked(page)) == u"a &lt; b"
+    page = '<html><head><meta property="og:title" content="Caf&#233; \xc3\xa9"></head>'
+    assert extract_title(chunked(page)) == u"Caf\xe9 \xe9"
+    page = '<html><head><title>a &amp;lt; b</title></head>'
+    assert extract_title(chunked(page)) == u"a &lt; b"
+    page = "<html><head></head><body>" + "x" * 1000 + "<title>late</title>"
+    assert extract_title(chunked(page, 100), max_bytes=500) is None
+    assert extract_title(chunked("")) is None
+
+    # Benchmark against parsing the whole page with BeautifulSoup
+    import timeit
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        print "Install beautifulsoup4 to run the benchmark"
+        raise SystemExit
+    body = "<div class='post'><p>Some text <a href='/x'>link</a></p></div>\n" * 40000
+    page = ("<!DOCTYPE html><html><head><meta charset='utf-8'>"
+            "<title>A big page</title></head><body>" + body + "</body></html>")
+    chunks = list(chunked(page, 8192))
+    t_soup = min(timeit.repeat(lambda: BeautifulSoup(page).title.text, number=1, repeat=3))
+    t_stream = min(timeit.repeat(lambda: extract_title(chunks), number=1, repeat=3))
+    assert BeautifulSoup(page).title.text == extract_title(chunks)
+    print "%.1fMB page  soup: %.1fms  streaming: %.3fms" % (
+        len(page) / 1e6, t_soup * 1000, t_stream * 1000)
+    print "Everything in order"
@@ -1,3 +1,7 @@
+import os
+import re
+from itertools import islice
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 class Throttle(object):
@@ -25,7 +29,214 @@ class Throttle(object):
             self.dict[key] = self.dtclass.now()
         return ans
 
-   
+
+class LRUCache(object):
+    """
+    Least recently used cache with a time to live for each entry.
+
+    The cache holds at most max_entries entries and max_bytes of their
+    sizes, as given to set(). The least recently used entries are
+    evicted first when either limit is reached.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=1024*1024, datetime_class=datetime):
+        self.dict = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.dtclass = datetime_class
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key, default=None):
+        try:
+            value, expires, size = self.dict.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < self.dtclass.now():
+            self.size -= size
+            self.expirations += 1
+            self.misses += 1
+            return default
+        # re-insert to mark it as the most recently used
+        self.dict[key] = value, expires, size
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl, size=1):
+        if size > self.max_bytes:
+            return
+        self.discard(key)
+        expires = self.dtclass.now() + timedelta(seconds=ttl)
+        self.dict[key] = value, expires, size
+        self.size += size
+        while len(self.dict) > self.max_entries or self.size > self.max_bytes:
+            old_key, (old_value, old_expires, old_size) = self.dict.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    def discard(self, key):
+        try:
+            value, expires, size = self.dict.pop(key)
+        except KeyError:
+            return
+        self.size -= size
+
+    def purge(self):
+        """Remove all entries, returning how many there were"""
+        count = len(self.dict)
+        self.dict.clear()
+        self.size = 0
+        return count
+
+    def __len__(self):
+        return len(self.dict)
+
+    def stats(self):
+        return {'entries': len(self.dict), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class CircuitBreakers(object):
+    """
+    Circuit breakers for many keys, ie. hosts.
+
+    After `threshold` failures in a row for a key its circuit opens and
+    allow() refuses it for `cooldown` seconds. Then a single probe is
+    allowed through, half-open. If the probe succeeds the circuit
+    closes, if it fails it opens again for another cooldown.
+    Only keys with failures are kept, along with the reason of the
+    last failure.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=3, cooldown=60, max_entries=1000, datetime_class=datetime):
+        self.dict = {}
+        self.threshold = threshold
+        self.cooldown = timedelta(seconds=cooldown)
+        self.max_entries = max_entries
+        self.dtclass = datetime_class
+        self.trips = self.rejections = 0
+
+    def state(self, key):
+        entry = self.dict.get(key)
+        return entry[0] if entry else self.CLOSED
+
+    def allow(self, key):
+        """Return whether a request for key should go through"""
+        entry = self.dict.get(key)
+        if not entry or entry[0] == self.CLOSED:
+            return True
+        state, failures, since, reason = entry
+        now = self.dtclass.now()
+        # a half-open probe that never reported back gets replaced
+        if since + self.cooldown <= now:
+            self.dict[key] = [self.HALF_OPEN, failures, now, reason]
+            return True
+        self.rejections += 1
+        return False
+
+    def reason(self, key):
+        entry = self.dict.get(key)
+        return entry[3] if entry else None
+
+    def success(self, key):
+        self.dict.pop(key, None)
+
+    def failure(self, key, reason=None):
+        now = self.dtclass.now()
+        entry = self.dict.get(key)
+        if not entry:
+            if len(self.dict) >= self.max_entries:
+                self._prune()
+            entry = self.dict[key] = [self.CLOSED, 0, now, None]
+        entry[1] += 1
+        entry[3] = reason
+        if entry[0] == self.HALF_OPEN or (
+                entry[0] == self.CLOSED and entry[1] >= self.threshold):
+            entry[0] = self.OPEN
+            entry[2] = now
+            self.trips += 1
+
+    def _prune(self):
+        """Make room for a key, dropping the closed and cooled down ones first"""
+        now = self.dtclass.now()
+        for key, entry in self.dict.items():
+            if entry[0] == self.CLOSED or entry[2] + self.cooldown <= now:
+                del self.dict[key]
+        if len(self.dict) >= self.max_entries:
+            # then the ones open the longest
+            oldest = sorted(self.dict, key=lambda key: self.dict[key][2])
+            for key in oldest[:len(self.dict) - self.max_entries + 1]:
+                del self.dict[key]
+
+    def stats(self):
+        states = [entry[0] for entry in self.dict.itervalues()]
+        return {'open': states.count(self.OPEN),
+                'half_open': states.count(self.HALF_OPEN),
+                'failing': states.count(self.CLOSED),
+                'trips': self.trips, 'rejections': self.rejections}
+
+
+def human_delta(seconds):
+    """Say how long a number of seconds is, in its biggest unit, ie. 3m"""
+    seconds = int(seconds)
+    for unit, length in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= length:
+            return "%d%s" % (seconds // length, unit)
+    return "%ds" % max(seconds, 0)
+
+
+duration_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+duration_regex = re.compile(r"^(?:\s*(\d+)\s*([smhdw]))+\s*$", re.IGNORECASE)
+duration_part = re.compile(r"(\d+)\s*([smhdw])", re.IGNORECASE)
+
+
+def parse_duration(text):
+    """Seconds in a duration like 1h30m or 2d, None if it isn't one"""
+    if not duration_regex.match(text):
+        return None
+    return sum(int(n) * duration_units[unit.lower()] for n, unit in duration_part.findall(text))
+
+
+def reverse_lines(path, block_size=4096):
+    """
+    Yield the lines of a file, last line first.
+
+    The file is read in blocks backwards from its end, so getting the
+    last few lines costs the same no matter how big the file is.
+    Lines are yielded without their line endings.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        rest = ''
+        first = True
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + rest).split('\n')
+            if first and lines[-1] == '':
+                # don't yield an empty line for the final newline
+                lines.pop()
+            first = False
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                yield line.rstrip('\r')
+        if not first:
+            yield rest.rstrip('\r')
+
+
+def tail(path, n=10, block_size=4096):
+    """Return the last n lines of a file, without line endings"""
+    lines = list(islice(reverse_lines(path, block_size), n))
+    lines.reverse()
+    return lines
+
+
 class DummyDatetime(object):
     def __init__(self):
         self.dt = datetime.fromtimestamp(0)
@@ -49,3 +260,78 @@ if __name__ == '__main__':
     assert th.is_throttled("a") == True, 't=20'
     dt.advance(10) # t=30
     assert th.is_throttled("a") == False, 't=30'
+
+    # Test the LRUCache class
+    dt = DummyDatetime() # t=0
+    cache = LRUCache(max_entries=2, max_bytes=10, datetime_class=dt)
+    cache.set("a", 1, ttl=10)
+    cache.set("b", 2, ttl=5)
+    assert cache.get("a") == 1
+    cache.set("c", 3, ttl=10) # evicts b, a was used more recently
+    assert cache.get("b") is None
+    dt.advance(6) # t=6
+    assert cache.get("c") == 3
+    cache.set("d", 4, ttl=1, size=9) # evicts a for size
+    assert cache.get("a") is None and cache.get("d") == 4
+    dt.advance(2) # t=8, d expired
+    assert cache.get("d") is None
+    assert cache.size == 1
+    cache.set("e", 5, ttl=10, size=11) # too big to cache
+    assert cache.get("e") is None
+    assert cache.stats()['hits'] == 3
+    assert cache.purge() == 1 and cache.size == 0
+
+    # Test the CircuitBreakers class
+    dt = DummyDatetime() # t=0
+    breakers = CircuitBreakers(threshold=2, cooldown=10, datetime_class=dt)
+    breakers.failure("a")
+    assert breakers.allow("a") and breakers.state("a") == 'closed'
+    breakers.failure("a", "down") # opens until t=10
+    assert not breakers.allow("a") and breakers.allow("b")
+    assert breakers.reason("a") == "down"
+    dt.advance(10) # t=10
+    assert breakers.allow("a") and breakers.state("a") == 'half-open'
+    assert not breakers.allow("a") # only one probe
+    breakers.failure("a") # opens again until t=20
+    dt.advance(5) # t=15
+    assert not breakers.allow("a")
+    dt.advance(5) # t=20
+    assert breakers.allow("a")
+    breakers.success("a")
+    assert breakers.state("a") == 'closed' and not breakers.dict
+    assert breakers.stats()['trips'] == 2
+    # the dict stays bounded by max_entries, whatever the states
+    breakers = CircuitBreakers(threshold=1, cooldown=10, max_entries=3, datetime_class=dt)
+    for host in "abc":
+        breakers.failure(host)
+        dt.advance(1)
+    breakers.failure("d") # none cooled down, a is open the longest
+    assert sorted(breakers.dict) == ["b", "c", "d"]
+    dt.advance(8) # b cooled down, c and d not yet
+    breakers.failure("e")
+    assert sorted(breakers.dict) == ["c", "d", "e"]
+    dt.advance(100)
+    breakers.failure("f")
+    assert sorted(breakers.dict) == ["f"]
+
+    assert [human_delta(s) for s in (-1, 59, 60, 7199, 86400 * 3)] == ['0s', '59s', '1m', '1h', '3d']
+    assert [parse_duration(s) for s in ("90s", "1h30m", "2D", "1w 1d", "soon", "5")] == \
+        [90, 5400, 172800, 691200, None, None]
+
+    # Test the reverse reader
+    import tempfile
+    fd, path = tempfile.mkstemp()
+    try:
+        lines = ["line %d" % i for i in xrange(100)]
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        for bs in (1, 3, 7, 4096):
+            assert list(reverse_lines(path, bs)) == lines[::-1], bs
+            assert tail(path, 5, bs) == lines[-5:], bs
+        with open(path, 'w') as f:
+            f.write("no newline\r\nat the end")
+        assert tail(path, 5, 4) == ["no newline", "at the end"]
+        open(path, 'w').close()
+        assert tail(path, 5) == []
+    finally:
+        os.remove(path)
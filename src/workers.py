@@ -0,0 +1,122 @@
+# Author: Nick Raptis <airscorp@gmail.com>
+"""
+Worker threads for running blocking work off the reactor thread
+
+Anything that waits on the network or disk for long should be run
+through the bot's WorkerPool, so the reactor keeps processing events.
+Results are handed back through a callback that runs on the reactor
+thread, where it is safe to send messages and touch module state.
+"""
+
+import threading
+import Queue
+from collections import defaultdict
+from contextlib import contextmanager
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def call_now(function, *args):
+    """Run a callback right away, for when there is no reactor"""
+    function(*args)
+
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads processing jobs from a queue.
+
+    call_soon is how callbacks get to the reactor thread. It is called
+    as call_soon(callback, result, error), ie. a function that
+    schedules the call with the reactor's execute_delayed.
+    """
+
+    def __init__(self, size=8, call_soon=call_now, name="worker"):
+        self.queue = Queue.Queue()
+        self.call_soon = call_soon
+        self.threads = []
+        for i in xrange(size):
+            t = threading.Thread(target=self._work, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, function, args=(), callback=None):
+        """
+        Run function(*args) in a worker thread.
+
+        If given, callback(result, error) is run on the reactor thread
+        afterwards. error is None if the function didn't raise.
+        """
+        self.queue.put((function, args, callback))
+
+    def _work(self):
+        while True:
+            function, args, callback = self.queue.get()
+            result = error = None
+            try:
+                result = function(*args)
+            except Exception as e:
+                log.exception(e)
+                error = e
+            if callback:
+                self.call_soon(callback, result, error)
+
+
+class KeyedSemaphore(object):
+    """Limit how many threads can hold a slot for the same key at once"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = defaultdict(lambda: threading.Semaphore(self.limit))
+        self.users = defaultdict(int)
+
+    @contextmanager
+    def slot(self, key):
+        with self.lock:
+            semaphore = self.semaphores[key]
+            self.users[key] += 1
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+            with self.lock:
+                self.users[key] -= 1
+                if not self.users[key]:
+                    # nobody is waiting, don't keep it around
+                    del self.users[key]
+                    del self.semaphores[key]
+
+
+if __name__ == '__main__':
+    # Test the pool and the per key limits
+    import time
+    results = Queue.Queue()
+    pool = WorkerPool(4, call_soon=lambda f, *a: results.put(a))
+    pool.submit(lambda x: x * 2, (21,), callback=True)
+    assert results.get(timeout=1) == (42, None)
+    pool.submit(lambda: 1 / 0, callback=True)
+    result, error = results.get(timeout=1)
+    assert isinstance(error, ZeroDivisionError)
+
+    limits = KeyedSemaphore(2)
+    running = defaultdict(int)
+    peak = defaultdict(int)
+    lock = threading.Lock()
+    def job(key):
+        with limits.slot(key):
+            with lock:
+                running[key] += 1
+                peak[key] = max(peak[key], running[key])
+            time.sleep(0.05)
+            with lock:
+                running[key] -= 1
+    for key in "aaaab":
+        pool.submit(job, (key,), callback=True)
+    for _ in xrange(5):
+        results.get(timeout=2)
+    assert peak['a'] == 2 and peak['b'] == 1, peak
+    assert not limits.semaphores
+    print "Everything in order"